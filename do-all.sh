@@ -1,18 +1,19 @@
 #!/bin/bash
 
 # better set lower during an observation
-# if too large, the oldest ones see http 302 (redir)
+# cycles older than NOMADS keeps get a .skip file instead of downloads (they used to see http 302)
 BACKFILL=168
 
 # use during an observation -- normally set in weatherwrapper.sh
 #WAIT="--wait"
 #FLUSH="--flush Aa"
 
-for vex in $STATIONS; do
-   eht-met-forecast --backfill $BACKFILL --dir $DEST --vex $vex $WAIT $FLUSH --log LOG &
-done
+# shared with anything else using this --dir, NOMADS blocks at 120/minute
+QUOTA="--quota-per-minute 100"
 
-wait
+# one process for every station and cycle: one stats and latency report, nearby stations share downloads
+VEXES=$(echo $STATIONS | tr ' ' ',')
+eht-met-forecast --backfill $BACKFILL --dir $DEST --vex $VEXES --async --batch $WAIT $FLUSH $QUOTA --log LOG
 
 (cd $DEST && bash ./commit-finished.sh)
 
@@ -5,6 +5,8 @@ import os
 import sys
 import math
 
+import numpy as np
+
 from .constants import LEVELS, GFS_DAY, LATLON_DELTA
 from .latlon import box
 
@@ -17,7 +19,23 @@ f 225 GHz 225 GHz 1 GHz
 output f GHz tau Tb K
 T0 2.7 K
 '''
-# XXX hint: this for 345 ghz 'f  345 GHz 345 GHz 1 GHz'
+frequencies = [225]  # GHz, the first is the tau255 column of the tables. Set by the cli
+
+
+def frequency_header(freqs=None):
+    '''
+    header_amc, with a frequency grid that hits every band in freqs, so that
+    one am run per profile computes all of them. am aligns its grid to integer
+    multiples of the step, so the step is the gcd of the bands themselves.
+    '''
+    freqs = sorted(set(freqs or frequencies))
+    step = 0
+    if len(freqs) > 1:
+        for freq in freqs:
+            step = math.gcd(step, freq)
+    grid = 'f {} GHz {} GHz {} GHz'.format(freqs[0], freqs[-1], step or 1)
+    return header_amc.replace('f 225 GHz 225 GHz 1 GHz', grid)
+
 
 LAYER_HEADER = """
 #
@@ -54,6 +72,120 @@ def grid_interp_vector(a, b, u, v):
     return grid_interp(c, u, v)
 
 
+def grid_interp_stack(cells, u, v):
+    # grid_interp for a stack of 2x2 cells, shape (..., 2, 2) -> (...), same arithmetic in the same order
+    return (cells[..., 0, 0] * (1.0 - u) * (1.0 - v) + cells[..., 1, 0] * u * (1.0 - v)
+          + cells[..., 0, 1] * (1.0 - u) * v         + cells[..., 1, 1] * u * v       )
+
+
+def grid_interp_vector_stack(a, b, u, v):
+    return grid_interp_stack(np.sqrt(a**2 + b**2), u, v)
+
+
+def grid_cells(grb, row=0, col=0):
+    # the 2x2 cells around a station; row and col are nonzero when the grib covers a group of stations
+    return grb.values[row:row+2, col:col+2]
+
+
+class GribCells:
+    # just enough of a pygrib message for grid_cells() and latlons(): the 2x2 cells around one station
+    def __init__(self, values, lats, lons):
+        self.values = values
+        self.lats = lats
+        self.lons = lons
+
+    def latlons(self):
+        return self.lats, self.lons
+
+
+def grib_messages(grib_buffer):
+    # split a buffer of grib2 messages using the total length in each section 0
+    pos = 0
+    while pos < len(grib_buffer):
+        if grib_buffer[pos:pos+4] != b'GRIB':
+            raise ValueError('no GRIB header at byte {}'.format(pos))
+        length = int.from_bytes(grib_buffer[pos+8:pos+16], 'big')
+        yield grib_buffer[pos:pos+length]
+        pos += length
+
+
+class CellsIndex:
+    # stands in for pygrib.index(gribname, 'name', 'level')
+    def __init__(self):
+        self.fields = {}
+
+    def select(self, name, level):
+        try:
+            return [self.fields[(name, level)]]
+        except KeyError:
+            raise ValueError('no matches found')
+
+    def get(self, name, level):
+        # None if missing
+        return self.fields.get((name, level))
+
+    def names(self):
+        return sorted(set(name for name, level in self.fields))
+
+
+class GribIndex(CellsIndex):
+    # decoded straight from the downloaded bytes, no temporary file and no on-disk index
+    def __init__(self, grib_buffer):
+        super().__init__()
+        for message in grib_messages(grib_buffer):
+            grb = pygrib.fromstring(message)
+            self.fields.setdefault((grb['name'], grb['level']), grb)  # like select(...)[0], the first one wins
+
+
+def subset_grib(grib_buffer, sites):
+    '''
+    Read a grib covering many stations -- a batch box or a whole global grid -- once,
+    decoding every message once, and return a CellsIndex per site holding its 2x2 cells,
+    or None for a site outside of the grid.
+    Rows are flipped if needed so that row 0 is the bottom latitude, like a single-station grib.
+    '''
+    indexes = [CellsIndex() for site in sites]
+    cells = None
+    for message in grib_messages(grib_buffer):
+        mess = pygrib.fromstring(message)
+        if cells is None:
+            lats, lons = mess.latlons()
+            nrows, ncols = lats.shape
+            north_first = nrows > 1 and lats[1][0] < lats[0][0]
+            global_lons = round(ncols * LATLON_DELTA) == 360
+            cells = []
+            for site in sites:
+                leftlon, rightlon, bottomlat, toplat = box(site['lat'], site['lon'], LATLON_DELTA)
+                if north_first:
+                    row = round((lats[0][0] - toplat) / LATLON_DELTA)
+                    rows = [row + 1, row]
+                else:
+                    row = round((bottomlat - lats[0][0]) / LATLON_DELTA)
+                    rows = [row, row + 1]
+                col = round(((leftlon - lons[0][0]) % 360.) / LATLON_DELTA)
+                cols = [col, col + 1]
+                if global_lons:
+                    cols = [c % ncols for c in cols]  # 359.75 and 0 are neighbors
+                if min(rows) < 0 or max(rows) >= nrows or max(cols) >= ncols:
+                    cells.append(None)  # grib2_to_am_layers will complain about it
+                    continue
+                ix = np.ix_(rows, cols)
+                cells.append((ix, lats[ix], lons[ix]))
+
+        key = (mess['name'], mess['level'])
+        values = None
+        for index, cell in zip(indexes, cells):
+            if cell is None or key in index.fields:
+                continue  # like grbindx.select(...)[0], the first one wins
+            if values is None:
+                values = mess.values
+            ix, clats, clons = cell
+            index.fields[key] = GribCells(values[ix], clats, clons)
+    if cells is None:
+        raise ValueError('empty grib')
+    return [None if cell is None else index for index, cell in zip(indexes, cells)]
+
+
 # Numerical and physical constants
 BADVAL              = -99999.  # placeholder for missing or undefined data
 BADVAL_TEST         = -99998.
@@ -91,65 +223,126 @@ vector_gribs = [  # this table is not yet used
 ]
 
 
-def grib2_to_extra_information(grbindx, u, v):
+EXTRA_FIELDS = (
+    # our name, grib name, level
+    # appears for lev_surface at level 0
+    # if the grib comes back damaged, the crash is going to be at csnow
+    ('csnow', 'Categorical snow', 0),
+    ('cicep', 'Categorical ice pellets', 0),
+    ('cfrzr', 'Categorical freezing rain', 0),
+    ('crain', 'Categorical rain', 0),
+    ('wgust', 'Wind speed (gust)', 0),
+)
+EXTRA_VECTOR_FIELDS = (
+    # our name, u grib name, v grib name, level
+    ('max_wind', 'U component of wind', 'V component of wind', 0),  # appears for lev_max_wind at level 0
+    ('10m_wind', '10 metre U wind component', '10 metre V wind component', 10),  # appears for lev_10_m_above_ground
+)
+
+
+def grib2_to_extra_information(grbindx, u, v, row=0, col=0):
+    def cells(k, name, level):
+        grb = grbindx.get(name, level)
+        if grb is None:
+            print('key:', k, 'exception: no matches found', file=sys.stderr)
+            raise ValueError('no matches found: {} level {}'.format(name, level))
+        return grid_cells(grb, row, col)
+
+    scalars = np.array([cells(k, name, level) for k, name, level in EXTRA_FIELDS])
+    us = np.array([cells(k, uname, level) for k, uname, vname, level in EXTRA_VECTOR_FIELDS])
+    vs = np.array([cells(k, vname, level) for k, uname, vname, level in EXTRA_VECTOR_FIELDS])
+
+    keys = [f[0] for f in EXTRA_FIELDS] + [f[0] for f in EXTRA_VECTOR_FIELDS]
+    values = grid_interp_stack(scalars, u, v).tolist() + grid_interp_vector_stack(us, vs, u, v).tolist()
+    return dict(zip(keys, values))
+
+
+LAYER_FIELDS = (
+    # our name, grib name, value if missing at a level (None: the grib is bad)
+    ('z', 'Geopotential Height', None),
+    ('T', 'Temperature', None),
+    ('o3_vmr', 'Ozone mixing ratio', 0.0),
+    ('RH', 'Relative humidity', 0.0),
+    ('cloud_lmr', 'Cloud mixing ratio', 0.0),
+    ('cloud_imr', 'Ice water mixing ratio', 0.0),
+)
+LAYER_O3 = 2
+LAYER_RH = 3
+
+
+class AtmosphereProfile:
     '''
-pygrib clues
-grbindx.select only works on the named args named in the pygrib.index() call (name and level, here)
-didn't have much luck having more than 2 index names in the pygrib.index call -- could probably make multiple indices
-or you can use pygrib.open() instead, to not have an index, it's supposedly slower but these grib files are small (2k/station)
+    One station's profile for one forecast hour: layers is a (7, level) float64 array
+    of Pbase, z, T, o3_vmr, RH, cloud_lmr, cloud_imr, and extra is the dict of surface
+    and wind fields for the .extra file. Pickles small, and to_bytes() is smaller still.
     '''
-    ret = {}
+    __slots__ = ('layers', 'extra')
+    fields = ('Pbase', 'z', 'T', 'o3_vmr', 'RH', 'cloud_lmr', 'cloud_imr')
+    extra_keys = tuple(f[0] for f in EXTRA_FIELDS) + tuple(f[0] for f in EXTRA_VECTOR_FIELDS)
 
-    try:
-        # appears for lev_surface at level 0
-        # if the grib comes back damaged, the crash is going to be here
-        k = 'csnow'
-        ret['csnow'] = (grid_interp(grbindx.select(name='Categorical snow', level=0)[0].values, u, v))
-        k = 'cicep'
-        ret['cicep'] = (grid_interp(grbindx.select(name='Categorical ice pellets', level=0)[0].values, u, v))
-        k = 'cfrzr'
-        ret['cfrzr'] = (grid_interp(grbindx.select(name='Categorical freezing rain', level=0)[0].values, u, v))
-        k = 'crain'
-        ret['crain'] = (grid_interp(grbindx.select(name='Categorical rain', level=0)[0].values, u, v))
-
-        # appears for lev_surface at level 0
-        k = 'wgust'
-        ret['wgust'] = (grid_interp(grbindx.select(name='Wind speed (gust)', level=0)[0].values, u, v))
-
-        # appears for lev_max_wind at level 0
-        k = 'max wind u'
-        a = grbindx.select(name='U component of wind', level=0)[0].values
-        k = 'max wind v'
-        b = grbindx.select(name='V component of wind', level=0)[0].values
-        ret['max_wind'] = grid_interp_vector(a, b, u, v)
-
-        # appears for lev_10_m_above_ground
-        a = grbindx.select(name='10 metre U wind component', level=10)[0].values
-        b = grbindx.select(name='10 metre V wind component', level=10)[0].values
-        ret['10m_wind'] = grid_interp_vector(a, b, u, v)
-    except Exception as e:
-        print('key:', k, 'exception:', e, file=sys.stderr)
-        raise
-    return ret
+    def __init__(self, layers, extra):
+        self.layers = layers
+        self.extra = extra
+
+    def __getstate__(self):
+        return self.to_bytes()
+
+    def __setstate__(self, state):
+        other = self.from_bytes(state)
+        self.layers = other.layers
+        self.extra = other.extra
+
+    def to_bytes(self):
+        extra = [self.extra[k] for k in self.extra_keys]
+        return np.concatenate((self.layers.ravel(), extra)).astype('<f8').tobytes()
 
+    @classmethod
+    def from_bytes(cls, buf):
+        a = np.frombuffer(buf, dtype='<f8')
+        nextra = len(cls.extra_keys)
+        layers = a[:-nextra].reshape(len(cls.fields), -1)
+        extra = dict(zip(cls.extra_keys, a[-nextra:].tolist()))
+        return cls(layers, extra)
 
-def grib2_to_am_layers(gribname, lat, lon, alt):
-    grbindx = pygrib.index(gribname, "name", "level")  # on-disk
+    @property
+    def Pbase(self):
+        return self.layers[0]
 
-    # in memory -- not sure what syntax actually works for this?
-    # need to .index() after creation
-    # gribfile = pygrib.fromstring(grib_buffer)
-    # gribindx = ???
+    @property
+    def z(self):
+        return self.layers[1]
+
+    @property
+    def T(self):
+        return self.layers[2]
+
+    @property
+    def o3_vmr(self):
+        return self.layers[3]
+
+    @property
+    def RH(self):
+        return self.layers[4]
+
+    @property
+    def cloud_lmr(self):
+        return self.layers[5]
+
+    @property
+    def cloud_imr(self):
+        return self.layers[6]
+
+
+def grib2_to_am_layers(grib_buffer, lat, lon, alt, grbindx=None):
+    if grbindx is None:
+        grbindx = GribIndex(grib_buffer)
 
     # is the grib valid? Categorical snow is our known occasional crash
     try:
-        grbindx.select(name='Categorical snow', level=0)
+        probe = grbindx.select(name='Categorical snow', level=0)[0]
     except ValueError:
         print('invalid grib seen', file=sys.stderr)
-        names = set()
-        for mess in pygrib.open(gribname):
-            names.add(mess['name'])
-        print(' grib names are:', sorted(names))
+        print(' grib names are:', grbindx.names())
         raise
 
     leftlon, rightlon, bottomlat, toplat = box(lat, lon, LATLON_DELTA)
@@ -157,69 +350,45 @@ def grib2_to_am_layers(gribname, lat, lon, alt):
     # from a complete grib to the subset:
     # data, lats, lons = grb.data(lat1=20,lat2=70,lon1=220,lon2=320)
 
+    # a batched download is a union box for several stations; find our corner of it
+    # grib longitudes are 0..360 and ours might be negative
+    row = col = 0
+    lats, lons = probe.latlons()
+    if lats.shape != (2, 2):
+        row = round((bottomlat - lats[0][0]) / LATLON_DELTA)
+        col = round(((leftlon - lons[0][0]) % 360.) / LATLON_DELTA)
+        if row < 0 or col < 0 or row + 2 > lats.shape[0] or col + 2 > lats.shape[1]:
+            raise ValueError('lat {} lon {} is outside of the grib grid'.format(lat, lon))
+
     u = (lat - bottomlat) / LATLON_DELTA
     v = (lon - leftlon) / LATLON_DELTA
-    Pbase     = []
-    z         = []
-    T         = []
-    o3_vmr    = []
-    RH        = []
-    cloud_lmr = []
-    cloud_imr = []
-
-    extra = grib2_to_extra_information(grbindx, u, v)
-
-    for i, lev in enumerate(LEVELS):
-        Pbase.append(lev)
-        try:
-            x = (grid_interp(grbindx.select(
-                name="Geopotential Height", level=lev)[0].values, u, v))
-            z.append(x)
-        except:
-            print('point 1, level=', lev, file=sys.stderr)
-            raise  # XXX debug these bad gribs
-            z.append(BADVAL)
-        try:
-            x = (grid_interp(grbindx.select(
-                name="Temperature", level=lev)[0].values, u, v))
-            T.append(x)
-        except:
-            print('point 2', file=sys.stderr)
-            raise  # XXX debug these bad gribs
-            T.append(BADVAL)
-        try:
-            x = (grid_interp(grbindx.select(
-                name="Ozone mixing ratio", level=lev)[0].values, u, v))
-            x *= M_AIR / M_O3  # convert mass mixing ratio to volume mixing ratio
-            o3_vmr.append(x)
-        except:
-            # this is not unusual
-            o3_vmr.append(0.0)
-        try:
-            x = (grid_interp(grbindx.select(
-                name="Relative humidity", level=lev)[0].values, u, v))
-            # Greg: this used to have 'if (lev >= RH_TOP_PLEVEL)' in gfs15_to_am
-            # now it throws the exception
-            RH.append(x)
-        except:
-            RH.append(0.0)
-            print('point 4', file=sys.stderr)
-        try:
-            x = (grid_interp(grbindx.select(
-                name="Cloud mixing ratio", level=lev)[0].values, u, v))
-            cloud_lmr.append(x)
-        except:
-            # this is not unusual
-            cloud_lmr.append(0.0)
-        try:
-            x = (grid_interp(grbindx.select(
-                name="Ice water mixing ratio", level=lev)[0].values, u, v))
-            cloud_imr.append(x)
-        except:
-            # this is not unusual
-            cloud_imr.append(0.0)
 
-    return Pbase, z, T, o3_vmr, RH, cloud_lmr, cloud_imr, extra
+    extra = grib2_to_extra_information(grbindx, u, v, row=row, col=col)
+
+    # every field at every level, shape (field, level, 2, 2), interpolated all at once
+    cells = np.zeros((len(LAYER_FIELDS), len(LEVELS), 2, 2))
+    present = np.ones((len(LAYER_FIELDS), len(LEVELS)), dtype=bool)
+    for i, (ours, name, default) in enumerate(LAYER_FIELDS):
+        for j, lev in enumerate(LEVELS):
+            grb = grbindx.get(name, lev)
+            if grb is None:
+                if default is None:
+                    raise ValueError('no matches found: {} level {}'.format(name, lev))
+                present[i, j] = False
+                continue
+            cells[i, j] = grid_cells(grb, row, col)
+
+    profile = grid_interp_stack(cells, u, v)
+    profile[LAYER_O3] *= M_AIR / M_O3  # convert mass mixing ratio to volume mixing ratio
+    defaults = np.array([0.0 if default is None else default for ours, name, default in LAYER_FIELDS])
+    profile = np.where(present, profile, defaults[:, np.newaxis])
+
+    if not present[LAYER_RH].all():
+        # ozone and cloud mixing ratios are often missing, but RH is not
+        print('relative humidity missing at levels', [lev for lev, p in zip(LEVELS, present[LAYER_RH]) if not p],
+              file=sys.stderr)
+
+    return AtmosphereProfile(np.vstack((LEVELS, profile)), extra)
 
 
 def print_extra(gfs_cycle, forecast_hour, extra):
@@ -234,7 +403,7 @@ def print_extra(gfs_cycle, forecast_hour, extra):
     pass
 
 
-def print_am_header(gfs_cycle, forecast_hour, lat, lon, alt):
+def am_header_text(gfs_cycle, forecast_hour, lat, lon, alt):
     gfs_day = gfs_cycle.strftime(GFS_DAY)
     gfs_hour = gfs_cycle.hour
     gfs_product = 'f{:03d}'.format(forecast_hour)
@@ -242,137 +411,142 @@ def print_am_header(gfs_cycle, forecast_hour, lat, lon, alt):
         product_str = "analysis"
     else:
         product_str = gfs_product[1:] + " hour forecast"
-    print(LAYER_HEADER.format(gfs_day, gfs_hour, product_str, lat, lon, alt))
-
-
-def print_am_layers(alt, Pbase, z, T, o3_vmr, RH, cloud_lmr, cloud_imr):
-    for i, lev in enumerate(LEVELS):
-        if (z[i] < alt):
-            break
-        print("layer")
-        print("Pbase {0:.1f} mbar  # {1:.1f} m".format(Pbase[i], z[i]))
-        print("Tbase {0:.1f} K".format(T[i]))
-        print("column dry_air vmr")
-        if (i > 0):
-            o3_vmr_mid    = 0.5 * (   o3_vmr[i-1] +    o3_vmr[i])
-            RH_mid        = 0.5 * (       RH[i-1] +        RH[i])
-            cloud_lmr_mid = 0.5 * (cloud_lmr[i-1] + cloud_lmr[i])
-            cloud_imr_mid = 0.5 * (cloud_imr[i-1] + cloud_imr[i])
-            T_mid         = 0.5 * (        T[i-1] +         T[i])
-        else:
-            o3_vmr_mid    = o3_vmr[i]
-            RH_mid        = RH[i]
-            cloud_lmr_mid = cloud_lmr[i]
-            cloud_imr_mid = cloud_imr[i]
-            T_mid         = T[i]
-        if (o3_vmr_mid > 0.0):
-            print("column o3 vmr {0:.3e}".format(o3_vmr_mid))
-        if (Pbase[i] > RH_TOP_PLEVEL):
-            if (T_mid < H2O_SUPERCOOL_LIMIT):
-                print("column h2o RHi {0:.2f}%".format(RH_mid))
-            else:
-                print("column h2o RH {0:.2f}%".format(RH_mid))
-        else:
-            print("column h2o vmr {0:.3e}".format(STRAT_H2O_VMR))
-        if (cloud_lmr_mid > 0.0):
-            #
-            # Convert cloud liquid water mixing ratio [kg / kg] to
-            # cloud total liquid water across the layer [kg / m^2].
-            # Below the supercooling limit, assume any liquid water
-            # is really ice.  (GFS 15 occasionally had numerically
-            # negligible amounts of liquid water at unphysically
-            # low temperature.)
-            #
-            dP = PASCAL_ON_MBAR * (Pbase[0] if i == 0 else Pbase[i] - Pbase[i-1])
-            m = dP / G_STD
-            ctw = m * cloud_lmr_mid
-            if (T_mid < H2O_SUPERCOOL_LIMIT):
-                print("column iwp_abs_Rayleigh {0:.3e} kg*m^-2".format(ctw))
-            else:
-                print("column lwp_abs_Rayleigh {0:.3e} kg*m^-2".format(ctw))
-        if (cloud_imr_mid > 0.0):
-            #
-            # Convert cloud ice mixing ratio [kg / kg] to cloud total
-            # ice across the layer [kg / m^2].
-            #
-            dP = PASCAL_ON_MBAR * (Pbase[0] if i == 0 else Pbase[i] - Pbase[i-1])
-            m = dP / G_STD
-            cti = m * cloud_imr_mid
-            print("column iwp_abs_Rayleigh {0:.3e} kg*m^-2".format(cti))
-        print("")
-
-    if (z[i] == alt):
-        return
+    return LAYER_HEADER.format(gfs_day, gfs_hour, product_str, lat, lon, alt) + '\n'
+
 
+def surface_layer(alt, profile, i):
+    '''
+    The bottom layer, from level i-1 down to the station altitude, as a row like the others:
+    Pbase, Tbase, and the values of o3_vmr, RH, cloud_lmr, cloud_imr at its base.
+    '''
+    Pbase, z, T, o3_vmr, RH, cloud_lmr, cloud_imr = profile.layers
     u      = (alt - z[i-1]) / (z[i] - z[i-1])
     logP_s = u * math.log(Pbase[i]) + (1.0 - u) * math.log(Pbase[i-1])
     P_s    = math.exp(logP_s)
     T_s    = u * T[i] + (1.0 - u) * T[i-1]
-    T_mid  = 0.5 * (T_s + T[i-1])
 
     #
     # Other variables are interpolated or extrapolated linearly in P
     # to the base level and clamped at zero.
     #
     u = (P_s - Pbase[i-1]) / (Pbase[i] - Pbase[i-1])
-    o3_vmr_s    = u *    o3_vmr[i] + (1.0 - u) *    o3_vmr[i-1]
-    RH_s        = u *        RH[i] + (1.0 - u) *        RH[i-1]
-    cloud_lmr_s = u * cloud_lmr[i] + (1.0 - u) * cloud_lmr[i-1]
-    cloud_imr_s = u * cloud_imr[i] + (1.0 - u) * cloud_imr[i-1]
-    if (o3_vmr_s < 0.0):
-        o3_vmr_s = 0.0
-    if (RH_s < 0.0):
-        RH_s = 0.0
-    if (cloud_lmr_s < 0.0):
-        cloud_lmr_s = 0.0
-    if (cloud_imr_s < 0.0):
-        cloud_imr_s = 0.0
-    o3_vmr_mid    = 0.5 * (   o3_vmr[i-1] +    o3_vmr_s)
-    RH_mid        = 0.5 * (       RH[i-1] +        RH_s)
-    cloud_lmr_mid = 0.5 * (cloud_lmr[i-1] + cloud_lmr_s)
-    cloud_imr_mid = 0.5 * (cloud_imr[i-1] + cloud_imr_s)
-    print("layer")
-    print("Pbase {0:.1f} mbar  # {1:.1f} m".format(P_s, alt))
-    print("Tbase {0:.1f} K".format(T_s))
-    print("column dry_air vmr")
-    if (o3_vmr_mid > 0.0):
-        print("column o3 vmr {0:.3e}".format(o3_vmr_mid))
-    if (P_s > RH_TOP_PLEVEL):
-        if (T_mid < H2O_SUPERCOOL_LIMIT):
-            print("column h2o RHi {0:.2f}%".format(RH_mid))
-        else:
-            print("column h2o RH {0:.2f}%".format(RH_mid))
+    others = [u * x[i] + (1.0 - u) * x[i-1] for x in (o3_vmr, RH, cloud_lmr, cloud_imr)]
+    return [P_s, T_s] + [max(x, 0.0) for x in others]
+
+
+def am_layers_text(alt, profile):
+    '''
+    The am layers for profile, down to the station altitude alt. Every layer quantity is
+    computed with array operations, and the text is written in one pass.
+    '''
+    Pbase, z, T, o3_vmr, RH, cloud_lmr, cloud_imr = profile.layers
+    below = np.flatnonzero(z < alt)
+    if len(below):
+        n = below[0]  # levels 0..n-1 are above the station, full layers
+        i = n  # level i is below, the bottom layer is cut off at alt
     else:
-        print("column h2o vmr {0:.3e}".format(STRAT_H2O_VMR))
-    if (cloud_lmr_mid > 0.0):
-        dP = PASCAL_ON_MBAR * (Pbase[0] if i == 0 else Pbase[i] - Pbase[i-1])
-        m = dP / G_STD
-        ctw = m * cloud_lmr_mid
-        if (T_mid < H2O_SUPERCOOL_LIMIT):
-            print("column iwp_abs_Rayleigh {0:.3e} kg*m^-2".format(ctw))
+        # all of the levels are above the station; extrapolate from the last two
+        n = len(z)
+        i = n - 1
+
+    # each layer's base values, and the values above it
+    base = np.array([Pbase, T, o3_vmr, RH, cloud_lmr, cloud_imr])[:, :n]
+    above = base[:, np.maximum(np.arange(n) - 1, 0)]
+    base_P = base[0]
+    base_z = z[:n]
+    dP = PASCAL_ON_MBAR * np.concatenate((Pbase[:1], Pbase[1:n] - Pbase[:n-1]))[:n]
+    full = n
+    if z[i] != alt:
+        surface = np.array(surface_layer(alt, profile, i))
+        base = np.column_stack((base, surface))
+        above = np.column_stack((above, np.array([Pbase, T, o3_vmr, RH, cloud_lmr, cloud_imr])[:, i-1]))
+        base_P = base[0]
+        base_z = np.append(base_z, alt)
+        dP = np.append(dP, PASCAL_ON_MBAR * (Pbase[0] if i == 0 else Pbase[i] - Pbase[i-1]))
+
+    # mid-layer averages; the top layer uses its base values
+    mid = 0.5 * (above + base)
+    mid[:, 0] = base[:, 0]
+    mid_T, mid_o3, mid_RH, mid_lmr, mid_imr = mid[1:]
+    m = dP / G_STD
+    ctw = m * mid_lmr  # cloud total liquid water across the layer [kg / m^2]
+    cti = m * mid_imr  # cloud total ice across the layer [kg / m^2]
+    supercool = mid_T < H2O_SUPERCOOL_LIMIT
+    rh_valid = base_P > RH_TOP_PLEVEL
+
+    out = []
+    for j in range(base.shape[1]):
+        out.append("layer\n")
+        out.append("Pbase {0:.1f} mbar  # {1:.1f} m\n".format(base_P[j], base_z[j]))
+        out.append("Tbase {0:.1f} K\n".format(base[1][j]))
+        out.append("column dry_air vmr\n")
+        if (mid_o3[j] > 0.0):
+            out.append("column o3 vmr {0:.3e}\n".format(mid_o3[j]))
+        if rh_valid[j]:
+            if supercool[j]:
+                out.append("column h2o RHi {0:.2f}%\n".format(mid_RH[j]))
+            else:
+                out.append("column h2o RH {0:.2f}%\n".format(mid_RH[j]))
         else:
-            print("column lwp_abs_Rayleigh {0:.3e} kg*m^-2".format(ctw))
-    if (cloud_imr_mid > 0.0):
-        dP = PASCAL_ON_MBAR * (Pbase[0] if i == 0 else Pbase[i] - Pbase[i-1])
-        m = dP / G_STD
-        cti = m * cloud_imr_mid
-        print("column iwp_abs_Rayleigh {0:.3e} kg*m^-2".format(cti))
+            out.append("column h2o vmr {0:.3e}\n".format(STRAT_H2O_VMR))
+        if (mid_lmr[j] > 0.0):
+            # Below the supercooling limit, assume any liquid water is really ice.
+            # (GFS 15 occasionally had numerically negligible amounts of liquid water
+            # at unphysically low temperature.)
+            if supercool[j]:
+                out.append("column iwp_abs_Rayleigh {0:.3e} kg*m^-2\n".format(ctw[j]))
+            else:
+                out.append("column lwp_abs_Rayleigh {0:.3e} kg*m^-2\n".format(ctw[j]))
+        if (mid_imr[j] > 0.0):
+            out.append("column iwp_abs_Rayleigh {0:.3e} kg*m^-2\n".format(cti[j]))
+        if j < full:
+            out.append("\n")
+    return ''.join(out)
+
+
+am_cache = None  # a cache.AmCache, set by the cli
+am_versions = {}
+
+
+def am_version():
+    # part of the am cache key, so that a different am binary does not see old results
+    am = os.environ['AM']
+    if am not in am_versions:
+        completed = subprocess.run((am, '-v'), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        am_versions[am] = completed.stdout.decode() + completed.stderr.decode()
+    return am_versions[am]
+
+
+def run_am_cached(layers_amc):
+    # same as run_am, but skips running am if we have seen this exact input before
+    if am_cache is None:
+        return run_am(layers_amc)
+    key = am_cache.key(frequency_header() + layers_amc, am_version())
+    result = am_cache.get_result(key)
+    if result is not None:
+        return result
+    returncode, stdout, stderr = run_am(layers_amc)
+    if returncode in (0, 1):
+        am_cache.put_result(key, returncode, stdout, stderr)
+    return returncode, stdout, stderr
 
 
 def run_am(layers_amc):
-    stdin = header_amc.encode() + layers_amc.encode()
+    stdin = frequency_header().encode() + layers_amc.encode()
 
     args = (os.environ['AM'], '-')
 
     completed = subprocess.run(args, input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     returncode = completed.returncode
-    stdout = completed.stdout.decode()  # one line with the integrated opacity
+    stdout = completed.stdout.decode()  # one line per frequency with the integrated opacity
     stderr = completed.stderr.decode()  # verbose stuff
 
     return returncode, stdout, stderr
 
 
-def summarize_am(am_output, am_error):
+def summarize_am(am_output, am_error, freqs=None):
+    # returns tau, Tb, pwv, lwp, iwp, o3 for the first band, then tau, Tb for each of the other bands
+    freqs = freqs or frequencies
     lwp = 0.
     iwp = 0.
     for line in am_error.splitlines():
@@ -386,12 +560,18 @@ def summarize_am(am_output, am_error):
             if 'o3' in line:
                 o3 = float(line.split()[2])
 
-    parts = am_output.split()
-    tau = float(parts[1])
-    Tb = float(parts[2])
+    bands = {}
+    for line in am_output.splitlines():
+        parts = line.split()
+        if parts:
+            bands[round(float(parts[0]), 3)] = (float(parts[1]), float(parts[2]))
+    tau, Tb = bands[freqs[0]]
 
     MM_PWV   = 3.3427e21
     KG_ON_M2 = 3.3427e21
     DU       = 2.6868e16
 
-    return tau, Tb, pwv / MM_PWV, lwp / KG_ON_M2, iwp / KG_ON_M2, o3 / DU
+    row = (tau, Tb, pwv / MM_PWV, lwp / KG_ON_M2, iwp / KG_ON_M2, o3 / DU)
+    for freq in freqs[1:]:
+        row += bands[freq]
+    return row
@@ -0,0 +1,53 @@
+import datetime
+import os
+import sys
+
+from .constants import GFS_TIMESTAMP
+from .core import ok
+
+NOMADS_RETENTION_HOURS = 240  # how long NOMADS keeps a cycle, when --probe doesn't tell us
+RETENTION_MARGIN_HOURS = 6  # a cycle this close to expiring is likely gone before we get to it
+
+
+def utc(gfs_cycle):
+    # --cycle makes naive datetimes
+    if gfs_cycle.tzinfo is None:
+        return gfs_cycle.replace(tzinfo=datetime.timezone.utc)
+    return gfs_cycle
+
+
+def oldest_fetchable(prober=None, now=None):
+    # the oldest cycle worth asking NOMADS for
+    oldest = prober.oldest_cycle() if prober else None
+    if oldest is None:
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        oldest = now - datetime.timedelta(hours=NOMADS_RETENTION_HOURS)
+    return oldest + datetime.timedelta(hours=RETENTION_MARGIN_HOURS)
+
+
+def split_expired(cycles, oldest):
+    # (cycles to fetch, cycles NOMADS no longer has)
+    return [c for c in cycles if utc(c) >= oldest], [c for c in cycles if utc(c) < oldest]
+
+
+def skip_expired(outdir, vexes, expired, dry_run=False, verbose=False):
+    '''
+    Write a .skip marker for every unfinished table of the expired cycles, so that
+    later runs don't try them either. Returns the number of tables skipped.
+    '''
+    count = 0
+    for gfs_cycle in expired:
+        gcf = gfs_cycle.strftime(GFS_TIMESTAMP)
+        for vex in vexes:
+            outfile = '{}/{}/{}'.format(outdir, vex, gcf)
+            if ok(outfile):
+                continue
+            count += 1
+            if verbose or dry_run:
+                print('  expired from NOMADS, skipping', outfile, file=sys.stderr)
+            if dry_run:
+                continue
+            os.makedirs(os.path.dirname(outfile), exist_ok=True)
+            with open(outfile + '.skip', 'w') as f:
+                f.write('expired from NOMADS before it was fetched\n')
+    return count
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+GRIB_CACHE_MB = 1000
+GRIB_CACHE_HOURS = 168  # same as our usual backfill
+AM_CACHE_MB = 200
+AM_CACHE_HOURS = 168
+
+
+class DiskCache:
+    '''
+    On-disk cache of blobs, one file per key.
+
+    Entries older than max_age seconds are dropped. When the cache is bigger than
+    max_bytes, the least recently used entries are evicted. File mtime is the
+    write time and atime is the last use, set explicitly because many filesystems
+    are mounted noatime.
+    '''
+    suffix = '.bin'
+
+    def __init__(self, directory, max_bytes, max_age):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = 0
+        self.lock = threading.Lock()  # for total_bytes, am results are put from several threads
+        self.evict_lock = threading.Lock()  # one eviction walk at a time
+        self.evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + self.suffix)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+        now = time.time()
+        if now - st.st_mtime > self.max_age:
+            self.remove(path, st.st_size)
+            return
+        try:
+            with open(path, 'rb') as f:
+                blob = f.read()
+            os.utime(path, (now, st.st_mtime))
+        except FileNotFoundError:
+            # evicted by another process since the stat
+            return
+        return blob
+
+    def put(self, key, blob):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so that a concurrent reader never sees a partial grib
+        with tempfile.NamedTemporaryFile(mode='wb', dir=os.path.dirname(path), delete=False) as f:
+            f.write(blob)
+        os.replace(f.name, path)
+        with self.lock:
+            self.total_bytes += len(blob)
+            full = self.total_bytes > self.max_bytes
+        if full:
+            self.evict()
+
+    def remove(self, path, size):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            self.total_bytes -= size
+
+    def evict(self):
+        with self.evict_lock:  # put() from several am threads
+            now = time.time()
+            entries = []
+            for dirpath, dirnames, filenames in os.walk(self.directory):
+                for fname in filenames:
+                    path = os.path.join(dirpath, fname)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    if now - st.st_mtime > self.max_age:
+                        try:
+                            os.unlink(path)
+                        except FileNotFoundError:
+                            pass  # another process sharing the directory got there first
+                        continue
+                    entries.append((st.st_atime, st.st_size, path))
+
+            with self.lock:
+                self.total_bytes = sum(e[1] for e in entries)
+            if self.total_bytes <= self.max_bytes:
+                return
+
+            # evict down to 90%, so we are not doing this on every put
+            target = self.max_bytes * 0.9
+            for atime, size, path in sorted(entries):
+                if self.total_bytes <= target:
+                    break
+                self.remove(path, size)
+            print(type(self).__name__, 'evicted down to', self.total_bytes, 'bytes', file=sys.stderr)
+
+
+class GribCache(DiskCache):
+    '''
+    Downloaded gribs, keyed by a hash of the download url and params,
+    which covers the cycle, forecast hour, bounding box, and variable/level set.
+    '''
+    suffix = '.grb'
+
+    def __init__(self, directory, max_bytes=GRIB_CACHE_MB * 1024 * 1024, max_age=GRIB_CACHE_HOURS * 3600):
+        super().__init__(directory, max_bytes, max_age)
+
+    @staticmethod
+    def key(url, params):
+        blob = json.dumps([url, sorted(params.items())])
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+
+class AmCache(DiskCache):
+    '''
+    am results, keyed by a hash of the complete am input and the am version. Only what
+    core.am_one_row needs is kept: the returncode, stdout, and the '#' summary lines of stderr.
+    '''
+    suffix = '.json'
+
+    def __init__(self, directory, max_bytes=AM_CACHE_MB * 1024 * 1024, max_age=AM_CACHE_HOURS * 3600):
+        super().__init__(directory, max_bytes, max_age)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(am_input, am_version):
+        return hashlib.sha256(am_version.encode() + b'\0' + am_input.encode()).hexdigest()
+
+    def get_result(self, key):
+        blob = self.get(key)
+        if blob is None:
+            self.misses += 1
+            return
+        self.hits += 1
+        result = json.loads(blob)
+        return result['returncode'], result['stdout'], result['stderr']
+
+    def put_result(self, key, returncode, stdout, stderr):
+        summary = ''.join(line + '\n' for line in stderr.splitlines() if line.startswith('#'))
+        self.put(key, json.dumps({'returncode': returncode, 'stdout': stdout, 'stderr': summary}).encode())
+
+    def report(self, stats):
+        stats['am_cache_hit'] = self.hits
+        stats['am_cache_miss'] = self.misses
@@ -4,15 +4,27 @@ import datetime
 import os
 from argparse import ArgumentParser
 from collections import defaultdict
-import csv
+from concurrent.futures import ThreadPoolExecutor
 
-from .constants import GFS_TIMESTAMP, GFS_TIMESTAMP_FULL
+from .constants import GFS_TIMESTAMP, GFS_TIMESTAMP_FULL, LATLON_DELTA, GROUP_MAX_SPAN
 from .timer_utils import dump_latency_histograms
-from .gfs import latest_gfs_cycle_time, jiggle
-from .core import read_stations, ok, make_forecast_table, dump_stats
+from .gfs import latest_gfs_cycle_time, jiggle, get_session, session_stats, POOL_SIZE, NOMADS_PROD_URL
+from . import gfs
+from . import core
+from . import am
+from . import surrogate
+from . import deadline
+from . import backfill
+from .cache import GribCache, GRIB_CACHE_MB, GRIB_CACHE_HOURS, AmCache, AM_CACHE_MB
+from .ratelimit import AIMDRate, FileQuota
+from .probe import AvailabilityProber
+from .core import read_stations, ok, make_forecast_table, make_forecast_table_group, dump_stats
+from .core import open_outputs, close_outputs, forecast_hours, progressive_order, resume_outputs, finish_outputs
+from .latlon import group_stations
+from .engine import Table, run_engine, DEFAULT_CONCURRENCY, DEFAULT_RATE
 
 
-def interpret_args(args, station_dict):
+def interpret_args(args, station_dict, prober=None):
     print_vexes = False
     if not args.vex:
         stations = station_dict.keys()
@@ -52,10 +64,15 @@ def interpret_args(args, station_dict):
             c += '00'
         gfs_starting_cycle = datetime.datetime.strptime(c, '%Y%m%d%H')
     else:
-        lag = None
-        if not args.wait:
-            lag = 5.2  # hours
-        gfs_starting_cycle = latest_gfs_cycle_time(lag=lag)
+        gfs_starting_cycle = None
+        if prober and not args.wait:
+            # the newest cycle that is completely published
+            gfs_starting_cycle = prober.latest_cycle()
+        if gfs_starting_cycle is None:
+            lag = None
+            if not args.wait:
+                lag = 5.2  # hours
+            gfs_starting_cycle = latest_gfs_cycle_time(lag=lag)
 
     end_hours = 1
     if args.backfill:
@@ -68,6 +85,204 @@ def interpret_args(args, station_dict):
     return stations, flushers, cycles
 
 
+def todo_outfile(vex, gfs_cycle, args, verbose=False):
+    # returns the outfile if this station and cycle needs work, else None
+    gcf = gfs_cycle.strftime(GFS_TIMESTAMP)
+    if verbose:
+        print('checking station', vex, 'cycle', gcf, file=sys.stderr)
+    outdir = '{}/{}'.format(args.dir, vex)
+    outfile = '{}/{}'.format(outdir, gcf)
+    if ok(outfile, verbose=verbose):
+        if verbose:
+            print('  outfile {} seems ok, not re-fetching'.format(outfile), file=sys.stderr)
+        return
+    print('downloading station', vex, 'cycle', gcf, file=sys.stderr)
+    if verbose or args.dry_run:
+        print('  processing', vex, outfile, file=sys.stderr)
+        if args.dry_run:
+            return
+    os.makedirs(outdir, exist_ok=True)
+    return outfile
+
+
+def plan_deadline(args, units, stats):
+    # {name: forecast hours} for the units of work that fit before --deadline, None without one
+    if not args.deadline:
+        return
+    seconds_left = (args.deadline - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    budget = int(max(0, seconds_left) * deadline.DEADLINE_MARGIN / deadline.seconds_per_request(args))
+    print('deadline: {} in {:.0f} minutes, room for {} downloads'.format(
+        args.deadline.strftime('%H:%M'), seconds_left / 60, budget), file=sys.stderr)
+    planned, skipped = deadline.plan(units, budget, hours=args.hours)
+    deadline.report(planned, skipped, hours=args.hours, stats=stats)
+    return dict((name, hours) for name, (level, hours) in planned.items())
+
+
+def plan_backfill(args, station_dict, stations, flushers, cycles, stats):
+    # before downloading anything: skip the backfill cycles NOMADS won't have, and estimate the rest
+    if len(cycles) < 2:
+        return cycles
+    # the first cycle is the latest or the --cycle asked for. Caches and mirrors keep what they like
+    expired = []
+    if not args.grib_cache and gfs.byterange_url in (None, NOMADS_PROD_URL):
+        oldest = backfill.oldest_fetchable(prober=gfs.prober)
+        fetchable, expired = backfill.split_expired(cycles[1:], oldest)
+        cycles = cycles[:1] + fetchable
+    if expired:
+        tables = backfill.skip_expired(args.dir, stations, expired, dry_run=args.dry_run, verbose=args.verbose)
+        print('backfill: fetching cycles from {}, skipping {} that NOMADS no longer has, {} tables'.format(
+            oldest.strftime(GFS_TIMESTAMP), len(expired), tables), file=sys.stderr)
+        stats['backfill_expired_cycles'] = len(expired)
+        stats['backfill_expired_tables'] = tables
+
+    units = 0
+    for gfs_cycle in cycles:
+        gcf = gfs_cycle.strftime(GFS_TIMESTAMP)
+        vexes = [vex for vex in stations if not ok('{}/{}/{}'.format(args.dir, vex, gcf))]
+        if args.batch:
+            units += len(batch_groups([dict(station_dict[vex], vex=vex) for vex in vexes], flushers))
+        else:
+            units += len(vexes)
+    requests = units * len(forecast_hours(args.hours))
+    seconds = requests * deadline.seconds_per_request(args)
+    print('backfill: {} cycles, at most {} requests, about {:.0f} minutes'.format(len(cycles), requests, seconds / 60),
+          file=sys.stderr)
+    stats['planned_requests'] = requests
+    stats['planned_minutes'] = int(seconds / 60)
+    return cycles
+
+
+def run_per_station(args, station_dict, stations, flushers, cycles, stats, verbose=False):
+    # the latest cycle for every station before any backfill, flushed stations first
+    exit_value = None
+    for gfs_cycle in cycles:
+        todo = []
+        for vex in sorted(stations, key=lambda vex: vex not in flushers):
+            outfile = todo_outfile(vex, gfs_cycle, args, verbose=verbose)
+            if outfile:
+                todo.append((vex, outfile))
+        planned = plan_deadline(args, [(vex, vex in flushers) for vex, outfile in todo], stats)
+
+        for vex, outfile in todo:
+            if planned is not None and vex not in planned:
+                continue
+            station = station_dict[vex]
+            flush = True if vex in flushers else False
+
+            resumed = resume_outputs(outfile, gfs_cycle, stdout=args.stdout, stats=stats)
+            f = f2 = fd2 = None
+            if not args.progressive:
+                # with --progressive, the RowWriter rewrites outfile, and the old one stays until then
+                f, f2, fd2 = open_outputs(outfile, stdout=args.stdout)
+
+            try:
+                make_forecast_table(station, gfs_cycle, f, f2, wait=args.wait, verbose=args.verbose, hours=args.hours,
+                                    stats=stats, flush=flush, resumed=resumed, hour_list=planned and planned[vex],
+                                    rewrite=args.progressive and outfile)
+            except TimeoutError:
+                # raised by gfs.py
+                print('Gave up on {} {}'.format(station, gfs_cycle), file=sys.stderr)
+                sys.stderr.flush()
+                exit_value = 1
+            else:
+                finish_outputs(outfile, stdout=args.stdout)
+            if f is not None:
+                close_outputs(f, fd2, stdout=args.stdout)
+    return exit_value
+
+
+def batch_groups(sites, flushers):
+    # nearby stations, as (bbox, sites, name), groups with a flushed station first
+    # a byte-range download is global, so everyone can share it
+    max_span = 361. if gfs.byterange_url else GROUP_MAX_SPAN
+    groups = group_stations(sites, LATLON_DELTA, max_span)
+    groups.sort(key=lambda g: not any(site['vex'] in flushers for site in g[1]))
+    return [(bbox, group, ','.join(site['vex'] for site in group)) for bbox, group in groups]
+
+
+def run_batched(args, station_dict, stations, flushers, cycles, stats, verbose=False):
+    # each forecast hour is downloaded once per group of nearby stations
+    exit_value = None
+    for gfs_cycle in cycles:
+        vexes = [vex for vex in stations if todo_outfile(vex, gfs_cycle, args, verbose=verbose)]
+        sites = [dict(station_dict[vex], vex=vex) for vex in vexes]
+        groups = batch_groups(sites, flushers)
+        planned = plan_deadline(args, [(name, any(site['vex'] in flushers for site in group))
+                                       for bbox, group, name in groups], stats)
+        for bbox, group, name in groups:
+            if planned is not None and name not in planned:
+                continue
+            group_vexes = [site['vex'] for site in group]
+            if verbose:
+                print('group', name, 'box', bbox, file=sys.stderr)
+            gcf = gfs_cycle.strftime(GFS_TIMESTAMP)
+            outfiles = ['{}/{}/{}'.format(args.dir, vex, gcf) for vex in group_vexes]
+            resumeds = [resume_outputs(outfile, gfs_cycle, stdout=args.stdout, stats=stats) for outfile in outfiles]
+            if args.progressive:
+                outputs = [(None, None, None)] * len(outfiles)  # see run_per_station
+            else:
+                outputs = [open_outputs(outfile, stdout=args.stdout) for outfile in outfiles]
+            fs = [o[0] for o in outputs]
+            f2s = [o[1] for o in outputs]
+            flushes = [vex in flushers for vex in group_vexes]
+            try:
+                make_forecast_table_group(group, bbox, gfs_cycle, fs, f2s, wait=args.wait, verbose=args.verbose,
+                                          hours=args.hours, stats=stats, flushes=flushes, resumeds=resumeds,
+                                          hour_list=planned and planned[name],
+                                          rewrites=args.progressive and outfiles)
+            except TimeoutError:
+                # raised by gfs.py
+                print('Gave up on {} {}'.format(name, gfs_cycle), file=sys.stderr)
+                sys.stderr.flush()
+                exit_value = 1
+            else:
+                for outfile in outfiles:
+                    finish_outputs(outfile, stdout=args.stdout)
+            for f, f2, fd2 in outputs:
+                if f is not None:
+                    close_outputs(f, fd2, stdout=args.stdout)
+    return exit_value
+
+
+def run_async(args, station_dict, stations, flushers, cycles, stats, verbose=False):
+    # with --batch, nearby stations share one download per forecast hour
+    groups = []
+    for gfs_cycle in cycles:
+        sites = []
+        outfiles = {}
+        for vex in stations:
+            outfile = todo_outfile(vex, gfs_cycle, args, verbose=verbose)
+            if outfile:
+                sites.append(dict(station_dict[vex], vex=vex))
+                outfiles[vex] = outfile
+        if args.batch:
+            cycle_groups = batch_groups(sites, flushers)
+            for bbox, group, name in cycle_groups:
+                if verbose:
+                    print('group', name, 'box', bbox, file=sys.stderr)
+        else:
+            cycle_groups = [(None, [site], site['vex']) for site in sites]
+        planned = plan_deadline(args, [(name, any(site['vex'] in flushers for site in group))
+                                       for bbox, group, name in cycle_groups], stats)
+
+        for bbox, group, name in cycle_groups:
+            if planned is not None and name not in planned:
+                continue
+            hours = planned[name] if planned else forecast_hours(args.hours)
+            if args.progressive:
+                hours = progressive_order(hours)
+            tables = []
+            for site in group:
+                vex = site['vex']
+                resumed = resume_outputs(outfiles[vex], gfs_cycle, stdout=args.stdout, stats=stats)
+                tables.append(Table(vex, site, gfs_cycle, outfiles[vex], hours,
+                                    stdout=args.stdout, flush=vex in flushers, resumed=resumed,
+                                    progressive=args.progressive))
+            groups.append((bbox, tables))
+    return run_engine(groups, concurrency=args.concurrency, rate=args.rate,
+                      wait=args.wait, verbose=args.verbose, stats=stats)
+
+
 def main(args=None):
     parser = ArgumentParser(description='eht-met-forecast command line tool')
     parser.add_argument('--vex', action='append', help='station(s) to fetch')
@@ -82,83 +297,162 @@ def main(args=None):
     parser.add_argument('--stdout', action='store_true', help='Print output to stdout instead of a file')
     parser.add_argument('--log', action='store', help='File to write logging information to')
     parser.add_argument('--flush', action='append', help='station(s) to flush output for, used for monitoring')
+    parser.add_argument('--batch', action='store_true', help='Download once per group of nearby stations')
+    parser.add_argument('--async', action='store_true', dest='async_engine',
+                        help='Fetch all stations and cycles concurrently in this process. '
+                             'With --batch, nearby stations share downloads')
+    parser.add_argument('--concurrency', action='store', default=DEFAULT_CONCURRENCY, type=int,
+                        help='NOMADS requests in flight with --async (default: {})'.format(DEFAULT_CONCURRENCY))
+    parser.add_argument('--rate', action='store', default=DEFAULT_RATE, type=float,
+                        help='NOMADS requests per second with --async (default: {})'.format(DEFAULT_RATE))
+    parser.add_argument('--am-workers', action='store', default=os.cpu_count(), type=int,
+                        help='am processes to run at once, 0 to run am in line (default: cpu count, {})'.format(
+                            os.cpu_count()))
+    parser.add_argument('--probe', action='store_true',
+                        help='Use NOMADS directory listings to find the latest cycle and, with --wait, published hours')
+    parser.add_argument('--quota-per-minute', action='store', type=float,
+                        help='NOMADS requests per minute shared by every eht-met-forecast using this --dir')
+    parser.add_argument('--aimd', action='store_true',
+                        help='Adapt the request rate to NOMADS throttling, starting at --rate')
+    parser.add_argument('--pool-size', action='store', type=int,
+                        help='keep-alive connections per host (default: {}, or --concurrency if bigger)'.format(
+                            POOL_SIZE))
+    parser.add_argument('--grib-cache', action='store',
+                        help='directory to cache downloaded gribs in (default: no cache)')
+    parser.add_argument('--grib-cache-mb', action='store', default=GRIB_CACHE_MB, type=int,
+                        help='grib cache size limit in megabytes (default: {})'.format(GRIB_CACHE_MB))
+    parser.add_argument('--grib-cache-hours', action='store', default=GRIB_CACHE_HOURS, type=float,
+                        help='grib cache maximum age in hours (default: {})'.format(GRIB_CACHE_HOURS))
+    parser.add_argument('--byterange-url', action='store', nargs='?', const=NOMADS_PROD_URL,
+                        help='Fetch our messages out of the full pgrb2 files at this url (default: {}), '
+                             'once for all stations. Implies --batch'.format(NOMADS_PROD_URL))
+    parser.add_argument('--am-cache', action='store',
+                        help='directory to cache am results in (default: no cache)')
+    parser.add_argument('--am-cache-mb', action='store', default=AM_CACHE_MB, type=int,
+                        help='am cache size limit in megabytes (default: {})'.format(AM_CACHE_MB))
+    parser.add_argument('--freq', action='append', type=int, default=[],
+                        help='also compute tau and Tb at this frequency in GHz, e.g. 345. Adds two table columns')
+    parser.add_argument('--surrogate', action='store', type=int, metavar='HOUR',
+                        help='quick look: estimate tau and Tb without am for forecast hours >= HOUR '
+                             '(0 for the whole table), for stations in --surrogate-table')
+    parser.add_argument('--surrogate-table', action='store',
+                        help='fitted surrogate coefficients, the output of scripts/fit-surrogate.py')
+    parser.add_argument('--deadline', action='store', metavar='HH:MM',
+                        help='UTC time the latest cycle has to be done by. Fetches fewer hours and stations '
+                             'if needed, flushed stations and the next 48 hours first, and skips backfill')
+    parser.add_argument('--progressive', action='store_true',
+                        help='Fetch every 12 hours over the whole forecast first, then every 3 hours, then hourly, '
+                             'rewriting the table in order as it fills in')
     parser.add_argument('--verbose', '-v', action='store_true', help='Print more information')
     args = parser.parse_args(args=args)
 
     exit_value = None
 
+    if args.progressive and args.stdout:
+        print('--progressive rewrites the output file, it cannot be used with --stdout', file=sys.stderr)
+        exit(1)
+    if args.surrogate is not None and not args.surrogate_table:
+        print('--surrogate needs a --surrogate-table, from scripts/fit-surrogate.py', file=sys.stderr)
+        exit(1)
+
     verbose = args.verbose
     if args.dry_run:
         verbose = True
 
+    # the flags below set these, don't inherit them from an earlier main() in this process
+    gfs.rate_controller = gfs.request_quota = gfs.grib_cache = gfs.prober = gfs.byterange_url = None
+    am.am_cache = None
+    core.am_pool = None
+    surrogate.table = surrogate.from_hour = None
+
+    if args.byterange_url:
+        args.batch = True
+        gfs.byterange_url = args.byterange_url.rstrip('/')
+
     station_dict = read_stations(args.stations)
 
-    stations, flushers, cycles = interpret_args(args, station_dict)
+    stats = defaultdict(int)
+
+    pool_size = args.pool_size
+    if pool_size is None:
+        pool_size = max(POOL_SIZE, args.concurrency) if args.async_engine else POOL_SIZE
+    get_session(pool_size=pool_size)
+
+    if args.quota_per_minute:
+        gfs.request_quota = FileQuota(os.path.join(args.dir, '.nomads-quota'), args.quota_per_minute)
+
+    if args.aimd:
+        gfs.rate_controller = AIMDRate(args.rate)
+
+    if args.grib_cache:
+        gfs.grib_cache = GribCache(args.grib_cache, max_bytes=args.grib_cache_mb * 1024 * 1024,
+                                   max_age=args.grib_cache_hours * 3600)
+
+    am.frequencies = [225] + [freq for freq in dict.fromkeys(args.freq) if freq != 225]
+
+    if args.surrogate is not None:
+        try:
+            surrogate.table = surrogate.load_table(args.surrogate_table)
+        except (OSError, ValueError) as e:
+            print('cannot read --surrogate-table:', e, file=sys.stderr)
+            exit(1)
+        surrogate.from_hour = args.surrogate
+        if len(am.frequencies) > 1:
+            print('--surrogate only estimates 225 GHz, running am for --freq', file=sys.stderr)
+
+    if args.am_cache:
+        am.am_cache = AmCache(args.am_cache, max_bytes=args.am_cache_mb * 1024 * 1024)
+
+    if args.probe:
+        gfs.prober = AvailabilityProber(stats=stats)
+
+    stations, flushers, cycles = interpret_args(args, station_dict, prober=gfs.prober)
+
+    if args.deadline:
+        args.deadline = deadline.parse_deadline(args.deadline)
+        if len(cycles) > 1:
+            print('deadline: skipping the backfill of', len(cycles) - 1, 'cycles', file=sys.stderr)
+            cycles = cycles[:1]
 
     if not stations:
         print('no valid stations to fetch', file=sys.stderr)
         exit(1)
 
-    stats = defaultdict(int)
-    stats['stations'] = []
+    stats['stations'] = list(stations)
     stats['gfs_time'] = cycles[0].strftime(GFS_TIMESTAMP)
+    cycles = plan_backfill(args, station_dict, stations, flushers, cycles, stats)
     stats['start'] = datetime.datetime.now(datetime.timezone.utc).strftime(GFS_TIMESTAMP_FULL)
     time.sleep(jiggle(15) - 15)  # 0-5 seconds
     t0 = time.time()
+    downloads_t0 = deadline.downloads()
 
-    for vex in stations:
-        station = station_dict[vex]
-        stats['stations'].append(vex)
-        flush = True if vex in flushers else False
+    if args.am_workers:
+        # am is a subprocess, so threads are enough to keep every core busy
+        core.am_pool = ThreadPoolExecutor(max_workers=args.am_workers)
 
-        for gfs_cycle in cycles:
-            gcf = gfs_cycle.strftime(GFS_TIMESTAMP)
-            if verbose:
-                print('checking station', vex, 'cycle', gcf, file=sys.stderr)
-            outdir = '{}/{}'.format(args.dir, vex)
-            outfile = '{}/{}'.format(outdir, gcf)
-            if ok(outfile, verbose=verbose):
-                if verbose:
-                    print('  outfile {} seems ok, not re-fetching'.format(outfile), file=sys.stderr)
-                continue
-            print('downloading station', vex, 'cycle', gcf, file=sys.stderr)
-            if verbose or args.dry_run:
-                print('  processing', vex, outfile, file=sys.stderr)
-                if args.dry_run:
-                    continue
-            os.makedirs(outdir, exist_ok=True)
-            if args.stdout:
-                f = sys.stdout
-                f2 = None
-                fd2 = None
-            else:
-                # this file is not csv formatted, so f is the fd
-                f = open(outfile, 'w')
-                # this new file is csv formatted, we pass around f2 = csv.DictWriter
-                fd2 = open(outfile+'.extra', 'w', newline='')
-
-            if fd2:
-                fieldnames = [
-                    'date', 'csnow', 'cicep', 'cfrzr', 'crain', 'wgust', 'max_wind', '10m_wind',
-                ]
-                f2 = csv.DictWriter(fd2, fieldnames=fieldnames, delimiter=' ')
-                f2.writeheader()
-
-            try:
-                make_forecast_table(station, gfs_cycle, f, f2, wait=args.wait, verbose=args.verbose, hours=args.hours, stats=stats, flush=flush)
-            except TimeoutError:
-                # raised by gfs.py
-                print('Gave up on {} {}'.format(station, gfs_cycle), file=sys.stderr)
-                sys.stderr.flush()
-                exit_value = 1
-            if not args.stdout:
-                f.close()
-                if fd2:
-                    # can't close f2, close the underlying file
-                    fd2.close()
+    try:
+        if args.async_engine:
+            exit_value = run_async(args, station_dict, stations, flushers, cycles, stats, verbose=verbose)
+        elif args.batch:
+            exit_value = run_batched(args, station_dict, stations, flushers, cycles, stats, verbose=verbose)
+        else:
+            exit_value = run_per_station(args, station_dict, stations, flushers, cycles, stats, verbose=verbose)
+    finally:
+        if core.am_pool:
+            core.am_pool.shutdown()
+            core.am_pool = None
 
     stats['stations'] = ':'.join(sorted(stats['stations']))
+    session_stats(stats)
+    if gfs.rate_controller:
+        gfs.rate_controller.report(stats)
+    if am.am_cache:
+        am.am_cache.report(stats)
+    if gfs.request_quota:
+        stats['quota_waited_s'] = int(gfs.request_quota.waited)
     elapsed = int(time.time() - t0)
+    if not args.dry_run:
+        deadline.save_throughput(args.dir, args, time.time() - t0, deadline.downloads() - downloads_t0)
     if args.wait:
         stats['elapsed_wait_s'] = elapsed
     else:
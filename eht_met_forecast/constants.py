@@ -8,3 +8,6 @@ GFS_TIMESTAMP_FULL = '%Y%m%d_%H:%M:%S'
 GFS_DAYHOUR = '%Y%m%d/%H'
 GFS_DAY = '%Y%m%d'
 GFS_HOUR = '%H'
+
+# largest union box, in degrees of lat or lon, that batched downloads will group stations into
+GROUP_MAX_SPAN = 2.0
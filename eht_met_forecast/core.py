@@ -1,18 +1,25 @@
+import collections
+import concurrent.futures
 import datetime
 import os.path
 import sys
-import time
-import io
-import contextlib
 import tempfile
+import threading
+import time
 import json
+import csv
 
 from .constants import GFS_TIMESTAMP
 from .timer_utils import record_latency
-from .am import grib2_to_am_layers, print_am_header, print_am_layers, run_am, summarize_am, header_amc
-from .gfs import download_gfs
+from .am import grib2_to_am_layers, subset_grib, am_header_text, am_layers_text, run_am_cached, summarize_am
+from .am import frequency_header
+from . import am
+from . import surrogate
+from . import gfs
+from .gfs import download_gfs, courtesy_sleep
 
 expected_lines = 210
+am_pool = None  # a concurrent.futures executor to run am in, set by the cli
 table_header = ('#', 'date', 'tau255', 'Tb[K]', 'pwv[mm]', 'lwp[kg*m^-2]', 'iwp[kg*m^-2]', 'o3[DU]')
 
 
@@ -40,62 +47,82 @@ table_line_string = '{:1s}{:>16s} {:>12s} {:>12s} {:>12s} {:>12s} {:>12s} {:>12s
 table_line_floats = '{} {:12.4e} {:12.4e} {:12.4e} {:12.4e} {:12.4e} {:12.4e}'
 
 
-def print_table_line(fields, f):
-    print(table_line_string.format(*fields), file=f)
+def table_columns():
+    # table_header, plus tau and Tb for each band after the first in am.frequencies
+    extra = []
+    for freq in am.frequencies[1:]:
+        extra += ['tau{}'.format(freq), 'Tb{}[K]'.format(freq)]
+    return table_header + tuple(extra)
 
 
-def gfs15_to_am10(lat, lon, alt, gfs_cycle, forecast_hour, wait=False, verbose=False, stats=None):
-    grib_buffer = download_gfs(lat, lon, alt, gfs_cycle, forecast_hour, wait=wait, verbose=verbose, stats=stats)
+def format_row(gfs_timestamp, row):
+    return (table_line_floats + ' {:12.4e}' * (len(row) - 6)).format(gfs_timestamp, *row)
+
+
+def print_table_line(fields, f):
+    print((table_line_string + ' {:>12s}' * (len(fields) - 8)).format(*fields), file=f)
 
+
+def grib_to_am10(grib_buffer, lat, lon, alt, gfs_cycle, forecast_hour, grbindx=None):
     grib_problem = False
-    # development hint: use delete=False to save all of these
-    delete = True
-    with tempfile.NamedTemporaryFile(mode='wb', prefix='temp-', suffix='.grb', delete=delete) as f:
-        f.write(grib_buffer)
-        f.flush()
+    try:
+        profile = grib2_to_am_layers(grib_buffer, lat, lon, alt, grbindx=grbindx)
+    except Exception as e:
+        # example: RuntimeError: b'End of resource reached when reading message'
+        # example: UserWarning: file temp.grb has multi-field messages,
+        #          keys inside multi-field messages will not be indexed correctly
+        # example: key: csnow exception: no matches found
+        # example: problem reading grib: ValueError('no matches found',)
+
+        grib_problem = repr(e)
+        print('problem reading grib:', grib_problem, file=sys.stderr)
+        print('  problem grib length is', len(grib_buffer), file=sys.stderr)
+        # for csnow exception, example lengths 28k and 13k
 
+    if not grib_problem:
         try:
-            Pbase, z, T, o3_vmr, RH, cloud_lmr, cloud_imr, extra = grib2_to_am_layers(f.name, lat, lon, alt)
+            layers_amc = am_header_text(gfs_cycle, forecast_hour, lat, lon, alt) + am_layers_text(alt, profile)
         except Exception as e:
-            # example: RuntimeError: b'End of resource reached when reading message'
-            # example: UserWarning: file temp.grb has multi-field messages, keys inside multi-field messages will not be indexed correctly
-            # example: key: csnow exception: no matches found
-            # example: problem reading grib: ValueError('no matches found',)
+            # example: ZeroDivisionError after a bunch of
+            #   ECCODES INFO    :  grib_file_open: cannot open file foo.grb (No such file or directory)
+            grib_problem = str(e)
+            print('problem printing am', grib_problem, file=sys.stderr)
 
-            grib_problem = repr(e)
-            print('problem reading grib:', grib_problem, file=sys.stderr)
-            print('  problem grib length is', len(grib_buffer), file=sys.stderr)
-            # for csnow exception, example lengths 28k and 13k
+    if grib_problem:
+        return None, None
 
-    my_stdout = io.StringIO()
+    return layers_amc, profile.extra
 
-    if not grib_problem:
-        with contextlib.redirect_stdout(my_stdout):
-            try:
-                print_am_header(gfs_cycle, forecast_hour, lat, lon, alt)
-                print_am_layers(alt, Pbase, z, T, o3_vmr, RH, cloud_lmr, cloud_imr)
-            except Exception as e:
-                # example: ZeroDivisionError after a bunch of
-                #   ECCODES INFO    :  grib_file_open: cannot open file foo.grb (No such file or directory)
-                grib_problem = str(e)
-                print('problem printing am', grib_problem, file=sys.stderr)
-
-    if False:
-        with tempfile.NamedTemporaryFile(mode='wb', prefix='layers-err-', suffix='.grb', dir='.', delete=False) as tfile:
-            print('some problem turning the grib into layers, saving ', tfile.name, file=sys.stderr)
-            tfile.write(grib_buffer)
-            tfile.flush()
-            fname = tfile.name[:-4]+'.info'
-            with open(fname, 'w') as f:
-                print(grib_problem, file=f)
-                print('lat', lat, 'lon', lon, 'alt', alt, 'gfs_cycle', gfs_cycle, 'forecast_hour', forecast_hour, file=f)
-        return None, None
 
-    return my_stdout.getvalue(), extra
+def download_group(sites, bbox, gfs_cycle, forecast_hour, wait=False, verbose=False, stats=None):
+    # bbox=None means the box around the single site
+    if bbox is None:
+        site = sites[0]
+        return download_gfs(site['lat'], site['lon'], site['alt'], gfs_cycle, forecast_hour,
+                            wait=wait, verbose=verbose, stats=stats)
+    return download_gfs(None, None, None, gfs_cycle, forecast_hour,
+                        wait=wait, verbose=verbose, stats=stats, bbox=bbox)
 
 
-def print_final_output(gfs_timestamp, tau, Tb, pwv, lwp, iwp, o3, f, verbose=False, flush=False):
-    out = table_line_floats.format(gfs_timestamp, tau, Tb, pwv, lwp, iwp, o3)
+def grib_buffer_to_am10(grib_buffer, sites, gfs_cycle, forecast_hour):
+    indexes = [None] * len(sites)
+    if len(sites) > 1 or gfs.byterange_url:
+        # decode each message of the big grib once, instead of once per site
+        try:
+            indexes = subset_grib(grib_buffer, sites)
+        except Exception as e:
+            print('problem reading grib:', repr(e), file=sys.stderr)
+            print('  problem grib length is', len(grib_buffer), file=sys.stderr)
+            return [(None, None)] * len(sites)
+    ret = []
+    for site, grbindx in zip(sites, indexes):
+        ret.append(grib_to_am10(grib_buffer, site['lat'], site['lon'], site['alt'], gfs_cycle, forecast_hour,
+                                grbindx=grbindx))
+    return ret
+
+
+def print_final_output(gfs_timestamp, row, f, verbose=False, flush=False):
+    out = format_row(gfs_timestamp, row)
     print(out, file=f)
     if flush:
         f.flush()
@@ -110,62 +137,455 @@ def print_extra(fcast_pretty, extra, f2, verbose=False):
         f2.writerow(extra)
 
 
-def compute_one_hour(site, gfs_cycle, forecast_hour, f, f2, wait=False, verbose=False, stats=None, flush=False):
-    if verbose:
-        print(site['name'], 'fetching for hour', forecast_hour, file=sys.stderr)
-    with record_latency('fetch gfs data'):
-        layers_amc, extra = gfs15_to_am10(site['lat'], site['lon'], site['alt'], gfs_cycle, forecast_hour, wait=wait, verbose=verbose, stats=stats)
-    if layers_amc is None:
-        return  # no line emitted
+def forecast_hours(hours=385):
+    # hourly for 5 days, then every 3 hours out to 16 days
+    return [h for h in list(range(0, 121)) + list(range(123, 385, 3)) if h < hours]
+
+
+def progressive_level(forecast_hour):
+    # which pass of progressive_order() an hour is in
+    return 0 if forecast_hour % 12 == 0 else 1 if forecast_hour % 3 == 0 else 2
 
-    dt_forecast_hour = gfs_cycle + datetime.timedelta(hours=forecast_hour)
-    fcast_pretty = dt_forecast_hour.strftime(GFS_TIMESTAMP)
 
+def progressive_order(hours):
+    # coarse to fine: every 12 hours over the whole range first, then every 3 hours, then the rest
+    return sorted(hours, key=progressive_level)
+
+
+def am_one_row(layers_amc):
+    # runs am, returns tau, Tb, pwv, lwp, iwp, o3 (and tau, Tb for each extra band) or None if there was a problem
     am_problem = False
     with record_latency('run am'):
-        returncode, am_output, am_error = run_am(layers_amc)
+        returncode, am_output, am_error = run_am_cached(layers_amc)
     if returncode not in (0, 1):
         # am exits 1 for warnings: '! Warning: Water ice was encountered on a layer where models were'
         am_problem = 'saw returncode of {}'.format(returncode)
 
     if not am_problem:
         try:
-            tau, Tb, pwv, lwp, iwp, o3 = summarize_am(am_output, am_error)
+            return summarize_am(am_output, am_error)
         except Exception as e:
             am_problem = str(e)
 
-    if am_problem:
-        with tempfile.NamedTemporaryFile(mode='w', prefix='am-problem-', dir='.', delete=False) as tfile:
-            print('problem running am, saving input and output to', tfile.name, file=sys.stderr)
-            # example: -(35) : The volume mixing ratio must be in the range 0 to 1.
-            # ! Error: parse error.
-            tfile.write('am_problem: {}\n'.format(am_problem))
-            tfile.write('Input:\n\n')
-            tfile.write(header_amc)
-            tfile.write(layers_amc)
-            tfile.write('\nOutput:\n\n')
-            tfile.write(am_error)
-            tfile.write(am_output)
-            return  # no line emitted
+    with tempfile.NamedTemporaryFile(mode='w', prefix='am-problem-', dir='.', delete=False) as tfile:
+        print('problem running am, saving input and output to', tfile.name, file=sys.stderr)
+        # example: -(35) : The volume mixing ratio must be in the range 0 to 1.
+        # ! Error: parse error.
+        tfile.write('am_problem: {}\n'.format(am_problem))
+        tfile.write('Input:\n\n')
+        tfile.write(frequency_header())
+        tfile.write(layers_amc)
+        tfile.write('\nOutput:\n\n')
+        tfile.write(am_error)
+        tfile.write(am_output)
+
 
+def print_row(gfs_cycle, forecast_hour, row, extra, f, f2, verbose=False, flush=False):
+    dt_forecast_hour = gfs_cycle + datetime.timedelta(hours=forecast_hour)
     fcast_pretty = dt_forecast_hour.strftime(GFS_TIMESTAMP)
-    print_final_output(fcast_pretty, tau, Tb, pwv, lwp, iwp, o3, f, verbose=verbose, flush=flush)
+    print_final_output(fcast_pretty, row, f, verbose=verbose, flush=flush)
     print_extra(fcast_pretty, extra, f2, verbose=verbose)
     # flush f -- csv writer
     # flush f2 -- csv writer
-    time.sleep(1)
 
 
-def make_forecast_table(site, gfs_cycle, f, f2, wait=False, verbose=False, hours=-1, stats=None, flush=False):
-    print_table_line(table_header, f)
-    for forecast_hour in range(0, 121):
-        if forecast_hour >= hours:
-            return
-        compute_one_hour(site, gfs_cycle, forecast_hour, f, f2, wait=wait, verbose=verbose, stats=stats, flush=flush)
-    for forecast_hour in range(123, 385, 3):
-        if forecast_hour >= hours:
+PIPELINE_DEPTH = 8  # forecast hours downloaded but not yet written, per table
+REWRITE_SECONDS = 60  # with progressive_order(), also rewrite the table this often during a pass
+PIPELINE_STAGES = ('download', 'decode', 'am', 'write')
+
+
+class Pipeline:
+    '''
+    Runs the stages of making a table concurrently: downloads in the caller's thread,
+    grib decoding in one worker thread, am in am_pool, and writing in the caller's thread,
+    in forecast hour order. At most depth hours are in flight; when the window is full
+    the downloads wait for the oldest hour to be written, so that a slow stage holds
+    back the others instead of letting work pile up in front of it.
+
+    Without an am_pool everything runs in line, one hour at a time.
+    '''
+    def __init__(self, depth=None):
+        self.depth = depth or PIPELINE_DEPTH
+        self.decode_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1) if am_pool else None
+        self.lock = threading.Lock()
+        self.busy = collections.defaultdict(float)  # stage -> seconds
+        self.queued = collections.defaultdict(int)  # stage -> jobs waiting to start
+        self.max_queue = collections.defaultdict(int)
+        self.unwritten = {}  # forecast_hour -> writers that have not written it yet, in start order
+        self.max_in_flight = 0
+        self.t0 = time.time()
+
+    def run(self, stage, fn, *args, **kwargs):
+        t0 = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.busy[stage] += time.time() - t0
+
+    def submit(self, stage, executor, fn, *args):
+        with self.lock:
+            self.queued[stage] += 1
+            self.max_queue[stage] = max(self.max_queue[stage], self.queued[stage])
+        if executor is None:
+            future = concurrent.futures.Future()
+            future.set_result(self.start(stage, fn, *args))
+            return future
+        return executor.submit(self.start, stage, fn, *args)
+
+    def start(self, stage, fn, *args):
+        with self.lock:
+            self.queued[stage] -= 1
+        return fn(*args)
+
+    def am(self, layers_amc):
+        return self.run('am', am_one_row, layers_amc)
+
+    def start_hour(self, forecast_hour, writers):
+        # backpressure: write out the oldest hours until there is room for this one
+        while len(self.unwritten) >= self.depth:
+            oldest = next(iter(self.unwritten))  # in the order they were started
+            for writer in writers:
+                writer.drain(through=oldest)
+        self.unwritten[forecast_hour] = len(writers)
+        self.max_in_flight = max(self.max_in_flight, len(self.unwritten))
+
+    def written(self, forecast_hour):
+        if forecast_hour in self.unwritten:
+            self.unwritten[forecast_hour] -= 1
+            if not self.unwritten[forecast_hour]:
+                del self.unwritten[forecast_hour]
+
+    def decode(self, grib_buffer, sites, gfs_cycle, forecast_hour, slots):
+        # slots: a Future for each site's (row, extra), or None for sites that don't need this hour
+        results = self.run('decode', grib_buffer_to_am10, grib_buffer, sites, gfs_cycle, forecast_hour)
+        for site, (layers_amc, extra), slot in zip(sites, results, slots):
+            if slot is None:
+                continue
+            if layers_amc is None:
+                slot.set_result(None)  # no line emitted
+                continue
+            coefficients = surrogate.for_hour(site, forecast_hour)
+            if coefficients:
+                # quick-look row, no need to run am
+                slot.set_result((surrogate.estimate_row(coefficients, layers_amc), extra))
+                continue
+            chain_row(self.submit('am', am_pool, self.am, layers_amc), slot, extra)
+
+    def add_hour(self, grib_buffer, sites, gfs_cycle, forecast_hour, writers, resumeds):
+        slots = []
+        for writer, resumed in zip(writers, resumeds):
+            if forecast_hour in resumed:
+                writer.add_row(forecast_hour, *resumed[forecast_hour])
+                slots.append(None)
+            else:
+                slots.append(concurrent.futures.Future())
+                writer.add_future(forecast_hour, slots[-1])
+        decoded = self.submit('decode', self.decode_pool, self.decode,
+                              grib_buffer, sites, gfs_cycle, forecast_hour, slots)
+        decoded.add_done_callback(lambda f: fail_slots(f, slots))
+        for writer in writers:
+            writer.drain()
+
+    def close(self, writers, stats=None):
+        self.max_queue['write'] = max((writer.max_done for writer in writers), default=0)
+        if self.decode_pool:
+            self.decode_pool.shutdown()
+        if stats is None:
             return
-        compute_one_hour(site, gfs_cycle, forecast_hour, f, f2, wait=wait, verbose=verbose, stats=stats, flush=flush)
+        # summed over tables; am utilization is in units of one am worker, so it can be over 100%
+        stats['pipeline_wall_s'] = round(stats['pipeline_wall_s'] + time.time() - self.t0, 1)
+        for stage in PIPELINE_STAGES:
+            key = 'pipeline_{}_busy_s'.format(stage)
+            busy = stats[key] = round(stats[key] + self.busy[stage], 1)
+            stats['pipeline_{}_util_pct'.format(stage)] = int(100 * busy / max(stats['pipeline_wall_s'], 0.1))
+            key = 'pipeline_{}_max_queue'.format(stage)
+            stats[key] = max(stats[key], self.max_queue[stage])
+        stats['pipeline_max_in_flight'] = max(stats['pipeline_max_in_flight'], self.max_in_flight)
+
+
+def chain_row(future, slot, extra):
+    # when future's am row is ready, slot gets (row, extra), or None if am had a problem
+    def done(f):
+        if f.exception() is not None:
+            slot.set_exception(f.exception())
+        elif f.result() is None:
+            slot.set_result(None)
+        else:
+            slot.set_result((f.result(), extra))
+    future.add_done_callback(done)
+
+
+def fail_slots(decoded, slots):
+    # so that the writers don't wait forever for rows of a decode that blew up
+    if decoded.exception() is not None:
+        for slot in slots:
+            if slot is not None and not slot.done():
+                slot.set_exception(decoded.exception())
+
+
+class RowWriter:
+    '''
+    Writes one table's rows in the order they were added, forecast hour order unless
+    progressive. Rows arrive as futures filled in by a Pipeline, for the serial and batch
+    runs and the async engine alike, so that downloads overlap with decoding and am.
+    '''
+    def __init__(self, gfs_cycle, f, f2, verbose=False, flush=False, pipeline=None, rewrite=None):
+        self.gfs_cycle = gfs_cycle
+        self.f = f
+        self.f2 = f2
+        self.verbose = verbose
+        self.flush = flush
+        self.pipeline = pipeline
+        self.rewrite = rewrite  # the outfile, for progressive_order()
+        self.rows = {}  # forecast_hour -> (row, extra), with rewrite
+        self.level = None  # progressive_level() of the last row
+        self.rewritten = time.time()
+        self.dirty = False  # rows that are not in the file yet
+        self.pending = collections.deque()  # (forecast_hour, future (row, extra) or None)
+        self.max_done = 0  # most rows that were ready but waiting for an earlier hour
+
+    def add_row(self, forecast_hour, row, extra):
+        # a row we already have, e.g. from resume_outputs()
+        future = concurrent.futures.Future()
+        future.set_result((row, extra))
+        self.add_future(forecast_hour, future)
+
+    def add_future(self, forecast_hour, future):
+        self.pending.append((forecast_hour, future))
+        self.drain()
+
+    def drain(self, wait=False, through=None):
+        # writes the rows that are ready; with wait, all of them; with through, up to that hour's row
+        self.max_done = max(self.max_done, sum(future.done() for _, future in self.pending))
+        if through not in (forecast_hour for forecast_hour, _ in self.pending):
+            through = None
+        while self.pending:
+            forecast_hour, future = self.pending[0]
+            if not future.done() and not wait and through is None:
+                break
+            self.pending.popleft()
+            if forecast_hour == through:
+                through = None
+            result = future.result()
+            if result is not None:
+                row, extra = result
+                if self.pipeline:
+                    self.pipeline.run('write', self.write, forecast_hour, row, extra)
+                else:
+                    self.write(forecast_hour, row, extra)
+            if self.pipeline:
+                self.pipeline.written(forecast_hour)
+
+    def write(self, forecast_hour, row, extra):
+        if self.rewrite:
+            # rows arrive out of order, so the whole table is rewritten in order when a pass
+            # of progressive_order() is done, and every REWRITE_SECONDS
+            new_pass = self.level is not None and progressive_level(forecast_hour) != self.level
+            self.level = progressive_level(forecast_hour)
+            self.rows[forecast_hour] = (row, extra)
+            self.dirty = True
+            if new_pass or time.time() - self.rewritten >= REWRITE_SECONDS:
+                self.rewrite_table()
+        else:
+            print_row(self.gfs_cycle, forecast_hour, row, extra, self.f, self.f2, verbose=self.verbose,
+                      flush=self.flush)
+
+    def rewrite_table(self):
+        write_table(self.rewrite, self.gfs_cycle, self.rows)
+        self.rewritten = time.time()
+        self.dirty = False
+
+    def close(self):
+        # the rows of the last pass
+        if self.dirty:
+            if self.pipeline:
+                self.pipeline.run('write', self.rewrite_table)
+            else:
+                self.rewrite_table()
+
+
+def compute_one_hour(site, gfs_cycle, forecast_hour, writer, pipeline, wait=False, verbose=False, stats=None):
+    compute_one_hour_group([site], None, gfs_cycle, forecast_hour, [writer], pipeline,
+                           wait=wait, verbose=verbose, stats=stats)
+
+
+def compute_one_hour_group(sites, bbox, gfs_cycle, forecast_hour, writers, pipeline,
+                           wait=False, verbose=False, stats=None, resumeds=None):
+    # bbox=None means the box around the single site
+    if verbose:
+        print(','.join(s['name'] for s in sites), 'fetching for hour', forecast_hour, file=sys.stderr)
+    pipeline.start_hour(forecast_hour, writers)
+    with record_latency('fetch gfs data'):
+        grib_buffer = pipeline.run('download', download_group, sites, bbox, gfs_cycle, forecast_hour,
+                                   wait=wait, verbose=verbose, stats=stats)
+    if stats and bbox is not None:
+        stats['group_downloads'] += 1
+        stats['group_stations'] += len(sites)
+    pipeline.add_hour(grib_buffer, sites, gfs_cycle, forecast_hour, writers, resumeds or [{}] * len(sites))
+    courtesy_sleep()
+
+
+def make_forecast_table(site, gfs_cycle, f, f2, wait=False, verbose=False, hours=-1, stats=None, flush=False,
+                        resumed=None, hour_list=None, rewrite=None):
+    # resumed: rows from an interrupted run, see resume_outputs()
+    # hour_list: the forecast hours to fetch, if not all of them
+    # rewrite: the outfile, to fetch in progressive_order() and rewrite the table in order as rows arrive;
+    # f and f2 are then None, so that the old table stays until the first rewrite
+    if not rewrite:
+        print_table_line(table_columns(), f)
+    pipeline = Pipeline()
+    writer = RowWriter(gfs_cycle, f, f2, verbose=verbose, flush=flush, pipeline=pipeline, rewrite=rewrite)
+    hour_list = hour_list or forecast_hours(hours)
+    if rewrite:
+        hour_list = progressive_order(hour_list)
+    try:
+        for forecast_hour in hour_list:
+            if resumed and forecast_hour in resumed:
+                writer.add_row(forecast_hour, *resumed[forecast_hour])
+                continue
+            compute_one_hour(site, gfs_cycle, forecast_hour, writer, pipeline, wait=wait, verbose=verbose, stats=stats)
+    finally:
+        writer.drain(wait=True)
+        writer.close()
+        pipeline.close([writer], stats=stats)
+
+
+def make_forecast_table_group(sites, bbox, gfs_cycle, fs, f2s, wait=False, verbose=False, hours=-1, stats=None,
+                              flushes=None, resumeds=None, hour_list=None, rewrites=None):
+    # like make_forecast_table, but each forecast hour is downloaded once for all of the sites in bbox
+    resumeds = resumeds or [{}] * len(sites)
+    flushes = flushes or [False] * len(sites)
+    rewrites = rewrites or [None] * len(sites)
+    for f, rewrite in zip(fs, rewrites):
+        if not rewrite:
+            print_table_line(table_columns(), f)
+    pipeline = Pipeline()
+    writers = [RowWriter(gfs_cycle, f, f2, verbose=verbose, flush=flush, pipeline=pipeline, rewrite=rewrite)
+               for f, f2, flush, rewrite in zip(fs, f2s, flushes, rewrites)]
+    hour_list = hour_list or forecast_hours(hours)
+    if rewrites[0]:
+        hour_list = progressive_order(hour_list)
+    try:
+        for forecast_hour in hour_list:
+            if all(forecast_hour in resumed for resumed in resumeds):
+                for writer, resumed in zip(writers, resumeds):
+                    writer.add_row(forecast_hour, *resumed[forecast_hour])
+                continue
+            compute_one_hour_group(sites, bbox, gfs_cycle, forecast_hour, writers, pipeline, wait=wait, verbose=verbose,
+                                   stats=stats, resumeds=resumeds)
+    finally:
+        for writer in writers:
+            writer.drain(wait=True)
+            writer.close()
+        pipeline.close(writers, stats=stats)
+
+
+extra_fieldnames = [
+    'date', 'csnow', 'cicep', 'cfrzr', 'crain', 'wgust', 'max_wind', '10m_wind',
+]
+
+
+def open_outputs(outfile, stdout=False):
+    if stdout:
+        return sys.stdout, None, None
+
+    # this file is not csv formatted, so f is the fd
+    f = open(outfile, 'w')
+    # this new file is csv formatted, we pass around f2 = csv.DictWriter
+    fd2 = open(outfile+'.extra', 'w', newline='')
+
+    f2 = csv.DictWriter(fd2, fieldnames=extra_fieldnames, delimiter=' ')
+    f2.writeheader()
+    return f, f2, fd2
+
+
+def close_outputs(f, fd2, stdout=False):
+    if not stdout:
+        f.close()
+        if fd2:
+            # can't close f2, close the underlying file
+            fd2.close()
+
+
+def read_table(outfile, gfs_cycle):
+    '''
+    Read the rows of a (possibly partial) output table and its .extra file.
+    Returns {forecast_hour: (row, extra)} for the hours that are in both, in the
+    form that print_row() takes, so that writing them out again is byte-identical.
+    '''
+    extras = {}
+    try:
+        with open(outfile + '.extra', newline='') as fd2:
+            for extra in csv.DictReader(fd2, delimiter=' '):
+                if None not in extra.values():
+                    extras[extra.pop('date')] = extra
+    except FileNotFoundError:
+        return {}
+
+    columns = table_columns()
+    table = {}
+    with open(outfile) as f:
+        for line in f:
+            parts = line.split()
+            if not parts or parts[0].startswith('#') or parts[0] not in extras:
+                continue
+            try:
+                dt = datetime.datetime.strptime(parts[0], GFS_TIMESTAMP).replace(tzinfo=gfs_cycle.tzinfo)
+                row = tuple(float(p) for p in parts[1:])
+                if len(row) != len(columns) - 2 or format_row(parts[0], row) != line.rstrip('\n'):
+                    continue  # a line truncated by a crash, or from a run with other frequencies
+            except (ValueError, IndexError):
+                continue
+            forecast_hour = int((dt - gfs_cycle).total_seconds()) // 3600
+            table[forecast_hour] = (row, extras[parts[0]])
+    return table
+
+
+def write_table(outfile, gfs_cycle, table):
+    # written under a temporary name and renamed, so a crash leaves the old one intact
+    f, f2, fd2 = open_outputs(outfile + '.tmp')
+    print_table_line(table_columns(), f)
+    for forecast_hour in sorted(table):
+        row, extra = table[forecast_hour]
+        print_row(gfs_cycle, forecast_hour, row, dict(extra), f, f2)
+    close_outputs(f, fd2)
+    os.replace(outfile + '.tmp.extra', outfile + '.extra')
+    os.replace(outfile + '.tmp', outfile)
+
+
+def resume_outputs(outfile, gfs_cycle, stdout=False, stats=None):
+    '''
+    Checkpoint the hours finished by earlier, interrupted runs of this table, and
+    return them so that they are not downloaded again.
+
+    Finished rows are kept in outfile.partial (and outfile.partial.extra), because
+    outfile itself is about to be rewritten in forecast hour order. A run that
+    completes removes the checkpoint with finish_outputs().
+    '''
+    if stdout:
+        return {}
+    partial = outfile + '.partial'
+    resumed = {}
+    if os.path.exists(partial):
+        resumed.update(read_table(partial, gfs_cycle))
+    if os.path.exists(outfile):
+        resumed.update(read_table(outfile, gfs_cycle))
+    if resumed:
+        write_table(partial, gfs_cycle, resumed)
+        print('  resuming with {} hours already done'.format(len(resumed)), file=sys.stderr)
+        if stats is not None:
+            stats['resumed_hours'] += len(resumed)
+    return resumed
+
+
+def finish_outputs(outfile, stdout=False):
+    # the table is complete, the checkpoint is no longer needed
+    if stdout:
+        return
+    for fname in (outfile + '.partial', outfile + '.partial.extra'):
+        if os.path.exists(fname):
+            os.unlink(fname)
 
 
 def read_stations(filename):
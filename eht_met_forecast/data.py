@@ -39,6 +39,7 @@ def read_one(vex, gfs_cycle, basedir='.'):
         'delim_whitespace': True,
         'comment': '#',
         'names': 'datestr tau225 Tb pwv lwp iwp o3'.split(),
+        'usecols': range(7),  # tables made with --freq have tau and Tb columns for more bands
         'parse_dates': {'date': [0]},
         'keep_date_col': True,
         'date_parser': lambda x: datetime.datetime.strptime(x, '%Y%m%d_%H:%M:%S').replace(tzinfo=utc)
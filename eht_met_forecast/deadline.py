@@ -0,0 +1,177 @@
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+
+from . import gfs
+from . import timer_utils
+from .core import forecast_hours
+
+DEADLINE_MARGIN = 0.9  # plan to use this much of the time left
+SERIAL_SECONDS_PER_REQUEST = 3.  # courtesy sleep plus a typical download, without --async, if nothing was measured
+THROUGHPUT_FILE = '.nomads-throughput'  # in --dir, what recent runs measured
+THROUGHPUT_MAX_AGE = 24 * 3600
+MIN_MEASURED_DOWNLOADS = 10
+
+
+def levels(hours=385):
+    '''
+    The forecast hours to fetch for a table, from complete to the least we can make a
+    decision with. The next 48 hours matter most, so they keep their resolution longest.
+    '''
+    full = forecast_hours(hours)
+    return [
+        ('full', full),
+        ('48h hourly', [h for h in full if h <= 48 or h % 3 == 0]),
+        ('3-hourly', [h for h in full if h % 3 == 0]),
+        ('3-hourly to 120h', [h for h in full if h % 3 == 0 and h <= 120]),
+        ('3-hourly to 48h', [h for h in full if h % 3 == 0 and h <= 48]),
+    ]
+
+
+def parse_deadline(s, now=None):
+    # HH:MM UTC, the next time it comes around
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    t = datetime.datetime.strptime(s, '%H:%M')
+    deadline = now.replace(hour=t.hour, minute=t.minute, second=0, microsecond=0)
+    if deadline <= now:
+        deadline += datetime.timedelta(days=1)
+    return deadline
+
+
+def mode(args):
+    return 'async' if args.async_engine else 'serial'
+
+
+def paced_seconds_per_request(args, quota=True):
+    # the fastest our own pacing lets requests go: --aimd's current rate, else --rate, and the quota
+    if gfs.rate_controller:
+        rate = gfs.rate_controller.rate
+    elif args.async_engine:
+        rate = args.rate
+    else:
+        rate = 1.  # gfs.courtesy_sleep()
+    if quota and args.quota_per_minute:
+        rate = min(rate, args.quota_per_minute / 60.)
+    return 1. / rate
+
+
+def seconds_per_request(args):
+    '''
+    What a run in this mode can sustain against NOMADS, measured if we can: from
+    the downloads of this process so far, else from the last runs that used this
+    --dir, else from the configured pacing.
+    '''
+    count, seconds = timer_utils.totals.get('fetch gfs data', (0, 0.))
+    if count >= MIN_MEASURED_DOWNLOADS:
+        latency = seconds / count  # throttled downloads with their retry sleeps, too
+        if args.async_engine:
+            return max(paced_seconds_per_request(args), latency / args.concurrency)
+        # one download at a time, then the courtesy sleep
+        return max(paced_seconds_per_request(args), latency + paced_seconds_per_request(args, quota=False))
+
+    measured = read_throughput(args.dir).get(mode(args))
+    if measured:
+        return measured
+    if args.async_engine:
+        return paced_seconds_per_request(args)
+    return max(SERIAL_SECONDS_PER_REQUEST, paced_seconds_per_request(args))
+
+
+def downloads():
+    # NOMADS downloads so far in this process
+    return timer_utils.totals.get('fetch gfs data', (0, 0.))[0]
+
+
+def read_throughput(directory, now=None):
+    # {mode: seconds per download} measured by recent runs
+    now = now or time.time()
+    try:
+        with open(os.path.join(directory, THROUGHPUT_FILE)) as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return dict((k, v['seconds_per_request']) for k, v in state.items() if now - v['time'] < THROUGHPUT_MAX_AGE)
+
+
+def save_throughput(directory, args, elapsed, downloads):
+    # for the next run's seconds_per_request(); runs that waited for NOAA don't say much about NOMADS
+    if args.wait or downloads < MIN_MEASURED_DOWNLOADS or not os.path.isdir(directory):
+        return
+    path = os.path.join(directory, THROUGHPUT_FILE)
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        state = {}
+    state[mode(args)] = {'seconds_per_request': round(elapsed / downloads, 3), 'time': time.time()}
+    # write then rename, other runs may be reading it
+    with tempfile.NamedTemporaryFile(mode='w', dir=directory, delete=False) as f:
+        json.dump(state, f)
+    os.replace(f.name, path)
+
+
+def plan(units, budget, hours=385):
+    '''
+    Choose the forecast hours to fetch for each unit of work, a table or a group of
+    tables that shares its downloads, so that the total number of downloads fits in budget.
+
+    units is a list of (name, flushed). Every unit starts at the least complete level; units
+    that don't fit even then are skipped, flushed units last. Then flushed units are made
+    as complete as the budget allows, and then everyone else, one level at a time.
+
+    Returns {name: (level name, hours)} and the list of skipped names.
+    '''
+    ladder = levels(hours)
+    cost = [len(h) for name, h in ladder]
+    order = sorted(units, key=lambda u: not u[1])  # flushed first
+
+    level = {}
+    total = 0
+    skipped = []
+    for name, flushed in order:
+        if total + cost[-1] <= budget:
+            level[name] = len(ladder) - 1
+            total += cost[-1]
+        else:
+            skipped.append(name)
+
+    def upgrade(name):
+        nonlocal total
+        i = level[name]
+        if i > 0 and total + cost[i-1] - cost[i] <= budget:
+            level[name] = i - 1
+            total += cost[i-1] - cost[i]
+            return True
+        return False
+
+    for name, flushed in order:
+        if flushed and name in level:
+            while upgrade(name):
+                pass
+    upgraded = True
+    while upgraded:
+        upgraded = False
+        for name, flushed in order:
+            if not flushed and name in level:
+                upgraded = upgrade(name) or upgraded
+
+    return dict((name, ladder[i]) for name, i in level.items()), skipped
+
+
+def report(planned, skipped, hours=385, stats=None):
+    full = len(levels(hours)[0][1])
+    skipped_hours = 0
+    for name in sorted(planned):
+        level_name, level_hours = planned[name]
+        skipped_hours += full - len(level_hours)
+        if level_name != 'full':
+            print('deadline: {} is {}, skipping {} hours'.format(name, level_name, full - len(level_hours)),
+                  file=sys.stderr)
+    for name in skipped:
+        print('deadline: skipping', name, file=sys.stderr)
+    if stats is not None:
+        stats['deadline_skipped_hours'] = skipped_hours + full * len(skipped)
+        stats['deadline_skipped_tables'] = len(skipped)
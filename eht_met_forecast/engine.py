@@ -0,0 +1,295 @@
+# asyncio download engine: every station and cycle in one process, with a
+# limited number of NOMADS requests in flight, paced by one token bucket.
+# Nearby stations can share their downloads, as in --batch.
+#
+# requests is not async, so each request runs in a thread, as do grib decoding
+# and am; the event loop does the pacing, retries, and writing the output tables in order.
+
+import asyncio
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from . import gfs
+from .gfs import download_url, classify_response, classify_exception, print_retry, give_up
+from .gfs import cache_get, cache_put
+from .core import Pipeline, RowWriter, print_table_line, table_columns
+from .core import open_outputs, close_outputs, finish_outputs
+from .ratelimit import TokenBucket
+from .timer_utils import record_latency
+
+# NOMADS says more than 120 hits/minute gets you blocked
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RATE = 1.0  # requests per second, for the whole process
+
+
+async def fetch_gfs_download_async(url, params, limiter, executor, wait=False, verbose=False, stats=None):
+    # same retry logic as gfs.fetch_gfs_download
+    loop = asyncio.get_running_loop()
+
+    retry = gfs.MAX_DOWNLOAD_TRIES
+    actual_tries = 0
+    r = None  # so we can use it even after an exception
+    while retry > 0:
+        await limiter.acquire()
+        if gfs.request_quota:
+            await gfs.request_quota.acquire()
+        try:
+            actual_tries += 1
+            r = None
+            r = await loop.run_in_executor(executor, functools.partial(gfs.get_grib, url, params=params))
+            errflag, retry_bonus, retry_duration, quiet_retry = classify_response(r, actual_tries, wait=wait,
+                                                                                  verbose=verbose, stats=stats)
+        except requests.exceptions.RequestException as e:
+            errflag, retry_bonus, retry_duration, quiet_retry = classify_exception(e, wait=wait, stats=stats)
+
+        if errflag:
+            retry = retry + retry_bonus - 1
+            if retry > 0:
+                print_retry(r, actual_tries, quiet_retry)
+                await asyncio.sleep(retry_duration)
+            else:
+                give_up(url, stats=stats)
+        else:
+            break
+
+    return r.content
+
+
+class PrioritySemaphore:
+    '''
+    asyncio semaphore that gives a free slot to the waiter with the lowest priority,
+    instead of the one that has waited longest. Backfill waiters can hold at most
+    backfill_slots slots, so that the current cycle never waits behind backfill.
+    '''
+    def __init__(self, value, backfill_slots=None):
+        self.free = value
+        self.backfill_slots = value if backfill_slots is None else backfill_slots
+        self.backfill_held = 0
+        self.waiters = []  # heap of (priority, seq, future, backfill)
+        self.seq = itertools.count()
+
+    def eligible(self, backfill):
+        return self.free > 0 and (not backfill or self.backfill_held < self.backfill_slots)
+
+    async def acquire(self, priority, backfill=False):
+        if not self.waiters and self.eligible(backfill):
+            self.take(backfill)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.seq), future, backfill))
+        self.wake()  # the waiters ahead of us may be backfill that can't go, while we can
+        try:
+            await future  # take() was done by wake()
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(backfill)
+            raise
+
+    def take(self, backfill):
+        self.free -= 1
+        if backfill:
+            self.backfill_held += 1
+
+    def release(self, backfill=False):
+        self.free += 1
+        if backfill:
+            self.backfill_held -= 1
+        self.wake()
+
+    def wake(self):
+        # backfill sorts after everything else, so if the best waiter is backfill and can't go, nobody can
+        while self.waiters and self.eligible(self.waiters[0][3]):
+            priority, seq, future, backfill = heapq.heappop(self.waiters)
+            if future.cancelled():
+                continue
+            self.take(backfill)
+            future.set_result(None)
+
+
+class Table:
+    '''
+    One output table (station, cycle), written by a core.RowWriter: hours can finish
+    in any order, and rows are written in forecast hour order, or with progressive,
+    in the order of hours, rewriting the whole table in forecast hour order.
+    '''
+    def __init__(self, vex, site, gfs_cycle, outfile, hours, stdout=False, flush=False, resumed=None,
+                 progressive=False):
+        self.vex = vex
+        self.site = site
+        self.gfs_cycle = gfs_cycle
+        self.outfile = outfile
+        self.hours = hours
+        self.stdout = stdout
+        self.flush = flush
+        self.resumed = resumed or {}  # forecast_hour -> (row, extra) from an interrupted run
+        self.progressive = progressive
+        self.failed_hour = None
+        self.outstanding = len(hours)
+        self.f = self.fd2 = None
+        self.writer = None
+        self.write_executor = None
+        self.slots = {}  # forecast_hour -> Future of (row, extra), or None for no line
+
+    def open(self, pipeline=None, write_executor=None, verbose=False):
+        # write_executor: one thread that does the writing for every table, off the event loop
+        if self.writer is not None:
+            return
+        self.write_executor = write_executor
+        f2 = None
+        if not self.progressive:
+            self.f, f2, self.fd2 = open_outputs(self.outfile, stdout=self.stdout)
+            print_table_line(table_columns(), self.f)
+        self.writer = RowWriter(self.gfs_cycle, self.f, f2, verbose=verbose, flush=self.flush, pipeline=pipeline,
+                                rewrite=self.outfile if self.progressive else None)
+        for forecast_hour in self.hours:
+            self.slots[forecast_hour] = concurrent.futures.Future()
+            self.writer.add_future(forecast_hour, self.slots[forecast_hour])
+
+    def fail(self, forecast_hour):
+        # this hour's row never comes, so nothing after it is written
+        if self.failed_hour is None or forecast_hour < self.failed_hour:
+            self.failed_hour = forecast_hour
+
+    async def done(self, forecast_hour, result=None):
+        # result is for rows that didn't come through a Pipeline, which fills the slot itself
+        slot = self.slots[forecast_hour]
+        if not slot.done() and (self.failed_hour is None or forecast_hour < self.failed_hour):
+            slot.set_result(result)
+        await self.finish()
+
+    async def finish(self):
+        self.outstanding -= 1
+        if self.writer is None:
+            return
+        await self.in_writer(self.writer.drain)
+        if self.outstanding == 0:
+            await self.in_writer(self.close)
+
+    async def in_writer(self, fn):
+        if self.write_executor is None:
+            return fn()
+        return await asyncio.get_running_loop().run_in_executor(self.write_executor, fn)
+
+    def close(self):
+        self.writer.close()
+        if self.f is not None:
+            close_outputs(self.f, self.fd2, stdout=self.stdout)
+        if self.failed_hour is None:
+            finish_outputs(self.outfile, stdout=self.stdout)
+
+
+def priority(tables, forecast_hour, newest_cycle):
+    # latest cycle first, then flushed stations, then forecast hour. Returns (priority, backfill)
+    age = int((newest_cycle - tables[0].gfs_cycle).total_seconds()) // 3600
+    flushed = any(table.flush for table in tables)
+    if tables[0].progressive:
+        forecast_hour = tables[0].hours.index(forecast_hour)  # coarse hours first
+    return (age, not flushed, forecast_hour), age > 0
+
+
+async def do_hour(tables, bbox, forecast_hour, sem, limiter, executor, pipeline, write_executor, newest_cycle,
+                  wait=False, verbose=False, stats=None):
+    # one download for every table of a group of nearby stations, bbox=None for the box around a single station
+    loop = asyncio.get_running_loop()
+    gfs_cycle = tables[0].gfs_cycle
+    prio, backfill = priority(tables, forecast_hour, newest_cycle)
+
+    todo = []
+    for table in tables:
+        if forecast_hour in table.resumed:
+            table.open(pipeline, write_executor, verbose=verbose)
+            await table.done(forecast_hour, table.resumed[forecast_hour])
+        else:
+            todo.append(table)
+    if not todo:
+        return
+    sites = [table.site for table in todo]
+    names = ','.join(site['name'] for site in sites)
+
+    site = sites[0]
+    url, params = download_url(site['lat'], site['lon'], site['alt'], gfs_cycle, forecast_hour, bbox=bbox)
+    grib_buffer = cache_get(url, params, stats=stats)
+
+    if grib_buffer is None:
+        if wait and gfs.prober:
+            # don't hold a download slot while waiting for NOAA
+            await gfs.prober.wait_for_async(gfs_cycle, forecast_hour, verbose=verbose)
+        await sem.acquire(prio, backfill=backfill)
+        try:
+            if all(table.failed_hour is not None for table in todo):
+                for table in todo:
+                    await table.finish()
+                return
+            if verbose:
+                print(names, 'fetching for hour', forecast_hour, file=sys.stderr)
+            try:
+                with record_latency('fetch gfs data'):
+                    if gfs.byterange_url:
+                        # a handful of requests, with their own retries and pacing
+                        grib_buffer = await loop.run_in_executor(executor, functools.partial(
+                            gfs.download_gfs_byterange, gfs_cycle, forecast_hour, base_url=gfs.byterange_url,
+                            wait=wait, verbose=verbose, stats=stats))
+                    else:
+                        grib_buffer = await fetch_gfs_download_async(url, params, limiter, executor,
+                                                                     wait=wait, verbose=verbose, stats=stats)
+            except TimeoutError:
+                # raised by gfs.give_up
+                for table in todo:
+                    if table.failed_hour is None:
+                        print('Gave up on {} {}'.format(table.site, gfs_cycle), file=sys.stderr)
+                        sys.stderr.flush()
+                    table.open(pipeline, write_executor, verbose=verbose)
+                    table.fail(forecast_hour)
+                    await table.finish()
+                return
+        finally:
+            sem.release(backfill=backfill)
+        cache_put(url, params, grib_buffer)
+
+    if stats and bbox is not None:
+        stats['group_downloads'] += 1
+        stats['group_stations'] += len(todo)
+
+    # decoding and am are the same as without --async, they fill in the tables' slots for this hour
+    for table in todo:
+        table.open(pipeline, write_executor, verbose=verbose)
+    slots = [table.slots[forecast_hour] for table in todo]
+    await loop.run_in_executor(None, pipeline.decode, grib_buffer, sites, gfs_cycle, forecast_hour, slots)
+    await asyncio.gather(*(asyncio.wrap_future(slot) for slot in slots))
+    for table in todo:
+        await table.done(forecast_hour)
+
+
+async def run_tables(groups, concurrency, rate, wait=False, verbose=False, stats=None):
+    # backfill gets whatever the latest cycle leaves over, and never the last slot if there is more than one
+    sem = PrioritySemaphore(concurrency, backfill_slots=max(1, concurrency - 1))
+    limiter = gfs.rate_controller or TokenBucket(rate)
+    newest_cycle = max((tables[0].gfs_cycle for bbox, tables in groups), default=None)
+    work = [(bbox, tables, forecast_hour) for bbox, tables in groups for forecast_hour in tables[0].hours]
+    # also start them in priority order, so that the pacing and waits ahead of sem go the same way
+    work.sort(key=lambda w: priority(w[1], w[2], newest_cycle)[0])
+    pipeline = Pipeline()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, ThreadPoolExecutor(max_workers=1) as write_executor:
+        tasks = []
+        for bbox, tables, forecast_hour in work:
+            tasks.append(do_hour(tables, bbox, forecast_hour, sem, limiter, executor, pipeline, write_executor,
+                                 newest_cycle, wait=wait, verbose=verbose, stats=stats))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            pipeline.close([table.writer for bbox, tables in groups for table in tables if table.writer], stats=stats)
+    if stats and not gfs.rate_controller:
+        stats['ratelimit_waited_s'] = int(limiter.waited)
+
+
+def run_engine(groups, concurrency=DEFAULT_CONCURRENCY, rate=DEFAULT_RATE, wait=False, verbose=False, stats=None):
+    # groups is a list of (bbox, tables), the tables of a group share one download per forecast hour
+    asyncio.run(run_tables(groups, concurrency, rate, wait=wait, verbose=verbose, stats=stats))
+    if any(table.failed_hour is not None for bbox, tables in groups for table in tables):
+        return 1
@@ -22,11 +22,27 @@ def latest_gfs_cycle_time(now=None, lag=None):
     return dt_gfs.replace(hour=int(dt_gfs.hour / 6) * 6, minute=0, second=0, microsecond=0)
 
 
-def form_gfs_download_url(lat, lon, alt, gfs_cycle, forecast_hour):
+# levels and variables we download, spelled the way .idx inventories spell them
+# the filter cgi wants lev_ + the level with spaces changed to _
+LEVEL_NAMES = ['{:d} mb'.format(lev) for lev in LEVELS]
+LEVEL_NAMES += ['10 m above ground']  # wind level=10
+LEVEL_NAMES += ['surface']  # CRAIN etc, GUST, maps to level=0
+LEVEL_NAMES += ['max wind']  # UGRD, VGRD, maps to level=0
+
+VARIABLES = ["CLWMR", "ICMR", "HGT", "O3MR", "RH", "TMP"]  # for AM
+VARIABLES += ["UGRD", "VGRD"]  # wind
+VARIABLES += ["CRAIN", "CFRZR", "CICEP", "CSNOW"]  # yes/no 1/0 rain, freezing rain, ice pellets, snow
+VARIABLES += ["GUST"]  # lev_surface level=0
+
+
+def form_gfs_download_url(lat, lon, alt, gfs_cycle, forecast_hour, bbox=None):
     CGI_URL = "https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_{}_1hr.pl"
     url = CGI_URL.format(LATLON_GRID_STR)
 
-    leftlon, rightlon, bottomlat, toplat = box(lat, lon, LATLON_DELTA)
+    # bbox is a union box when downloading for a group of stations at once
+    if bbox is None:
+        bbox = box(lat, lon, LATLON_DELTA)
+    leftlon, rightlon, bottomlat, toplat = bbox
 
     gfs_dayhour = gfs_cycle.strftime(GFS_DAYHOUR)
     gfs_hour = gfs_cycle.strftime(GFS_HOUR)
@@ -42,19 +58,12 @@ def form_gfs_download_url(lat, lon, alt, gfs_cycle, forecast_hour):
         'bottomlat': bottomlat,
     }
 
-    for lev in LEVELS:
-        params['lev_{:d}_mb'.format(lev)] = 'on'
-    params['lev_10_m_above_ground'] = 'on'  # wind level=10
-    params['lev_surface'] = 'on'  # CRAIN etc, GUST, maps to level=0
-    params['lev_max_wind'] = 'on'  # UGRD, VGRD, maps to level=0
+    for lev in LEVEL_NAMES:
+        params['lev_' + lev.replace(' ', '_')] = 'on'
 
     # hint: https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25_1hr.pl
     # shows an interactive page where you can click on stuff
 
-    VARIABLES = ["CLWMR", "ICMR", "HGT", "O3MR", "RH", "TMP"]  # for AM
-    VARIABLES += ["UGRD", "VGRD"]  # wind
-    VARIABLES += ["CRAIN", "CFRZR", "CICEP", "CSNOW"]  # yes/no 1/0 rain, freezing rain, ice pellets, snow
-    VARIABLES += ["GUST"]  # lev_surface level=0
     '''
     these are all of the levels -- get_gfs.pl download of all variables
 
@@ -118,6 +127,80 @@ def form_gfs_download_url(lat, lon, alt, gfs_cycle, forecast_hour):
     return url, params
 
 
+# full pgrb2 files: nomads, or a mirror such as https://noaa-gfs-bdp-pds.s3.amazonaws.com
+# or a local file server with the same gfs.YYYYMMDD/HH/atmos/ layout
+NOMADS_PROD_URL = 'https://nomads.ncep.noaa.gov/pub/data/nccf/com/gfs/prod'
+RANGE_MAX_GAP = 256 * 1024  # read through gaps smaller than this instead of making another request
+
+
+def form_gfs_full_url(gfs_cycle, forecast_hour, base_url=NOMADS_PROD_URL):
+    return '{}/gfs.{}/atmos/gfs.t{}z.pgrb2.{}.f{:03d}'.format(
+        base_url, gfs_cycle.strftime(GFS_DAYHOUR), gfs_cycle.strftime(GFS_HOUR), LATLON_GRID_STR, forecast_hour)
+
+
+def parse_idx(text):
+    '''
+    Parse a wgrib2-style inventory into (start, end, var, level) per message
+    end is exclusive, and None for the last message
+    1:0:d=2024030112:PRMSL:mean sea level:anl:
+    2:990253:d=2024030112:CLWMR:1 mb:anl:
+    '''
+    entries = []
+    for line in text.splitlines():
+        parts = line.split(':')
+        if len(parts) < 5:
+            continue
+        entries.append([int(parts[1]), None, parts[3], parts[4]])
+    for this, following in zip(entries, entries[1:]):
+        this[1] = following[0]
+    return [tuple(e) for e in entries]
+
+
+def select_ranges(entries, variables=VARIABLES, levels=LEVEL_NAMES):
+    # same selection as the filter cgi: every message with one of our variables at one of our levels
+    variables = set(variables)
+    levels = set(levels)
+    return [(start, end) for start, end, var, lev in entries if var in variables and lev in levels]
+
+
+def coalesce_ranges(ranges, max_gap=RANGE_MAX_GAP):
+    # returns (start, end, [wanted ranges]) for each http request
+    requests_ = []
+    for start, end in sorted(ranges):
+        if requests_ and requests_[-1][1] is not None and start - requests_[-1][1] <= max_gap:
+            requests_[-1][1] = end
+            requests_[-1][2].append((start, end))
+        else:
+            requests_.append([start, end, [(start, end)]])
+    return requests_
+
+
+def download_gfs_byterange(gfs_cycle, forecast_hour, base_url=NOMADS_PROD_URL,
+                           wait=False, verbose=False, stats=None):
+    '''
+    Fetch just our messages out of the full global pgrb2 file, using its .idx and
+    http Range requests. The result is a valid (global) grib with the same messages
+    that the filter cgi would have sent, which serves every station at once.
+    '''
+    url = form_gfs_full_url(gfs_cycle, forecast_hour, base_url=base_url)
+    idx = fetch_gfs_response(url + '.idx', {}, wait=wait, verbose=verbose, stats=stats, grib=False)
+    ranges = select_ranges(parse_idx(idx.text))
+
+    messages = []
+    for start, end, wanted in coalesce_ranges(ranges):
+        byte_range = 'bytes={}-{}'.format(start, '' if end is None else end - 1)
+        r = fetch_gfs_response(url, {}, wait=wait, verbose=verbose, stats=stats, headers={'Range': byte_range})
+        if stats:
+            stats['byterange_requests'] += 1
+        chunk = r.content
+        if r.status_code == requests.codes.ok:
+            # server ignored the Range: header and sent the whole file
+            chunk = chunk[start:end]
+        for wstart, wend in wanted:
+            messages.append(chunk[wstart - start:None if wend is None else wend - start])
+    return b''.join(messages)
+
+
 # Timeouts and retries
 CONN_TIMEOUT        = 60       # Initial server response timeout in seconds
 READ_TIMEOUT        = 60       # Stalled download timeout in seconds
@@ -127,143 +210,360 @@ RATELIMIT_DELAY     = 60
 MAX_DOWNLOAD_TRIES  = 8
 
 
+POOL_SIZE           = 4        # keep-alive connections kept per host
+STREAM_CHUNK        = 65536    # bytes per read while checking grib framing
+
+session = None
+grib_cache = None  # a cache.GribCache, if the cli was asked for one
+rate_controller = None  # a ratelimit.AIMDRate, if the cli was asked for one
+request_quota = None  # a ratelimit.FileQuota shared with other processes on this host
+prober = None  # a probe.AvailabilityProber, used with wait=True
+byterange_url = None  # if set, fetch from full pgrb2 files here instead of the filter cgi
+
+
+def get_session(pool_size=None):
+    '''
+    One requests.Session for the whole run, so we don't pay for a new
+    TLS handshake to nomads for every forecast hour
+    '''
+    global session
+    if session is None or pool_size is not None:
+        pool_size = pool_size or POOL_SIZE
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+    return session
+
+
+def session_stats(stats):
+    # per-host connection reuse, from urllib3's counters
+    if session is None:
+        return
+    seen = set()
+    for adapter in session.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools[key]
+            stats['conn_new_' + pool.host] += pool.num_connections
+            stats['conn_reused_' + pool.host] += pool.num_requests - pool.num_connections
+
+
 def jiggle(seconds):
     jig = seconds // 3
     return random.randint(seconds, seconds + jig)
 
 
+def throttle_delay():
+    # with a rate controller, slowing down replaces the fixed delay
+    if rate_controller:
+        rate_controller.throttled()
+        return 0
+    return jiggle(RATELIMIT_DELAY)
+
+
+def courtesy_sleep():
+    # between forecast hours, unless a rate controller is doing the pacing
+    if not rate_controller:
+        time.sleep(1)
+
+
+def classify_response(r, actual_tries, wait=False, verbose=False, stats=None):
+    '''
+    Decide what to do about a NOMADS response.
+    Returns errflag, retry_bonus, retry_duration, quiet_retry
+    retry_bonus is added to the remaining tries, e.g. 1 for a free retry
+    '''
+    retry_bonus = 0
+    retry_duration = RETRY_DELAY
+    quiet_retry = False
+
+    if stats:
+        stats[str(r.status_code)] += 1
+    if r.status_code in {requests.codes.ok, requests.codes.partial_content}:
+        errflag = 0
+        if rate_controller:
+            rate_controller.success()
+    elif r.status_code == 404:
+        errflag = 1
+        if wait:
+            retry_bonus = 1  # free retry
+            retry_duration = jiggle(FOUROHFOUR_DELAY)
+        print('Data not yet available (404)', file=sys.stderr, end='')
+    elif r.status_code in {403, 429}:
+        # 403, 429: I've never seen NOMADS send these but they are typical "slow down" status codes
+        # NOMADS behind CDN will start sending 403s Aug 23, 2022 ?? the 403 has a reference number in the content
+        #   this didn't happen, they are still sending 302 with no Location: for slow down
+        errflag = 1
+        print('Received surprising retryable status ({})'.format(r.status_code), file=sys.stderr, end='')
+        #if r.status_code == 403 and r.content:
+        if r.text:
+            try:  # I don't think this can fail, but anyway
+                print(', text: '+r.text[:100].replace('  ', ' '), file=sys.stderr, end='')
+            except Exception:
+                pass
+        retry_bonus = 1  # free retry
+        retry_duration = throttle_delay()
+        if stats:
+            stats['ratelimit_surprising'] += 1
+    elif (r.status_code in {302} and 'Location' not in r.headers) or r.status_code in {503}:
+        # here's what they started sending after 4/20/2021:
+        # HTTP/1.1 302 Your allowed limit has been reached.
+        #     Please go to https://www.weather.gov/abusive-user-block for more info
+        # This 302 does not have a Location: header, so we test for it to make it less likely
+        # we'll end up in an infinite loop
+        # These still happen (but very rarely) after the aug 2022 change to using a CDN
+        # 503 example: Dec 2022, Apr 2023: "Error: An error occurred while processing your request." (wrapped in html)
+        errflag = 1
+        if actual_tries > 1:
+            # this happens ~ 33 times per run (out of 209) so make it quieter
+            print('Received retryable status ({})'.format(r.status_code), file=sys.stderr, end='')
+        else:
+            quiet_retry = True
+        retry_bonus = 1  # free retry
+        retry_duration = throttle_delay()
+        if stats:
+            if r.status_code in {503}:
+                stats['ratelimit_503'] += 1
+            else:
+                stats['ratelimit_302_no_location'] += 1
+    elif r.status_code in {302}:
+        # ? this can happen if you ask for a date too far in the past
+        # allow_redirects=True is the default for .get() so by default the redir will be followed
+        # so a 302 shouldn't be visible
+        errflag = 1
+        print('should not happen: 302 with Location: {} seen'.format(r.headers['Location']), file=sys.stderr, end='')
+        if stats:
+            stats['302_with_location'] += 1
+    elif r.status_code in {500, 502, 504}:
+        # I've seen 502 from NOMADS when the website is broken
+        # 500s when the lev_ or var_ are incorrect, detailed message in the contents
+        errflag = 1
+        print('Received retryable status ({})'.format(r.status_code), file=sys.stderr, end='')
+        retry_bonus = 0.8  # this counts as 1/5 of a retry
+        if stats:
+            stats['website_broken'] += 1
+    else:
+        errflag = 1
+        print("Download failed with status code {0}".format(r.status_code),
+              file=sys.stderr, end='')
+        if verbose:
+            print('url:', r.url, file=sys.stderr)
+            print('content:', r.content, file=sys.stderr)
+
+    return errflag, retry_bonus, retry_duration, quiet_retry
+
+
+class GribFramingError(requests.exceptions.ContentDecodingError):
+    # the body of a 200 is not a complete grib, retry it like any other download problem
+    pass
+
+
+class GribFramer:
+    '''
+    Checks grib2 message framing as the bytes arrive: each message starts with GRIB and
+    its total length, its sections' lengths add up to that, and it ends with 7777.
+    '''
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0  # start of the current message
+        self.end = None  # end of the current message, once we have seen section 0
+        self.section = None  # start of the next section of the current message
+        self.messages = 0
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        buf = self.buffer
+        while True:
+            if self.end is None:
+                if len(buf) < self.pos + 16:
+                    return
+                if buf[self.pos:self.pos+4] != b'GRIB':
+                    raise GribFramingError('no GRIB header at byte {}: {!r}'.format(
+                        self.pos, bytes(buf[self.pos:self.pos+16])))
+                if buf[self.pos+7] != 2:
+                    raise GribFramingError('grib edition {} at byte {}'.format(buf[self.pos+7], self.pos))
+                self.end = self.pos + int.from_bytes(buf[self.pos+8:self.pos+16], 'big')
+                self.section = self.pos + 16
+
+            while self.section < self.end - 4:
+                if len(buf) < self.section + 5:
+                    return
+                length = int.from_bytes(buf[self.section:self.section+4], 'big')
+                if length < 5 or self.section + length > self.end - 4:
+                    raise GribFramingError('section {} length {} overruns message at byte {}'.format(
+                        buf[self.section+4], length, self.pos))
+                self.section += length
+
+            if len(buf) < self.end:
+                return
+            if buf[self.end-4:self.end] != b'7777':
+                raise GribFramingError('no 7777 at the end of message at byte {}'.format(self.pos))
+            self.messages += 1
+            self.pos = self.end
+            self.end = None
+
+    def finish(self):
+        if self.end is not None or self.pos != len(self.buffer):
+            raise GribFramingError('grib truncated at {} bytes, after {} messages'.format(
+                len(self.buffer), self.messages))
+        if not self.messages:
+            raise GribFramingError('empty grib')
+        return bytes(self.buffer)
+
+
+def get_grib(url, params=None, headers=None):
+    '''
+    session.get() for a grib, streaming the body through a GribFramer so that an error page
+    or a truncated grib raises GribFramingError inside of the download retry loop
+    '''
+    r = get_session().get(url, params=params, headers=headers, timeout=(CONN_TIMEOUT, READ_TIMEOUT), stream=True)
+    if r.status_code not in {requests.codes.ok, requests.codes.partial_content}:
+        return r
+    framer = GribFramer()
+    try:
+        for chunk in r.iter_content(chunk_size=STREAM_CHUNK):
+            framer.feed(chunk)
+        content = framer.finish()
+    finally:
+        r.close()
+    r._content = content  # what r.content would have read, had we not streamed it
+    return r
+
+
+def classify_exception(e, wait=False, stats=None):
+    '''
+    Same as classify_response, for a requests exception
+    '''
+    retry_bonus = 0
+    errflag = 1
+
+    if isinstance(e, (requests.exceptions.ConnectTimeout, requests.exceptions.ConnectionError)):
+        print("Connection timed out.", file=sys.stderr, end='')
+        if wait:
+            retry_bonus = 1
+            if stats:
+                stats['timeout_with_wait'] += 1
+        else:
+            if stats:
+                stats['timeout_without_wait'] += 1
+    elif isinstance(e, requests.exceptions.ReadTimeout):
+        print("Data download timed out.", file=sys.stderr, end='')
+        if stats:
+            stats['timeout_read'] += 1
+    elif isinstance(e, requests.exceptions.ChunkedEncodingError):
+        print("Incomplete read.", file=sys.stderr, end='')
+        if stats:
+            stats['incomplete_read'] += 1
+    elif isinstance(e, GribFramingError):
+        # example: 28k and 13k gribs that used to fail later, in pygrib, with no retry
+        print("Bad grib: {}.".format(e), file=sys.stderr, end='')
+        if stats:
+            stats['bad_grib'] += 1
+    else:
+        print("Surprising exception of", repr(e)+".", file=sys.stderr, end='')
+        if stats:
+            stats['exception_'+str(e)] += 1
+
+    return errflag, retry_bonus, RETRY_DELAY, False
+
+
+def print_retry(r, actual_tries, quiet_retry):
+    if not quiet_retry:
+        print(' tries={}'.format(actual_tries), file=sys.stderr, end='')
+        print("  Retrying...", file=sys.stderr)
+        if r:
+            try:  # I don't think this can fail, but anyway
+                text = r.text[:100].replace('\n', ' ').replace('  ', ' ')
+                if text:
+                    print('  Text was:', text, file=sys.stderr)
+            except Exception:
+                pass
+
+
+def give_up(url, stats=None):
+    print("  Giving up.", file=sys.stderr)
+    print("Failed URL was: ", url, file=sys.stderr)
+    if stats:
+        stats['giving_up'] += 1
+    raise TimeoutError('gave up')  # caught in cli.py
+
+
 def fetch_gfs_download(url, params, wait=False, verbose=False, stats=None):
+    return fetch_gfs_response(url, params, wait=wait, verbose=verbose, stats=stats).content
+
+
+def fetch_gfs_response(url, params, wait=False, verbose=False, stats=None, headers=None, grib=True):
+    # grib=False for things that aren't gribs, like .idx files
 
     retry = MAX_DOWNLOAD_TRIES
     actual_tries = 0
     r = None  # so we can use it even after an exception
     while retry > 0:
-        quiet_retry = False
+        if rate_controller:
+            rate_controller.wait()
+        if request_quota:
+            request_quota.wait()
         try:
             actual_tries += 1
-            retry_duration = RETRY_DELAY
-            r = requests.get(url, params=params, timeout=(CONN_TIMEOUT, READ_TIMEOUT))
-            if stats:
-                stats[str(r.status_code)] += 1
-            if r.status_code == requests.codes.ok:
-                errflag = 0
-            elif r.status_code == 404:
-                errflag = 1
-                if wait:
-                    retry += 1  # free retry
-                    retry_duration = jiggle(FOUROHFOUR_DELAY)
-                print('Data not yet available (404)', file=sys.stderr, end='')
-            elif r.status_code in {403, 429}:
-                # 403, 429: I've never seen NOMADS send these but they are typical "slow down" status codes
-                # NOMADS behind CDN will start sending 403s Aug 23, 2022 ?? the 403 has a reference number in the content
-                #   this didn't happen, they are still sending 302 with no Location: for slow down
-                errflag = 1
-                print('Received surprising retryable status ({})'.format(r.status_code), file=sys.stderr, end='')
-                #if r.status_code == 403 and r.content:
-                if r.text:
-                    try:  # I don't think this can fail, but anyway
-                        print(', text: '+r.text[:100].replace('  ', ' '), file=sys.stderr, end='')
-                    except Exception:
-                        pass
-                retry += 1  # free retry
-                retry_duration = jiggle(RATELIMIT_DELAY)
-                if stats:
-                    stats['ratelimit_surprising'] += 1
-            elif (r.status_code in {302} and 'Location' not in r.headers) or r.status_code in {503}:
-                # here's what they started sending after 4/20/2021:
-                # HTTP/1.1 302 Your allowed limit has been reached. Please go to https://www.weather.gov/abusive-user-block for more info
-                # This 302 does not have a Location: header, so we test for it to make it less likely we'll end up in an infinite loop
-                # These still happen (but very rarely) after the aug 2022 change to using a CDN
-                # 503 example: Dec 2022, Apr 2023: "Error: An error occurred while processing your request." (wrapped in html)
-                errflag = 1
-                if actual_tries > 1:
-                    # this happens ~ 33 times per run (out of 209) so make it quieter
-                    print('Received retryable status ({})'.format(r.status_code), file=sys.stderr, end='')
-                else:
-                    quiet_retry = True
-                retry += 1  # free retry
-                retry_duration = jiggle(RATELIMIT_DELAY)
-                if stats:
-                    if r.status_code in {503}:
-                        stats['ratelimit_503'] += 1
-                    else:
-                        stats['ratelimit_302_no_location'] += 1
-            elif r.status_code in {302}:
-                # ? this can happen if you ask for a date too far in the past
-                # allow_redirects=True is the default for .get() so by default the redir will be followed
-                # so a 302 shouldn't be visible
-                errflag = 1
-                print('should not happen: 302 with Location: {} seen'.format(r.headers['Location']), file=sys.stderr, end='')
-                if stats:
-                    stats['302_with_location'] += 1
-            elif r.status_code in {500, 502, 504}:
-                # I've seen 502 from NOMADS when the website is broken
-                # 500s when the lev_ or var_ are incorrect, detailed message in the contents
-                errflag = 1
-                print('Received retryable status ({})'.format(r.status_code), file=sys.stderr, end='')
-                retry += 0.8  # this counts as 1/5 of a retry
-                if stats:
-                    stats['website_broken'] += 1
+            r = None
+            if grib:
+                r = get_grib(url, params=params, headers=headers)
             else:
-                errflag = 1
-                print("Download failed with status code {0}".format(r.status_code),
-                      file=sys.stderr, end='')
-                if verbose:
-                    print('url:', r.url, file=sys.stderr)
-                    print('content:', r.content, file=sys.stderr)
-        except (requests.exceptions.ConnectTimeout, requests.exceptions.ConnectionError):
-            print("Connection timed out.", file=sys.stderr, end='')
-            errflag = 1
-            if wait:
-                retry += 1
-                if stats:
-                    stats['timeout_with_wait'] += 1
-            else:
-                if stats:
-                    stats['timeout_without_wait'] += 1
-        except requests.exceptions.ReadTimeout:
-            print("Data download timed out.", file=sys.stderr, end='')
-            errflag = 1
-            if stats:
-                stats['timeout_read'] += 1
-        except requests.exceptions.ChunkedEncodingError:
-            print("Incomplete read.", file=sys.stderr, end='')
-            errflag = 1
-            if stats:
-                stats['incomplete_read'] += 1
+                r = get_session().get(url, params=params, headers=headers, timeout=(CONN_TIMEOUT, READ_TIMEOUT))
+            errflag, retry_bonus, retry_duration, quiet_retry = classify_response(r, actual_tries, wait=wait,
+                                                                                  verbose=verbose, stats=stats)
         except requests.exceptions.RequestException as e:
-            print("Surprising exception of", repr(e)+".", file=sys.stderr, end='')
-            errflag = 1
-            if stats:
-                stats['exception_'+str(e)] += 1
+            errflag, retry_bonus, retry_duration, quiet_retry = classify_exception(e, wait=wait, stats=stats)
 
         if errflag:
-            retry = retry - 1
+            retry = retry + retry_bonus - 1
             if retry > 0:
-                if not quiet_retry:
-                    print(' tries={}'.format(actual_tries), file=sys.stderr, end='')
-                    print("  Retrying...", file=sys.stderr)
-                    if r:
-                        try:  # I don't think this can fail, but anyway
-                            text = r.text[:100].replace('\n', ' ').replace('  ', ' ')
-                            if text:
-                                print('  Text was:', text, file=sys.stderr)
-                        except Exception:
-                            pass
+                print_retry(r, actual_tries, quiet_retry)
                 time.sleep(retry_duration)
             else:
-                print("  Giving up.", file=sys.stderr)
-                print("Failed URL was: ", url, file=sys.stderr)
-                if stats:
-                    stats['giving_up'] += 1
-                raise TimeoutError('gave up')  # caught in cli.py
+                give_up(url, stats=stats)
         else:
             break
 
-    return r.content
+    return r
 
 
-def download_gfs(lat, lon, alt, gfs_cycle, forecast_hour, wait=False, verbose=False, stats=None):
-    url, params = form_gfs_download_url(lat, lon, alt, gfs_cycle, forecast_hour)
-    grib_buffer = fetch_gfs_download(url, params, wait=wait, verbose=verbose, stats=stats)
+def cache_get(url, params, stats=None):
+    if grib_cache is None:
+        return
+    grib_buffer = grib_cache.get(grib_cache.key(url, params))
+    if stats:
+        stats['grib_cache_hit' if grib_buffer is not None else 'grib_cache_miss'] += 1
+    return grib_buffer
+
+
+def cache_put(url, params, grib_buffer):
+    if grib_cache is not None:
+        grib_cache.put(grib_cache.key(url, params), grib_buffer)
+
+
+def download_url(lat, lon, alt, gfs_cycle, forecast_hour, bbox=None):
+    # with byterange_url, the download is global and lat, lon, bbox are ignored
+    if byterange_url:
+        url = form_gfs_full_url(gfs_cycle, forecast_hour, base_url=byterange_url)
+        params = {'var': VARIABLES, 'lev': LEVEL_NAMES}  # for the cache key
+        return url, params
+    return form_gfs_download_url(lat, lon, alt, gfs_cycle, forecast_hour, bbox=bbox)
+
+
+def download_gfs(lat, lon, alt, gfs_cycle, forecast_hour, wait=False, verbose=False, stats=None, bbox=None):
+    url, params = download_url(lat, lon, alt, gfs_cycle, forecast_hour, bbox=bbox)
+    grib_buffer = cache_get(url, params, stats=stats)
+    if grib_buffer is None:
+        if wait and prober:
+            prober.wait_for(gfs_cycle, forecast_hour, verbose=verbose)
+        if byterange_url:
+            grib_buffer = download_gfs_byterange(gfs_cycle, forecast_hour, base_url=byterange_url,
+                                                 wait=wait, verbose=verbose, stats=stats)
+        else:
+            grib_buffer = fetch_gfs_download(url, params, wait=wait, verbose=verbose, stats=stats)
+        cache_put(url, params, grib_buffer)
     return grib_buffer
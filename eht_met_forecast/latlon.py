@@ -7,3 +7,31 @@ def box(lat, lon, latlon_delta):
     bottomlat = math.floor(lat / latlon_delta) * latlon_delta
     toplat = bottomlat + latlon_delta
     return leftlon, rightlon, bottomlat, toplat
+
+
+def union_box(boxes):
+    leftlon = min(b[0] for b in boxes)
+    rightlon = max(b[1] for b in boxes)
+    bottomlat = min(b[2] for b in boxes)
+    toplat = max(b[3] for b in boxes)
+    return leftlon, rightlon, bottomlat, toplat
+
+
+def group_stations(sites, latlon_delta, max_span):
+    '''
+    Greedily group sites into union boxes no bigger than max_span degrees on a side.
+    Returns a list of (union_box, [site, ...]) in the order the sites were given.
+    Stations on opposite sides of the dateline end up in different groups.
+    '''
+    groups = []
+    for site in sites:
+        b = box(site['lat'], site['lon'], latlon_delta)
+        for g in groups:
+            u = union_box((g[0], b))
+            if u[1] - u[0] <= max_span and u[3] - u[2] <= max_span:
+                g[0] = u
+                g[1].append(site)
+                break
+        else:
+            groups.append([b, [site]])
+    return [(g[0], g[1]) for g in groups]
@@ -0,0 +1,127 @@
+import asyncio
+import datetime
+import re
+import sys
+import threading
+import time
+
+import requests
+
+from . import gfs
+from .gfs import NOMADS_PROD_URL  # the same files the filter cgi reads from
+from .constants import GFS_DAY, GFS_HOUR, LATLON_GRID_STR
+
+PROBE_DELAY = 60  # seconds between directory listings of a cycle that isn't complete yet
+
+
+def listing_url(gfs_cycle, base_url=NOMADS_PROD_URL):
+    return '{}/gfs.{}/{}/atmos/'.format(base_url, gfs_cycle.strftime(GFS_DAY), gfs_cycle.strftime(GFS_HOUR))
+
+
+def parse_days(text):
+    # the gfs.YYYYMMDD/ directories of the top-level listing, oldest first
+    return sorted(set(re.findall(r'href="gfs\.(\d{8})/"', text)))
+
+
+def parse_hours(text):
+    # the HH/ cycle directories of a day's listing
+    return sorted(set(re.findall(r'href="(\d\d)/"', text)))
+
+
+def parse_listing(text, gfs_cycle):
+    # the .idx is written after the grib, so its presence means the forecast hour is complete
+    pattern = r'gfs\.t{}z\.pgrb2\.{}\.f(\d{{3}})\.idx'.format(gfs_cycle.strftime(GFS_HOUR), LATLON_GRID_STR)
+    return set(int(h) for h in re.findall(pattern, text))
+
+
+class AvailabilityProber:
+    '''
+    Learns which forecast hours of a cycle have been published from one directory
+    listing of the cycle, instead of asking the filter cgi for every hour and
+    sleeping after each 404. Listings are cached for PROBE_DELAY seconds and shared
+    by every caller, including threads.
+    '''
+    def __init__(self, base_url=NOMADS_PROD_URL, delay=PROBE_DELAY, stats=None):
+        self.base_url = base_url
+        self.delay = delay
+        self.stats = stats
+        self.published = {}  # gfs_cycle -> set of forecast hours
+        self.last_listing = {}  # gfs_cycle -> time.time() of the last listing
+        self.lock = threading.Lock()
+
+    def listing(self, url):
+        # the text of a directory listing, or None
+        if gfs.request_quota:
+            gfs.request_quota.wait()
+        if self.stats is not None:
+            self.stats['probe_listings'] += 1
+        try:
+            r = gfs.get_session().get(url, timeout=(gfs.CONN_TIMEOUT, gfs.READ_TIMEOUT))
+        except requests.exceptions.RequestException as e:
+            print('probe of', url, 'failed:', repr(e), file=sys.stderr)
+            return
+        if r.status_code != requests.codes.ok:
+            # 404 if the cycle directory does not exist yet
+            return
+        return r.text
+
+    def list_cycle(self, gfs_cycle):
+        text = self.listing(listing_url(gfs_cycle, base_url=self.base_url))
+        if text is None:
+            return set()
+        return parse_listing(text, gfs_cycle)
+
+    def oldest_cycle(self):
+        # the oldest cycle NOMADS still has, None if we can't tell
+        text = self.listing(self.base_url + '/')
+        days = text and parse_days(text)
+        if not days:
+            return
+        text = self.listing('{}/gfs.{}/'.format(self.base_url, days[0]))
+        hours = text and parse_hours(text)
+        if not hours:
+            return
+        return datetime.datetime.strptime(days[0] + hours[0], '%Y%m%d%H').replace(tzinfo=datetime.timezone.utc)
+
+    def is_published(self, gfs_cycle, forecast_hour):
+        with self.lock:
+            if forecast_hour in self.published.get(gfs_cycle, ()):
+                return True
+            if time.time() - self.last_listing.get(gfs_cycle, 0) >= self.delay:
+                self.published[gfs_cycle] = self.list_cycle(gfs_cycle)
+                self.last_listing[gfs_cycle] = time.time()
+            return forecast_hour in self.published[gfs_cycle]
+
+    def next_listing_in(self, gfs_cycle):
+        return max(1., self.last_listing.get(gfs_cycle, 0) + self.delay - time.time())
+
+    def wait_for(self, gfs_cycle, forecast_hour, verbose=False):
+        t0 = time.time()
+        while not self.is_published(gfs_cycle, forecast_hour):
+            time.sleep(self.next_listing_in(gfs_cycle))
+        self.waited(gfs_cycle, forecast_hour, t0, verbose=verbose)
+
+    async def wait_for_async(self, gfs_cycle, forecast_hour, verbose=False):
+        if forecast_hour in self.published.get(gfs_cycle, ()):
+            return
+        loop = asyncio.get_running_loop()
+        t0 = time.time()
+        while not await loop.run_in_executor(None, self.is_published, gfs_cycle, forecast_hour):
+            await asyncio.sleep(self.next_listing_in(gfs_cycle))
+        self.waited(gfs_cycle, forecast_hour, t0, verbose=verbose)
+
+    def waited(self, gfs_cycle, forecast_hour, t0, verbose=False):
+        elapsed = time.time() - t0
+        if self.stats is not None:
+            self.stats['probe_waited_s'] += int(elapsed)
+        if verbose and elapsed > 1:
+            print('waited {:.0f}s for hour {} of cycle {} to be published'.format(elapsed, forecast_hour, gfs_cycle),
+                  file=sys.stderr)
+
+    def latest_cycle(self, forecast_hour=384, now=None, tries=4):
+        # most recent cycle that has forecast_hour published, None if we can't find one
+        gfs_cycle = gfs.latest_gfs_cycle_time(now=now)
+        for _ in range(tries):
+            if self.is_published(gfs_cycle, forecast_hour):
+                return gfs_cycle
+            gfs_cycle -= datetime.timedelta(hours=6)
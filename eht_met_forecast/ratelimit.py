@@ -0,0 +1,149 @@
+import asyncio
+import fcntl
+import json
+import os
+import time
+
+
+class TokenBucket:
+    '''
+    Token bucket for asyncio callers. rate is tokens per second,
+    burst is the most tokens that can pile up while nobody is asking.
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.waited = 0.
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    async def acquire(self):
+        while True:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            delay = (1 - self.tokens) / self.rate
+            self.waited += delay
+            await asyncio.sleep(delay)
+
+
+# NOMADS blocks you for a while at 120 requests/minute
+AIMD_MIN_RATE = 1 / 60.  # requests per second
+AIMD_MAX_RATE = 2.0
+AIMD_INCREASE = 0.01  # added to the rate after each success
+AIMD_DECREASE = 0.5  # rate is multiplied by this after each throttle
+
+
+class AIMDRate(TokenBucket):
+    '''
+    Token bucket whose rate goes up additively while NOMADS is happy,
+    and is cut multiplicatively when NOMADS throttles us.
+    acquire() is for asyncio callers, wait() for everyone else.
+    '''
+    def __init__(self, rate, min_rate=AIMD_MIN_RATE, max_rate=AIMD_MAX_RATE,
+                 increase=AIMD_INCREASE, decrease=AIMD_DECREASE):
+        super().__init__(min(max_rate, max(min_rate, rate)), burst=1)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.backoffs = 0
+        self.throttled_s = 0.
+        self.throttled_since = None
+
+    def wait(self):
+        self.refill()
+        if self.tokens < 1:
+            delay = (1 - self.tokens) / self.rate
+            self.waited += delay
+            time.sleep(delay)
+            self.refill()
+        self.tokens -= 1
+
+    def success(self):
+        if self.throttled_since is not None:
+            self.throttled_s += time.monotonic() - self.throttled_since
+            self.throttled_since = None
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self):
+        self.backoffs += 1
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.refill()
+        self.tokens = min(self.tokens, 0)  # the next request waits a full 1/rate
+        if self.throttled_since is None:
+            self.throttled_since = time.monotonic()
+
+    def report(self, stats):
+        stats['aimd_rate_per_minute'] = round(self.rate * 60, 1)
+        stats['aimd_backoffs'] = self.backoffs
+        throttled_s = self.throttled_s
+        if self.throttled_since is not None:
+            throttled_s += time.monotonic() - self.throttled_since
+        stats['aimd_throttled_s'] = int(throttled_s)
+        stats['aimd_waited_s'] = int(self.waited)
+
+
+class FileQuota:
+    '''
+    Token bucket shared by every process on this host that uses the same file,
+    e.g. the one-process-per-station runs in do-all.sh. The bucket state lives in
+    the file and is updated under an exclusive flock.
+    '''
+    def __init__(self, path, per_minute, burst=1):
+        self.path = path
+        self.rate = per_minute / 60.
+        self.burst = burst
+        self.waited = 0.
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def take(self):
+        # returns 0 if we got a token, otherwise how long to sleep before asking again
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read())
+                except ValueError:
+                    state = {}
+                now = time.time()
+                last = state.get('last', now)
+                tokens = state.get('tokens', self.burst)
+                tokens = min(self.burst, tokens + max(0., now - last) * self.rate)
+                delay = 0.
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    delay = (1 - tokens) / self.rate
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps({'last': now, 'tokens': tokens}))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return delay
+
+    def wait(self):
+        while True:
+            delay = self.take()
+            if not delay:
+                return
+            self.waited += delay
+            time.sleep(delay)
+
+    async def acquire(self):
+        # the flock can block while another process holds it, so not on the event loop
+        loop = asyncio.get_running_loop()
+        while True:
+            delay = await loop.run_in_executor(None, self.take)
+            if not delay:
+                return
+            self.waited += delay
+            await asyncio.sleep(delay)
@@ -0,0 +1,159 @@
+# Quick-look estimate of tau225 and Tb without running am.
+#
+# tau225 is close to linear in the water vapor and cloud columns, with a per-station dry
+# term, and Tb follows from tau. The coefficients are fitted per station from historical
+# output tables, where am computed both the columns and tau/Tb, see scripts/fit-surrogate.py.
+# At run time the columns are summed from the same layers that am would have been given.
+#
+# No fitted table ships with the package: --surrogate-table is the output of
+# scripts/fit-surrogate.py, and stations that it has no coefficients for still run am.
+
+import json
+import math
+
+import numpy as np
+
+from . import am
+from .am import G_STD, PASCAL_ON_MBAR
+
+MIN_FIT_ROWS = 100
+
+AVOGADRO = 6.02214076e23
+M_AIR = 28.9644e-3  # dry air [kg / mol]
+MM_PWV = 3.3427e21  # h2o molecules per cm^2 in 1 mm of pwv
+DU = 2.6868e16  # molecules per cm^2 in one Dobson unit
+
+table = None  # station -> coefficients, set by the cli
+from_hour = None  # use the surrogate for forecast hours >= this, set by the cli
+
+
+def load_table(path):
+    # the json written by scripts/fit-surrogate.py: vex -> coefficients and their validation
+    with open(path) as f:
+        return json.load(f)
+
+
+def for_hour(site, forecast_hour):
+    # coefficients to use instead of am for this row, or None to run am
+    if not table or from_hour is None or forecast_hour < from_hour:
+        return
+    if len(am.frequencies) > 1:
+        return  # only am does the other bands
+    return table.get(site.get('vex', site.get('name')))
+
+
+def e_liquid(T):
+    # saturation vapor pressure over liquid water [Pa], Murphy and Koop (2005)
+    return math.exp(54.842763 - 6763.22 / T - 4.210 * math.log(T) + 0.000367 * T
+                    + math.tanh(0.0415 * (T - 218.8)) * (53.878 - 1331.22 / T - 9.44523 * math.log(T) + 0.014025 * T))
+
+
+def e_ice(T):
+    # saturation vapor pressure over ice [Pa], Murphy and Koop (2005)
+    return math.exp(9.550426 - 5723.265 / T + 3.53068 * math.log(T) - 0.00728332 * T)
+
+
+def layer_columns(layers_amc):
+    '''
+    pwv [mm], lwp [kg*m^-2], iwp [kg*m^-2], and o3 [DU] of the am layers in layers_amc,
+    the same columns that am reports and core.am_one_row puts in the table.
+    '''
+    layers = []
+    for line in layers_amc.splitlines():
+        parts = line.split()
+        if not parts or parts[0].startswith('#'):
+            continue
+        if parts[0] == 'layer':
+            layers.append({'o3': 0., 'lwp': 0., 'iwp': 0.})
+        elif parts[0] == 'Pbase':
+            layers[-1]['P'] = float(parts[1])
+        elif parts[0] == 'Tbase':
+            layers[-1]['T'] = float(parts[1])
+        elif parts[1] == 'h2o':
+            layers[-1]['h2o'] = (parts[2], float(parts[3].rstrip('%')))
+        elif parts[1] == 'o3':
+            layers[-1]['o3'] = float(parts[3])
+        elif parts[1] == 'lwp_abs_Rayleigh':
+            layers[-1]['lwp'] += float(parts[2])
+        elif parts[1] == 'iwp_abs_Rayleigh':
+            layers[-1]['iwp'] += float(parts[2])
+
+    h2o = o3 = lwp = iwp = 0.
+    P_top, T_top = 0., None
+    for layer in layers:
+        # like am, the layer is at the mean of its top and base
+        P = 0.5 * (P_top + layer['P'])
+        T = layer['T'] if T_top is None else 0.5 * (T_top + layer['T'])
+        n_air = PASCAL_ON_MBAR * (layer['P'] - P_top) / G_STD / M_AIR * AVOGADRO / 1e4  # [cm^-2]
+        kind, value = layer['h2o']
+        if kind == 'vmr':
+            vmr = value
+        else:
+            vmr = 0.01 * value * (e_ice(T) if kind == 'RHi' else e_liquid(T)) / (PASCAL_ON_MBAR * P)
+        h2o += n_air * vmr
+        o3 += n_air * layer['o3']
+        lwp += layer['lwp']
+        iwp += layer['iwp']
+        P_top, T_top = layer['P'], layer['T']
+
+    return h2o / MM_PWV, lwp, iwp, o3 / DU
+
+
+def estimate(coefficients, pwv, lwp, iwp):
+    c = coefficients['tau']
+    tau = c[0] + c[1] * pwv + c[2] * lwp + c[3] * iwp
+    a, b = coefficients['Tb']
+    return tau, a * (1. - np.exp(-tau)) + b
+
+
+def estimate_row(coefficients, layers_amc):
+    # a table row like core.am_one_row's, with tau and Tb from the surrogate
+    pwv, lwp, iwp, o3 = layer_columns(layers_amc)
+    tau, Tb = estimate(coefficients, pwv, lwp, iwp)
+    return float(tau), float(Tb), pwv, lwp, iwp, o3
+
+
+def fit(rows):
+    '''
+    Least squares fit to rows of am output, an array with the table's columns
+    tau, Tb, pwv, lwp, iwp, o3. tau is linear in pwv, lwp, iwp; Tb is linear in 1 - exp(-tau).
+    '''
+    tau, Tb, pwv, lwp, iwp = rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3], rows[:, 4]
+    X = np.column_stack((np.ones(len(rows)), pwv, lwp, iwp))
+    tau_coefficients = np.linalg.lstsq(X, tau, rcond=None)[0]
+    X = np.column_stack((1. - np.exp(-tau), np.ones(len(rows))))
+    Tb_coefficients = np.linalg.lstsq(X, Tb, rcond=None)[0]
+    return {'tau': tau_coefficients.tolist(), 'Tb': Tb_coefficients.tolist()}
+
+
+def validate(coefficients, rows):
+    # error of the surrogate against am, on rows that were not used for the fit
+    tau, Tb = estimate(coefficients, rows[:, 2], rows[:, 3], rows[:, 4])
+    tau_err = tau - rows[:, 0]
+    Tb_err = Tb - rows[:, 1]
+    return {
+        'rows': len(rows),
+        'tau_rms': float(np.sqrt(np.mean(tau_err**2))),
+        'tau_max': float(np.max(np.abs(tau_err))),
+        'tau_rel_rms': float(np.sqrt(np.mean((tau_err / rows[:, 0])**2))),
+        'Tb_rms': float(np.sqrt(np.mean(Tb_err**2))),
+        'Tb_max': float(np.max(np.abs(Tb_err))),
+    }
+
+
+def fit_station(tables, holdout=0.2):
+    '''
+    Fit to a station's tables, a list of row arrays in gfs cycle order. The most
+    recent holdout fraction of the tables is kept out of the fit to validate it.
+    Returns None if there is not enough data.
+    '''
+    split = len(tables) - max(1, int(len(tables) * holdout))
+    if split < 1:
+        return
+    fit_rows = np.concatenate(tables[:split])
+    if len(fit_rows) < MIN_FIT_ROWS:
+        return
+    coefficients = fit(fit_rows)
+    coefficients['fit_rows'] = len(fit_rows)
+    coefficients['validation'] = validate(coefficients, np.concatenate(tables[split:]))
+    return coefficients
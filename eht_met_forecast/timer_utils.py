@@ -1,10 +1,13 @@
 import time
 import sys
+import threading
 from contextlib import contextmanager
 
 from hdrh.histogram import HdrHistogram
 
 hists = {}
+totals = {}  # name: [count, seconds], including what is too slow for the histograms
+lock = threading.Lock()  # am runs in threads
 
 
 @contextmanager
@@ -14,9 +17,13 @@ def record_latency(name):
         yield
     finally:
         elapsed = time.time() - start
-        if name not in hists:
-            hists[name] = HdrHistogram(1, 30 * 1000, 2)  # 1ms-30sec, 2 sig figs
-        hists[name].record_value(elapsed * 1000)  # ms
+        with lock:
+            if name not in hists:
+                hists[name] = HdrHistogram(1, 30 * 1000, 2)  # 1ms-30sec, 2 sig figs
+                totals[name] = [0, 0.]
+            hists[name].record_value(elapsed * 1000)  # ms, silently dropped if over 30 sec
+            totals[name][0] += 1
+            totals[name][1] += elapsed
 
 
 def dump_latency_histograms(log=None):
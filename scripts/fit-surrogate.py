@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+'''
+Fit the tau225/Tb surrogate (eht_met_forecast/surrogate.py) to historical output
+tables, and report its error against am on the most recent cycles.
+
+usage: fit-surrogate.py eht-met-data [vex ...] > surrogate.json
+
+then eht-met-forecast --surrogate HOUR --surrogate-table surrogate.json ...
+'''
+
+import glob
+import json
+import os.path
+import sys
+
+import numpy as np
+
+from eht_met_forecast import surrogate
+
+basedir = sys.argv[1]
+vexes = sys.argv[2:] or sorted(os.path.basename(d) for d in glob.glob(basedir + '/*') if os.path.isdir(d))
+
+out = {}
+for vex in vexes:
+    tables = []
+    for fname in sorted(glob.glob('{}/{}/2*'.format(basedir, vex))):
+        if '.' in os.path.basename(fname):
+            continue  # .extra, .partial, etc
+        rows = np.loadtxt(fname, usecols=(1, 2, 3, 4, 5, 6), skiprows=1, ndmin=2)
+        if len(rows):
+            tables.append(rows)
+    coefficients = surrogate.fit_station(tables)
+    if coefficients is None:
+        print(vex, 'not enough data, skipping', file=sys.stderr)
+        continue
+    out[vex] = coefficients
+    v = coefficients['validation']
+    print('{} fit on {} rows, checked on {}:'.format(vex, coefficients['fit_rows'], v['rows']),
+          'tau rms {:.4f} max {:.4f} rel {:.1%},'.format(v['tau_rms'], v['tau_max'], v['tau_rel_rms']),
+          'Tb rms {:.2f} K max {:.2f} K'.format(v['Tb_rms'], v['Tb_max']), file=sys.stderr)
+
+print(json.dumps(out, indent=4, sort_keys=True))
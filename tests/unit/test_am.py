@@ -1,3 +1,4 @@
+import pytest
 from pytest import approx
 from math import sqrt
 
@@ -50,3 +51,173 @@ def test_grid_interp_vector():
     t2 = [[0, 1], [0, 1]]
     u, v = .1, .1
     assert am.grid_interp_vector(t1, t2, u, v) == approx(0.1 * sqrt(2.))
+
+
+def test_grid_interp_stack():
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    cells = rng.normal(size=(3, 4, 2, 2))
+    winds = rng.normal(size=(3, 4, 2, 2))
+    u, v = .3, .7
+    stacked = am.grid_interp_stack(cells, u, v)
+    vector = am.grid_interp_vector_stack(cells, winds, u, v)
+    assert stacked.shape == (3, 4)
+    for i in range(3):
+        for j in range(4):
+            # exactly equal, so the am layers do not change
+            assert stacked[i, j] == am.grid_interp(cells[i, j].tolist(), u, v)
+            assert vector[i, j] == am.grid_interp_vector(cells[i, j].tolist(), winds[i, j].tolist(), u, v)
+
+
+def test_grid_cells():
+    import numpy as np
+
+    class FakeGrb:
+        values = np.arange(12.).reshape(3, 4)
+
+    assert am.grid_cells(FakeGrb).tolist() == [[0., 1.], [4., 5.]]
+    assert am.grid_cells(FakeGrb, row=1, col=2).tolist() == [[6., 7.], [10., 11.]]
+
+
+def test_subset_grib(monkeypatch):
+    import numpy as np
+
+    # a global grid like the full pgrb2 files: north first, longitude 0..359.75
+    lats1 = np.arange(90., -90.25, -am.LATLON_DELTA)
+    lons1 = np.arange(0., 360., am.LATLON_DELTA)
+    lons, lats = np.meshgrid(lons1, lats1)
+
+    class FakeMessage(dict):
+        def __init__(self, name, level, values):
+            super().__init__(name=name, level=level)
+            self.values = values
+
+        def latlons(self):
+            return lats, lons
+
+    messages = [FakeMessage('Temperature', 500, lats * 1000 + lons),
+                FakeMessage('Temperature', 500, lats * 0)]  # duplicate, the first one wins
+    monkeypatch.setattr(am, 'grib_messages', lambda grib_buffer: messages)
+    monkeypatch.setattr(am.pygrib, 'fromstring', lambda message: message)
+
+    sites = [{'lat': 31.953, 'lon': -111.615}, {'lat': -10.1, 'lon': -0.1}]
+    kt, dateline = am.subset_grib(b'global grib', sites)
+
+    grb = kt.select(name='Temperature', level=500)[0]
+    assert grb.latlons()[0].tolist() == [[31.75, 31.75], [32., 32.]], 'row 0 is the bottom latitude'
+    assert grb.latlons()[1].tolist() == [[248.25, 248.5], [248.25, 248.5]]
+    assert am.grid_cells(grb).tolist() == (grb.lats * 1000 + grb.lons).tolist()
+
+    grb = dateline.select(name='Temperature', level=500)[0]
+    assert grb.latlons()[1].tolist() == [[359.75, 0.], [359.75, 0.]], 'longitude wraps'
+
+    with pytest.raises(ValueError):
+        kt.select(name='Temperature', level=400)
+
+
+def test_grib_index():
+    import os
+
+    gribname = os.path.split(__file__)[0] + '/../test.grb'
+    with open(gribname, 'rb') as f:
+        grib_buffer = f.read()
+    assert len(list(am.grib_messages(grib_buffer))) == len(am.pygrib.open(gribname).read())
+
+    grbindx = am.GribIndex(grib_buffer)
+    ondisk = am.pygrib.index(gribname, 'name', 'level')
+    for name, level in (('Categorical snow', 0), ('U component of wind', 0), ('Temperature', 500)):
+        a = grbindx.select(name=name, level=level)[0]
+        b = ondisk.select(name=name, level=level)[0]
+        assert (a.values == b.values).all()
+        assert (a.latlons()[0] == b.latlons()[0]).all()
+    assert 'Temperature' in grbindx.names()
+
+    with pytest.raises(ValueError):
+        list(am.grib_messages(b'<html>'))
+
+
+def test_missing_fields():
+    import os
+
+    gribname = os.path.split(__file__)[0] + '/../test.grb'
+    with open(gribname, 'rb') as f:
+        grbindx = am.GribIndex(f.read())
+    # newer eccodes spells it differently
+    for (name, level) in list(grbindx.fields):
+        if name == 'Geopotential height':
+            grbindx.fields[('Geopotential Height', level)] = grbindx.fields.pop((name, level))
+
+    profile = am.grib2_to_am_layers(None, 31.9, -111.6, 0, grbindx=grbindx)
+    i = list(profile.Pbase).index(500)
+    assert profile.o3_vmr[i] > 0
+
+    del grbindx.fields[('Ozone mixing ratio', 500)]
+    profile = am.grib2_to_am_layers(None, 31.9, -111.6, 0, grbindx=grbindx)
+    assert profile.o3_vmr[i] == 0.0, 'optional field defaults to 0'
+
+    del grbindx.fields[('Temperature', 500)]
+    with pytest.raises(ValueError, match='Temperature level 500'):
+        am.grib2_to_am_layers(None, 31.9, -111.6, 1891, grbindx=grbindx)
+
+
+def test_atmosphere_profile():
+    import pickle
+    import numpy as np
+
+    layers = np.arange(7 * 31, dtype=float).reshape(7, 31)
+    extra = dict((k, i / 3.) for i, k in enumerate(am.AtmosphereProfile.extra_keys))
+    profile = am.AtmosphereProfile(layers, extra)
+    assert profile.Pbase[0] == 0. and profile.cloud_imr[-1] == 7 * 31 - 1
+
+    for other in (am.AtmosphereProfile.from_bytes(profile.to_bytes()), pickle.loads(pickle.dumps(profile))):
+        assert (other.layers == profile.layers).all()
+        assert other.extra == profile.extra
+        assert list(other.extra) == list(extra), 'same order, for the .extra csv'
+    assert len(pickle.dumps(profile)) < 2000
+
+
+def test_am_layers_text():
+    import numpy as np
+
+    Pbase = [100., 500., 1000.]
+    z = [16000., 5500., 100.]
+    T = [210., 250., 290.]
+    o3 = [1e-6, 0., 0.]
+    RH = [5., 50., 80.]
+    lmr = [0., 1e-5, 0.]
+    imr = [0., 0., 0.]
+    profile = am.AtmosphereProfile(np.array([Pbase, z, T, o3, RH, lmr, imr]), {})
+
+    text = am.am_layers_text(3000., profile)
+    layers = text.split('\n\n')
+    assert len(layers) == 3
+    assert layers[0].startswith('layer\nPbase 100.0 mbar  # 16000.0 m\nTbase 210.0 K\ncolumn dry_air vmr\n')
+    assert 'column o3 vmr 1.000e-06' in layers[0]
+    assert 'column h2o RHi 27.50%' in layers[1], 'mid-layer T is below the supercooling limit'
+    assert 'column iwp_abs_Rayleigh 2.039e-02 kg*m^-2' in layers[1], 'supercooled liquid is ice'
+    assert layers[2].startswith('layer\nPbase 689.2 mbar  # 3000.0 m\n'), 'the bottom layer stops at alt'
+    assert layers[2].endswith('kg*m^-2\n'), 'and has no blank line after it'
+
+    text = am.am_layers_text(100., profile)
+    assert text.count('layer\n') == 3 and text.endswith('\n\n'), 'alt on the bottom level, no partial layer'
+
+
+def test_summarize_am():
+    assert am.frequency_header([225]) == am.header_amc
+    assert 'f 225 GHz 345 GHz 15 GHz\n' in am.frequency_header([225, 345])
+    assert 'f 86 GHz 345 GHz 1 GHz\n' in am.frequency_header([225, 345, 86])
+    for freqs in ([225], [225, 345], [225, 230, 345], [225, 345, 86], [230, 690]):
+        grid = [line for line in am.frequency_header(freqs).splitlines() if line.startswith('f ')][0]
+        step = int(grid.split()[5])
+        assert all(freq % step == 0 for freq in freqs), 'every band is a point of am\'s grid'
+
+    am_error = '# h2o 1.5e21 cm^-2\n# lwp_abs_Rayleigh 0.0 cm^-2\n# iwp_abs_Rayleigh 0.0 cm^-2\n# o3 7.0e18 cm^-2\n'
+    am_output = '2.250000e+02 1.0000e-01 1.2532e+01\n3.450000e+02 3.0000e-01 3.1000e+01\n'
+    row = am.summarize_am(am_output, am_error, freqs=[225])
+    assert row[:2] == (0.1, 12.532)
+    assert row[2] == approx(1.5e21 / 3.3427e21)
+    assert len(row) == 6
+    assert am.summarize_am(am_output, am_error, freqs=[225, 345])[6:] == (0.3, 31.0)
+    with pytest.raises(KeyError):
+        am.summarize_am(am_output, am_error, freqs=[225, 230])
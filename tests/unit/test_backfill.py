@@ -0,0 +1,64 @@
+import datetime
+import os
+
+from eht_met_forecast import backfill
+
+
+def test_split_expired():
+    utc = datetime.timezone.utc
+    now = datetime.datetime(2024, 3, 11, 3, 17, tzinfo=utc)
+    oldest = backfill.oldest_fetchable(now=now)
+    assert oldest == now - datetime.timedelta(hours=backfill.NOMADS_RETENTION_HOURS - backfill.RETENTION_MARGIN_HOURS)
+
+    cycles = [datetime.datetime(2024, 3, 11, 0, tzinfo=utc) - datetime.timedelta(hours=h) for h in range(0, 241, 6)]
+    fetchable, expired = backfill.split_expired(cycles, oldest)
+    assert fetchable == cycles[:39]
+    assert expired == cycles[39:]
+
+    naive = datetime.datetime(2024, 3, 1, 6)  # from --cycle
+    assert backfill.split_expired([naive], oldest) == ([], [naive])
+
+
+def test_skip_expired(tmp_path):
+    gfs_cycle = datetime.datetime(2024, 3, 1, 6)
+    outdir = str(tmp_path)
+    os.makedirs(outdir + '/Mm')
+    with open(outdir + '/Mm/20240301_06:00:00', 'w') as f:
+        f.write('\n' * 210)  # finished
+
+    assert backfill.skip_expired(outdir, ['Mm', 'Kt'], [gfs_cycle], dry_run=True) == 1
+    assert not os.path.exists(outdir + '/Kt')
+
+    assert backfill.skip_expired(outdir, ['Mm', 'Kt'], [gfs_cycle]) == 1
+    assert os.path.exists(outdir + '/Kt/20240301_06:00:00.skip')
+    assert not os.path.exists(outdir + '/Mm/20240301_06:00:00.skip')
+    assert backfill.skip_expired(outdir, ['Mm', 'Kt'], [gfs_cycle]) == 0, 'already skipped'
+
+
+def test_plan_backfill(tmp_path, monkeypatch):
+    import argparse
+    import collections
+
+    from eht_met_forecast import cli, gfs
+
+    monkeypatch.setattr(gfs, 'prober', None)
+    monkeypatch.setattr(gfs, 'byterange_url', None)
+    station_dict = {'Mm': {'name': 'JCMT', 'lat': 19.8, 'lon': -155.5, 'alt': 4000}}
+    args = argparse.Namespace(dir=str(tmp_path), hours=385, batch=False, async_engine=False, rate=1.,
+                              quota_per_minute=None, concurrency=4, grib_cache=None, dry_run=False, verbose=False)
+    cycle = datetime.datetime(2020, 3, 16, 18)  # --cycle, long gone from NOMADS
+    cycles = [cycle - datetime.timedelta(hours=h) for h in (0, 6, 12)]
+
+    stats = collections.defaultdict(int)
+    assert cli.plan_backfill(args, station_dict, ['Mm'], set(), cycles[:1], stats) == cycles[:1]
+    assert not stats, 'no backfill, nothing to plan'
+
+    args.grib_cache = str(tmp_path / 'cache')
+    assert cli.plan_backfill(args, station_dict, ['Mm'], set(), cycles, stats) == cycles, 'the cache may have them'
+    assert stats['planned_requests'] == 3 * 209
+
+    args.grib_cache = None
+    assert cli.plan_backfill(args, station_dict, ['Mm'], set(), cycles, stats) == cycles[:1], '--cycle stays'
+    assert stats['backfill_expired_cycles'] == 2
+    assert not os.path.exists(str(tmp_path / 'Mm' / '20200316_18:00:00.skip'))
+    assert os.path.exists(str(tmp_path / 'Mm' / '20200316_12:00:00.skip'))
@@ -0,0 +1,92 @@
+import os
+import time
+
+from eht_met_forecast.cache import GribCache, AmCache
+from eht_met_forecast import am
+
+
+def test_grib_cache(tmp_path):
+    cache = GribCache(str(tmp_path), max_bytes=250, max_age=3600)
+
+    params = {'file': 'gfs.t00z.pgrb2.0p25.f000', 'leftlon': -155.5}
+    k1 = cache.key('https://example.com/', params)
+    assert k1 == cache.key('https://example.com/', dict(reversed(list(params.items()))))
+    assert k1 != cache.key('https://example.com/', dict(params, leftlon=-155.25))
+
+    assert cache.get(k1) is None
+    cache.put(k1, b'a' * 100)
+    assert cache.get(k1) == b'a' * 100
+
+    k2 = cache.key('https://example.com/', dict(params, file='gfs.t00z.pgrb2.0p25.f001'))
+    cache.put(k2, b'b' * 100)
+
+    # make k1 the most recently used, so k2 is the one evicted
+    os.utime(cache.path(k2), (time.time() - 100, time.time()))
+    k3 = cache.key('https://example.com/', dict(params, file='gfs.t00z.pgrb2.0p25.f002'))
+    cache.put(k3, b'c' * 100)
+    assert cache.get(k2) is None
+    assert cache.get(k1) == b'a' * 100
+    assert cache.get(k3) == b'c' * 100
+    assert cache.total_bytes == 200
+
+
+def test_grib_cache_age(tmp_path):
+    cache = GribCache(str(tmp_path), max_age=10)
+    key = cache.key('https://example.com/', {})
+    cache.put(key, b'grib')
+    old = time.time() - 20
+    os.utime(cache.path(key), (old, old))
+    assert cache.get(key) is None
+    assert not os.path.exists(cache.path(key))
+
+
+def test_am_cache(tmp_path, monkeypatch):
+    calls = []
+
+    def fake_run_am(layers_amc):
+        calls.append(layers_amc)
+        return 0, ' 225.0 1.5e-01 12.5\n', 'verbose stuff\n# h2o 1.5e21 cm^-2\n# o3 7.0e18 cm^-2\n'
+
+    monkeypatch.setattr(am, 'run_am', fake_run_am)
+    monkeypatch.setattr(am, 'am_version', lambda: 'am version 14.0')
+    monkeypatch.setattr(am, 'am_cache', AmCache(str(tmp_path)))
+
+    first = am.run_am_cached('layer\n')
+    second = am.run_am_cached('layer\n')
+    assert len(calls) == 1
+    assert second == (0, ' 225.0 1.5e-01 12.5\n', '# h2o 1.5e21 cm^-2\n# o3 7.0e18 cm^-2\n')
+    assert first[1] == second[1]
+
+    monkeypatch.setattr(am, 'am_version', lambda: 'am version 15.0')
+    am.run_am_cached('layer\n')
+    assert len(calls) == 2, 'a new am version is a miss'
+    assert (am.am_cache.hits, am.am_cache.misses) == (1, 2)
+
+
+def test_cache_evicted_by_another_process(tmp_path, monkeypatch):
+    from eht_met_forecast import cache as cache_module
+
+    cache = GribCache(str(tmp_path))
+    key = cache.key('https://example.com/', {})
+    cache.put(key, b'grib')
+
+    def evicted(path, mode):
+        os.unlink(path)  # between our stat and open
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(cache_module, 'open', evicted, raising=False)
+    assert cache.get(key) is None
+    monkeypatch.undo()
+
+    cache.put(key, b'grib')
+    old = time.time() - cache.max_age - 1
+    os.utime(cache.path(key), (old, old))
+    unlink = os.unlink
+
+    def raced(path):
+        unlink(path)  # another process expired it first
+        unlink(path)
+
+    monkeypatch.setattr(os, 'unlink', raced)
+    cache.evict()
+    assert cache.total_bytes == 0
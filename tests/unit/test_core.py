@@ -0,0 +1,136 @@
+import datetime
+
+from eht_met_forecast import core
+
+
+def write_rows(outfile, gfs_cycle, hours):
+    f, f2, fd2 = core.open_outputs(outfile)
+    core.print_table_line(core.table_header, f)
+    for h in hours:
+        extra = dict((k, str(h / 10.)) for k in core.extra_fieldnames[1:])
+        core.print_row(gfs_cycle, h, (h + 0.123456, 12.5, 0.4, 0., 0., 260.5), extra, f, f2)
+    core.close_outputs(f, fd2)
+
+
+def test_resume(tmp_path):
+    gfs_cycle = datetime.datetime(2024, 3, 1, 12, tzinfo=datetime.timezone.utc)
+    outfile = str(tmp_path / 'table')
+    write_rows(outfile, gfs_cycle, range(4))
+    with open(outfile) as f:
+        expected = f.read()
+
+    with open(outfile, 'a') as f:
+        f.write('20240301_16:00:00   1.6774e+00   1.2')  # truncated by a crash
+    table = core.read_table(outfile, gfs_cycle)
+    assert sorted(table) == [0, 1, 2, 3]
+    assert table[2][0] == (2.1235, 12.5, 0.4, 0., 0., 260.5)
+
+    # a run that dies early leaves a short table, the checkpoint keeps the rest
+    resumed = core.resume_outputs(outfile, gfs_cycle)
+    write_rows(outfile, gfs_cycle, [0])
+    assert sorted(core.resume_outputs(outfile, gfs_cycle)) == [0, 1, 2, 3]
+
+    f, f2, fd2 = core.open_outputs(outfile)
+    core.print_table_line(core.table_header, f)
+    for h in range(4):
+        core.print_row(gfs_cycle, h, *resumed[h], f, f2)
+    core.close_outputs(f, fd2)
+    with open(outfile) as f:
+        assert f.read() == expected, 'resumed rows are written byte-identical'
+
+    core.finish_outputs(outfile)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['table', 'table.extra']
+
+
+def test_pipeline(tmp_path, monkeypatch):
+    import collections
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    def fake_download(sites, bbox, gfs_cycle, forecast_hour, **kwargs):
+        return str(forecast_hour)
+
+    def fake_decode(grib_buffer, sites, gfs_cycle, forecast_hour):
+        extra = dict((k, '0.0') for k in core.extra_fieldnames[1:])
+        return [(None, None) if forecast_hour == 3 else (grib_buffer, extra)] * len(sites)
+
+    def fake_am(layers_amc):
+        # later hours finish first
+        h = int(layers_amc)
+        time.sleep((12 - h) / 200.)
+        return (h, 12.5, 0.4, 0., 0., 260.5)
+
+    monkeypatch.setattr(core, 'download_group', fake_download)
+    monkeypatch.setattr(core, 'grib_buffer_to_am10', fake_decode)
+    monkeypatch.setattr(core, 'am_one_row', fake_am)
+    monkeypatch.setattr(core, 'courtesy_sleep', lambda: None)
+    monkeypatch.setattr(core, 'PIPELINE_DEPTH', 4)
+    monkeypatch.setattr(core, 'am_pool', ThreadPoolExecutor(max_workers=8))
+
+    gfs_cycle = datetime.datetime(2024, 3, 1, 12, tzinfo=datetime.timezone.utc)
+    sites = [{'name': 'a', 'vex': 'Aa'}, {'name': 'b', 'vex': 'Bb'}]
+    outfiles = [str(tmp_path / 'a'), str(tmp_path / 'b')]
+    outputs = [core.open_outputs(outfile) for outfile in outfiles]
+    stats = collections.defaultdict(int)
+    stats['stations'] = 2
+    resumeds = [{}, {5: ((5.5, 12.5, 0.4, 0., 0., 260.5), dict((k, '0.0') for k in core.extra_fieldnames[1:]))}]
+    core.make_forecast_table_group(sites, (0, 0, 0, 0), gfs_cycle, [o[0] for o in outputs], [o[1] for o in outputs],
+                                   hours=12, stats=stats, resumeds=resumeds)
+    for f, f2, fd2 in outputs:
+        core.close_outputs(f, fd2)
+    core.am_pool.shutdown()
+
+    expected = [h for h in range(12) if h != 3]  # no line for hour 3
+    for outfile in outfiles:
+        with open(outfile) as f:
+            taus = [float(line.split()[1]) for line in f.readlines()[1:]]
+        assert taus == expected
+        expected[4] = 5.5  # b resumed hour 5
+    assert stats['group_downloads'] == 12
+    assert 1 < stats['pipeline_max_in_flight'] <= 4, 'downloads ran ahead of am, but not too far'
+    assert stats['pipeline_am_busy_s'] > 0
+    assert stats['pipeline_am_util_pct'] > 100, 'am ran in parallel'
+
+
+def test_progressive(tmp_path, monkeypatch):
+    hours = core.forecast_hours()
+    order = core.progressive_order(hours)
+    assert sorted(order) == hours
+    assert order[:4] == [0, 12, 24, 36]
+    assert order[33:35] == [3, 6], 'every 12 hours out to 384, then every 3'
+    assert order[-1] == 119
+
+    def fake_download(sites, bbox, gfs_cycle, forecast_hour, **kwargs):
+        return str(forecast_hour)
+
+    def fake_decode(grib_buffer, sites, gfs_cycle, forecast_hour):
+        extra = dict((k, '0.0') for k in core.extra_fieldnames[1:])
+        return [(grib_buffer, extra)] * len(sites)
+
+    snapshots = []
+    write_table = core.write_table
+
+    def recording_write_table(outfile, gfs_cycle, table):
+        if not snapshots:
+            with open(outfile) as f:
+                assert f.read() == 'the last run\n', 'not truncated before the first rewrite'
+        write_table(outfile, gfs_cycle, table)
+        with open(outfile) as f:
+            snapshots.append([int(float(line.split()[1])) for line in f.readlines()[1:]])
+
+    monkeypatch.setattr(core, 'download_group', fake_download)
+    monkeypatch.setattr(core, 'grib_buffer_to_am10', fake_decode)
+    monkeypatch.setattr(core, 'am_one_row', lambda layers_amc: (int(layers_amc), 12.5, 0.4, 0., 0., 260.5))
+    monkeypatch.setattr(core, 'courtesy_sleep', lambda: None)
+    monkeypatch.setattr(core, 'write_table', recording_write_table)
+
+    gfs_cycle = datetime.datetime(2024, 3, 1, 12, tzinfo=datetime.timezone.utc)
+    outfile = str(tmp_path / 'a')
+    with open(outfile, 'w') as f:
+        f.write('the last run\n')
+    core.make_forecast_table_group([{'name': 'a', 'vex': 'Aa'}], None, gfs_cycle, [None], [None], hours=25,
+                                   rewrites=[outfile])
+
+    # once when each pass starts, with the rows of the pass before, and once at the end
+    assert snapshots == [[0, 3, 12, 24], [0, 1, 3, 6, 9, 12, 15, 18, 21, 24], list(range(25))]
+    assert len(core.read_table(outfile, gfs_cycle)) == 25
@@ -0,0 +1,83 @@
+import datetime
+
+from eht_met_forecast import deadline
+
+
+def test_levels():
+    levels = deadline.levels()
+    assert [len(hours) for name, hours in levels] == [209, 161, 129, 41, 17]
+    for (name, hours), (next_name, next_hours) in zip(levels, levels[1:]):
+        assert set(next_hours) < set(hours)
+    assert levels[1][1][:50] == list(range(49)) + [51], '48h hourly'
+
+
+def test_plan():
+    units = [('Kt', False), ('Aa', True), ('Mm', False)]
+
+    planned, skipped = deadline.plan(units, 10000)
+    assert skipped == []
+    assert all(level == 'full' for level, hours in planned.values())
+
+    planned, skipped = deadline.plan(units, 17)
+    assert skipped == ['Kt', 'Mm'], 'flushed stations are the last to be skipped'
+    assert planned['Aa'][0] == '3-hourly to 48h'
+
+    planned, skipped = deadline.plan(units, 209 + 2 * 41)
+    assert skipped == []
+    assert planned['Aa'][0] == 'full', 'flushed stations get the budget first'
+    assert planned['Kt'][0] == planned['Mm'][0] == '3-hourly to 120h', 'everyone else is upgraded evenly'
+
+    planned, skipped = deadline.plan(units, 209 + 41 + 17)
+    assert planned['Kt'][0] == '3-hourly to 120h'
+    assert planned['Mm'][0] == '3-hourly to 48h'
+
+    planned, skipped = deadline.plan(units, 5, hours=6)
+    assert planned['Aa'][1] == planned['Kt'][1] == [0, 3] and skipped == ['Mm']
+
+
+def test_parse_deadline():
+    now = datetime.datetime(2024, 4, 10, 14, 30, tzinfo=datetime.timezone.utc)
+    assert deadline.parse_deadline('17:20', now=now) == now.replace(hour=17, minute=20)
+    tomorrow = datetime.datetime(2024, 4, 11, 2, 0, tzinfo=datetime.timezone.utc)
+    assert deadline.parse_deadline('02:00', now=now) == tomorrow
+
+
+def test_seconds_per_request(tmp_path, monkeypatch):
+    import argparse
+    import time
+
+    from eht_met_forecast import gfs, timer_utils
+
+    monkeypatch.setattr(timer_utils, 'hists', {})
+    monkeypatch.setattr(timer_utils, 'totals', {})
+    monkeypatch.setattr(gfs, 'rate_controller', None)
+    args = argparse.Namespace(async_engine=True, rate=1., quota_per_minute=30., concurrency=4, dir=str(tmp_path),
+                              wait=False)
+    assert deadline.seconds_per_request(args) == 2., 'nothing measured, the quota is the limit'
+    args.async_engine = False
+    assert deadline.seconds_per_request(args) == deadline.SERIAL_SECONDS_PER_REQUEST
+
+    deadline.save_throughput(str(tmp_path), args, 50., 10)
+    deadline.save_throughput(str(tmp_path), args, 100., 5)  # too few to go by
+    assert deadline.seconds_per_request(args) == 5., 'measured by the last run'
+    args.async_engine = True
+    assert deadline.seconds_per_request(args) == 2., 'that was a serial run'
+    assert deadline.read_throughput(str(tmp_path), now=time.time() + 2 * 86400) == {}, 'too old'
+
+    for _ in range(deadline.MIN_MEASURED_DOWNLOADS):
+        with timer_utils.record_latency('fetch gfs data'):
+            pass
+    args.async_engine = False
+    assert deadline.seconds_per_request(args) == 2., 'the quota is still the limit'
+    args.quota_per_minute = None
+    assert 1. <= deadline.seconds_per_request(args) < 1.1, 'our own downloads, plus the courtesy sleep'
+
+    now, real_time = time.time(), time.time
+    clock = iter([now, now + 70.] * deadline.MIN_MEASURED_DOWNLOADS)
+    monkeypatch.setattr(time, 'time', lambda: next(clock))
+    for _ in range(deadline.MIN_MEASURED_DOWNLOADS):
+        with timer_utils.record_latency('fetch gfs data'):
+            pass  # throttled, with a 60 sec retry sleep
+    monkeypatch.setattr(time, 'time', real_time)
+    assert deadline.downloads() == 2 * deadline.MIN_MEASURED_DOWNLOADS, 'too slow for the histogram, still counted'
+    assert 36. <= deadline.seconds_per_request(args) < 36.1, 'half of them took 70 sec'
@@ -0,0 +1,100 @@
+import asyncio
+import datetime
+
+from eht_met_forecast import core, engine
+
+
+def test_table_order(capsys):
+    gfs_cycle = datetime.datetime(2020, 3, 16, 18)
+    table = engine.Table('Mm', {'name': 'JCMT'}, gfs_cycle, None, [0, 1, 2, 3], stdout=True)
+    table.open()
+    row = (1., 2., 3., 4., 5., 6.)
+
+    asyncio.run(table.done(2, (row, {})))
+    asyncio.run(table.done(1, None))  # no line emitted for hour 1
+    out, err = capsys.readouterr()
+    assert out.count('\n') == 1  # just the header
+
+    asyncio.run(table.done(0, (row, {})))
+    out, err = capsys.readouterr()
+    assert out.startswith('20200316_18:00:00')
+    assert '20200316_20:00:00' in out
+    assert '19:00:00' not in out
+
+    table.fail(3)
+    asyncio.run(table.done(3, (row, {})))
+    out, err = capsys.readouterr()
+    assert out == ''
+    assert table.outstanding == 0
+
+
+def test_group_download(tmp_path, monkeypatch):
+    fetched = []
+
+    async def fake_fetch(url, params, limiter, executor, **kwargs):
+        fetched.append(params['file'])
+        return b'grib'
+
+    def fake_decode(grib_buffer, sites, gfs_cycle, forecast_hour):
+        return [('{} {}'.format(site['vex'], forecast_hour), {}) for site in sites]
+
+    def fake_am(layers_amc):
+        vex, h = layers_amc.split()
+        return (float(h), 0., 0., 0., 0., 0.)
+
+    monkeypatch.setattr(engine, 'fetch_gfs_download_async', fake_fetch)
+    monkeypatch.setattr(core, 'grib_buffer_to_am10', fake_decode)
+    monkeypatch.setattr(core, 'am_one_row', fake_am)
+
+    gfs_cycle = datetime.datetime(2020, 3, 16, 18)
+    tables = [engine.Table(vex, {'name': vex, 'vex': vex, 'lat': 19.8, 'lon': -155.5, 'alt': 4000}, gfs_cycle,
+                           str(tmp_path / vex), [0, 1, 2]) for vex in ('Mm', 'Sw')]
+    tables[1].resumed = {1: ((1.5, 0., 0., 0., 0., 0.), {})}
+    assert engine.run_engine([((-156, -155, 19, 20), tables)], rate=1000.) is None
+    assert sorted(fetched) == ['gfs.t18z.pgrb2.0p25.f000', 'gfs.t18z.pgrb2.0p25.f001', 'gfs.t18z.pgrb2.0p25.f002']
+
+    for vex, taus in (('Mm', [0., 1., 2.]), ('Sw', [0., 1.5, 2.])):
+        with open(str(tmp_path / vex)) as f:
+            assert [float(line.split()[1]) for line in f.readlines()[1:]] == taus
+
+
+def test_priority_semaphore():
+    async def run():
+        sem = engine.PrioritySemaphore(2, backfill_slots=1)
+        order = []
+
+        async def worker(name, priority, backfill):
+            await sem.acquire(priority, backfill=backfill)
+            order.append(name)
+            assert sem.backfill_held <= 1
+            await asyncio.sleep(0.01)
+            sem.release(backfill=backfill)
+
+        await sem.acquire((0,))
+        await sem.acquire((0,))
+        tasks = [asyncio.ensure_future(worker(name, priority, backfill)) for name, priority, backfill in (
+            ('old', (12, True, 0), True), ('older', (18, True, 0), True),
+            ('late', (0, True, 5), False), ('flushed', (0, False, 7), False))]
+        await asyncio.sleep(0)
+        sem.release()
+        sem.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    order = asyncio.run(run())
+    assert order[:2] == ['flushed', 'late'], 'current cycle first, flushed stations first'
+    assert order[2:] == ['old', 'older']
+
+    async def current_behind_backfill():
+        sem = engine.PrioritySemaphore(2, backfill_slots=1)
+        await sem.acquire((12, True, 0), backfill=True)
+        waiting = asyncio.ensure_future(sem.acquire((18, True, 0), backfill=True))
+        await asyncio.sleep(0)
+        assert sem.free == 1 and sem.waiters, 'backfill is at its limit'
+        await asyncio.wait_for(sem.acquire((0, True, 0)), 1)
+        assert not waiting.done(), 'the current cycle took the free slot'
+        waiting.cancel()
+
+    asyncio.run(current_behind_backfill())
+    assert engine.priority([engine.Table('Mm', {}, datetime.datetime(2020, 3, 16, 12), None, [0])], 3,
+                           datetime.datetime(2020, 3, 16, 18)) == ((6, True, 3), True)
@@ -1,3 +1,10 @@
+import datetime
+import os
+from collections import defaultdict
+
+import pytest
+import requests_mock
+
 import eht_met_forecast.gfs as gfs
 
 
@@ -10,3 +17,98 @@ def test_jiggle():
     assert gfs.jiggle(10) < 14
     assert gfs.jiggle(1) < 2
 
+
+idx = '''1:0:d=2024030112:PRMSL:mean sea level:anl:
+2:100:d=2024030112:CLWMR:1 mb:anl:
+3:250:d=2024030112:TMP:1 mb:anl:
+4:300:d=2024030112:TMP:2 m above ground:anl:
+5:5000:d=2024030112:RH:1000 mb:anl:
+'''
+
+
+def test_parse_idx():
+    entries = gfs.parse_idx(idx)
+    assert entries[0] == (0, 100, 'PRMSL', 'mean sea level')
+    assert entries[-1] == (5000, None, 'RH', '1000 mb')
+
+    ranges = gfs.select_ranges(entries)
+    assert ranges == [(100, 250), (250, 300), (5000, None)]
+
+    assert gfs.coalesce_ranges(ranges, max_gap=0) == [[100, 300, [(100, 250), (250, 300)]],
+                                                      [5000, None, [(5000, None)]]]
+    assert len(gfs.coalesce_ranges(ranges, max_gap=10000)) == 1
+
+
+def grib_messages(count):
+    # the first count messages of test.grb, and their offsets
+    fname = os.path.split(__file__)[0] + '/../test.grb'
+    with open(fname, 'rb') as f:
+        content = f.read()
+    offsets = [0]
+    for _ in range(count):
+        offsets.append(offsets[-1] + int.from_bytes(content[offsets[-1]+8:offsets[-1]+16], 'big'))
+    return content[:offsets[-1]], offsets
+
+
+def test_download_gfs_byterange():
+    gfs_cycle = datetime.datetime(2024, 3, 1, 12)
+    url = gfs.form_gfs_full_url(gfs_cycle, 3, base_url='https://example.com/gfs')
+    assert url == 'https://example.com/gfs/gfs.20240301/12/atmos/gfs.t12z.pgrb2.0p25.f003'
+
+    body, offsets = grib_messages(5)
+    lines = idx.splitlines()
+    real_idx = ''.join(':'.join([str(i+1), str(o)] + line.split(':')[2:]) + '\n'
+                       for i, (o, line) in enumerate(zip(offsets, lines)))
+
+    def ranged(request, context):
+        start, end = request.headers['Range'][len('bytes='):].split('-')
+        context.status_code = 206
+        return body[int(start):int(end) + 1 if end else None]
+
+    with requests_mock.Mocker() as m:
+        m.get(url + '.idx', text=real_idx)
+        m.get(url, content=ranged)
+        buf = gfs.download_gfs_byterange(gfs_cycle, 3, base_url='https://example.com/gfs')
+        assert buf == body[offsets[1]:offsets[3]] + body[offsets[4]:]
+        assert m.call_count == 2, 'idx, then one request for the nearby messages'
+
+        # a server that ignores Range:
+        m.get(url, content=body)
+        assert gfs.download_gfs_byterange(gfs_cycle, 3, base_url='https://example.com/gfs') == buf
+
+
+def test_grib_framer():
+    body, offsets = grib_messages(3)
+
+    framer = gfs.GribFramer()
+    for i in range(0, len(body), 7):
+        framer.feed(body[i:i+7])
+    assert framer.finish() == body
+    assert framer.messages == 3
+
+    with pytest.raises(gfs.GribFramingError, match='truncated'):
+        framer = gfs.GribFramer()
+        framer.feed(body[:-10])
+        framer.finish()
+
+    with pytest.raises(gfs.GribFramingError, match='no GRIB header'):
+        gfs.GribFramer().feed(b'<html><body>Your allowed limit has been reached</body></html>')
+
+    with pytest.raises(gfs.GribFramingError, match='7777'):
+        gfs.GribFramer().feed(body[:offsets[1]-4] + b'8888')
+
+    bad = bytearray(body)
+    bad[16:20] = (1000).to_bytes(4, 'big')  # section 1 length
+    with pytest.raises(gfs.GribFramingError, match='overruns'):
+        gfs.GribFramer().feed(bad)
+
+
+def test_bad_grib_is_retried(monkeypatch):
+    body, offsets = grib_messages(2)
+    monkeypatch.setattr(gfs.time, 'sleep', lambda s: None)
+    stats = defaultdict(int, stations=['Kt'])  # like cli.main, empty stats are falsy
+    with requests_mock.Mocker() as m:
+        m.get('https://example.com/grib', [{'content': body[:-100]}, {'content': body}])
+        assert gfs.fetch_gfs_download('https://example.com/grib', {}, stats=stats) == body
+        assert m.call_count == 2
+    assert stats['bad_grib'] == 1
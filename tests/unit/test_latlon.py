@@ -0,0 +1,28 @@
+from eht_met_forecast import latlon
+
+
+def test_union_box():
+    b1 = latlon.box(19.824, -155.478, 0.25)
+    b2 = latlon.box(19.823, -155.477, 0.25)
+    assert b1 == b2
+    assert latlon.union_box((b1, b2)) == b1
+
+    b3 = latlon.box(20.1, -155.1, 0.25)
+    assert latlon.union_box((b1, b3)) == (-155.5, -155.0, 19.75, 20.25)
+
+
+def test_group_stations():
+    sites = [
+        {'vex': 'Kt', 'lat': 31.953, 'lon': -111.615},
+        {'vex': 'Sw', 'lat': 19.824, 'lon': -155.478},
+        {'vex': 'Mg', 'lat': 32.702, 'lon': -109.891},
+        {'vex': 'Mm', 'lat': 19.823, 'lon': -155.477},
+        {'vex': 'Sz', 'lat': -90.0, 'lon': 45.0},
+    ]
+    groups = latlon.group_stations(sites, 0.25, 2.0)
+    assert [[s['vex'] for s in g] for b, g in groups] == [['Kt', 'Mg'], ['Sw', 'Mm'], ['Sz']]
+    assert groups[0][0] == (-111.75, -109.75, 31.75, 32.75)
+    assert groups[1][0] == latlon.box(19.824, -155.478, 0.25)
+
+    groups = latlon.group_stations(sites, 0.25, 0.25)
+    assert len(groups) == 4
@@ -0,0 +1,16 @@
+from eht_met_forecast import am, cli, gfs
+
+
+def test_main_resets_globals(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli.time, 'sleep', lambda s: None)
+    common = ['--vex', 'Mm', '--dir', str(tmp_path), '--dry-run']
+    cli.main(common + ['--aimd', '--quota-per-minute', '100', '--grib-cache', str(tmp_path / 'g'),
+                       '--am-cache', str(tmp_path / 'a'), '--byterange-url'])
+    assert gfs.rate_controller and gfs.byterange_url and am.am_cache
+
+    cli.main(common)
+    assert gfs.rate_controller is None
+    assert gfs.request_quota is None
+    assert gfs.grib_cache is None
+    assert gfs.byterange_url is None
+    assert am.am_cache is None
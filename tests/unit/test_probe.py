@@ -0,0 +1,51 @@
+import datetime
+
+import requests_mock
+
+from eht_met_forecast import probe
+
+listing = '''
+<a href="gfs.t12z.pgrb2.0p25.f000">gfs.t12z.pgrb2.0p25.f000</a>
+<a href="gfs.t12z.pgrb2.0p25.f000.idx">gfs.t12z.pgrb2.0p25.f000.idx</a>
+<a href="gfs.t12z.pgrb2.0p25.f001">gfs.t12z.pgrb2.0p25.f001</a>
+<a href="gfs.t12z.pgrb2.0p25.f001.idx">gfs.t12z.pgrb2.0p25.f001.idx</a>
+<a href="gfs.t12z.pgrb2.0p25.f002">gfs.t12z.pgrb2.0p25.f002</a>
+<a href="gfs.t12z.pgrb2.1p00.f003.idx">gfs.t12z.pgrb2.1p00.f003.idx</a>
+<a href="gfs.t12z.pgrb2b.0p25.f004.idx">gfs.t12z.pgrb2b.0p25.f004.idx</a>
+'''
+
+
+def test_parse_listing():
+    gfs_cycle = datetime.datetime(2024, 3, 1, 12)
+    assert probe.parse_listing(listing, gfs_cycle) == {0, 1}
+    assert probe.listing_url(gfs_cycle).endswith('/gfs.20240301/12/atmos/')
+
+
+def test_prober():
+    gfs_cycle = datetime.datetime(2024, 3, 1, 12)
+    stats = {'probe_listings': 0}
+    prober = probe.AvailabilityProber(delay=3600, stats=stats)
+    with requests_mock.Mocker() as m:
+        m.get(probe.listing_url(gfs_cycle), text=listing)
+        assert prober.is_published(gfs_cycle, 0)
+        assert prober.is_published(gfs_cycle, 1)
+        assert not prober.is_published(gfs_cycle, 2)  # no .idx yet
+        assert m.call_count == 1, 'one listing answers every hour'
+
+        m.get(probe.listing_url(gfs_cycle), status_code=404)
+        prober.delay = 0
+        assert not prober.is_published(gfs_cycle, 2)
+    assert stats['probe_listings'] == 2
+
+
+def test_oldest_cycle():
+    top = '<a href="gfs.20240302/">gfs.20240302/</a>\n<a href="gfs.20240301/">gfs.20240301/</a>\n'
+    day = '<a href="12/">12/</a>\n<a href="18/">18/</a>\n'
+    prober = probe.AvailabilityProber()
+    with requests_mock.Mocker() as m:
+        m.get(probe.NOMADS_PROD_URL + '/', text=top)
+        m.get(probe.NOMADS_PROD_URL + '/gfs.20240301/', text=day)
+        assert prober.oldest_cycle() == datetime.datetime(2024, 3, 1, 12, tzinfo=datetime.timezone.utc)
+
+        m.get(probe.NOMADS_PROD_URL + '/', status_code=503)
+        assert prober.oldest_cycle() is None
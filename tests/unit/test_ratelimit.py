@@ -0,0 +1,107 @@
+import asyncio
+import fcntl
+import threading
+import time
+
+from eht_met_forecast import ratelimit
+
+
+def test_token_bucket():
+    async def take(bucket, n):
+        for _ in range(n):
+            await bucket.acquire()
+
+    bucket = ratelimit.TokenBucket(20., burst=1)
+    t0 = time.monotonic()
+    asyncio.run(take(bucket, 5))
+    elapsed = time.monotonic() - t0
+    # first token is free, the other 4 take 1/20 s each
+    assert 0.15 < elapsed < 1.0
+    assert bucket.waited > 0.
+
+
+def test_aimd_rate():
+    controller = ratelimit.AIMDRate(1.0, min_rate=0.1, max_rate=1.05, increase=0.02, decrease=0.5)
+    controller.success()
+    assert controller.rate == 1.02
+    controller.success()
+    controller.success()
+    assert controller.rate == 1.05
+
+    controller.throttled()
+    assert controller.rate == 0.525
+    assert controller.tokens <= 0
+    for _ in range(10):
+        controller.throttled()
+    assert controller.rate == 0.1
+    assert controller.backoffs == 11
+
+    stats = {}
+    controller.success()
+    controller.report(stats)
+    assert stats['aimd_backoffs'] == 11
+    assert stats['aimd_rate_per_minute'] == 7.2
+    assert stats['aimd_throttled_s'] == 0
+
+
+def test_aimd_throttle_classification():
+    from collections import defaultdict
+    from eht_met_forecast import gfs
+
+    class FakeResponse:
+        status_code = 503
+        headers = {}
+        text = ''
+
+    stats = defaultdict(int)
+    stats['x'] = 1
+    try:
+        gfs.rate_controller = ratelimit.AIMDRate(1.0)
+        errflag, retry_bonus, retry_duration, quiet_retry = gfs.classify_response(FakeResponse(), 1, stats=stats)
+        assert errflag == 1 and retry_bonus == 1
+        assert retry_duration == 0  # the controller does the waiting
+        assert gfs.rate_controller.rate == 0.5
+        assert stats['ratelimit_503'] == 1
+
+        FakeResponse.status_code = 200
+        gfs.classify_response(FakeResponse(), 1, stats=stats)
+        assert gfs.rate_controller.rate > 0.5
+    finally:
+        gfs.rate_controller = None
+
+
+def test_file_quota(tmp_path):
+    path = str(tmp_path / 'quota')
+    q1 = ratelimit.FileQuota(path, 600.)  # 10 per second
+    q2 = ratelimit.FileQuota(path, 600.)  # another process, same file
+
+    assert q1.take() == 0  # the burst token
+    delay = q2.take()
+    assert 0 < delay <= 0.1, 'q2 sees that q1 took the token'
+
+    t0 = time.monotonic()
+    for q in (q1, q2, q1, q2):
+        q.wait()
+    assert time.monotonic() - t0 > 0.25
+
+
+def test_file_quota_async(tmp_path):
+    path = str(tmp_path / 'quota')
+    quota = ratelimit.FileQuota(path, 600.)
+    ticks = []
+
+    async def tick():
+        for _ in range(10):
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.02)
+
+    async def run():
+        await asyncio.gather(quota.acquire(), tick())
+
+    with open(path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)  # another process holds the quota file
+        t0 = time.monotonic()
+        threading.Timer(0.2, fcntl.flock, (f, fcntl.LOCK_UN)).start()
+        asyncio.run(run())
+    assert time.monotonic() - t0 >= 0.2
+    assert len([t for t in ticks if t - t0 < 0.2]) > 3, 'the event loop kept running while acquire waited'
@@ -0,0 +1,76 @@
+import numpy as np
+from pytest import approx
+
+from eht_met_forecast import surrogate
+
+
+layers_amc = '''
+# header comment
+layer
+Pbase 100.0 mbar  # 16000.0 m
+Tbase 210.0 K
+column dry_air vmr
+column o3 vmr 1.000e-06
+column h2o vmr 5.000e-06
+
+layer
+Pbase 600.0 mbar  # 4000.0 m
+Tbase 270.0 K
+column dry_air vmr
+column h2o RH 50.00%
+column lwp_abs_Rayleigh 1.000e-02 kg*m^-2
+column iwp_abs_Rayleigh 2.000e-02 kg*m^-2
+'''
+
+
+def test_layer_columns():
+    pwv, lwp, iwp, o3 = surrogate.layer_columns(layers_amc)
+    assert lwp == 0.01
+    assert iwp == 0.02
+    n_air = 100e2 / surrogate.G_STD / surrogate.M_AIR * surrogate.AVOGADRO / 1e4
+    assert o3 == approx(n_air * 1e-6 / surrogate.DU)
+
+    # 50% RH at 240 K and 350 mbar, the means of the layer's top and base
+    h2o = n_air * 5e-6 + 5 * n_air * 0.5 * surrogate.e_liquid(240.) / 35000.
+    assert pwv == approx(h2o / surrogate.MM_PWV)
+    assert surrogate.e_liquid(273.15) == approx(611.2, rel=1e-3)
+    assert surrogate.e_ice(273.15) == approx(611.2, rel=1e-3)
+
+
+def test_fit():
+    rng = np.random.default_rng(1)
+    pwv = rng.uniform(0.2, 5., 500)
+    lwp = rng.uniform(0., 0.1, 500) * (rng.uniform(size=500) > 0.7)
+    iwp = rng.uniform(0., 0.1, 500) * (rng.uniform(size=500) > 0.7)
+    tau = 0.01 + 0.06 * pwv + 0.5 * lwp + 0.02 * iwp
+    Tb = 260. * (1 - np.exp(-tau)) + 2.
+    rows = np.column_stack((tau, Tb, pwv, lwp, iwp, np.full(500, 280.)))
+
+    assert surrogate.fit_station([rows[:50]]) is None, 'no tables left to fit'
+    assert surrogate.fit_station([rows[:50], rows[50:60]]) is None, 'too few rows'
+
+    coefficients = surrogate.fit_station([rows[:100], rows[100:200], rows[200:300], rows[300:400], rows[400:]])
+    assert coefficients['tau'] == approx([0.01, 0.06, 0.5, 0.02])
+    assert coefficients['Tb'] == approx([260., 2.])
+    assert coefficients['fit_rows'] == 400
+    assert coefficients['validation']['rows'] == 100
+    assert coefficients['validation']['tau_rms'] < 1e-9
+
+    row = surrogate.estimate_row(coefficients, layers_amc)
+    pwv, lwp, iwp, o3 = surrogate.layer_columns(layers_amc)
+    assert row == approx((0.01 + 0.06 * pwv + 0.005 + 0.0004, 260. * (1 - np.exp(-row[0])) + 2., pwv, lwp, iwp, o3))
+
+
+def test_for_hour(tmp_path, monkeypatch):
+    site = {'vex': 'Mm', 'name': 'JCMT'}
+    assert surrogate.for_hour(site, 200) is None
+    path = tmp_path / 'surrogate.json'
+    path.write_text('{"Mm": {"tau": [0.0, 0.06, 0.0, 0.0], "Tb": [260.0, 2.0], "fit_rows": 1000, '
+                    '"validation": {"rows": 200}}}')
+    monkeypatch.setattr(surrogate, 'table', surrogate.load_table(str(path)))
+    monkeypatch.setattr(surrogate, 'from_hour', 123)
+    assert surrogate.for_hour(site, 120) is None
+    assert surrogate.for_hour(site, 123)['Tb'] == [260., 2.]
+    assert surrogate.for_hour({'vex': 'Kt'}, 200) is None, 'no fit, am is run'
+    monkeypatch.setattr(surrogate.am, 'frequencies', [225, 345])
+    assert surrogate.for_hour(site, 200) is None, 'am is needed for the other bands'